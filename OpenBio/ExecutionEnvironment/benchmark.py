@@ -0,0 +1,193 @@
+'''
+Benchmarks of the executor on synthetic workflows
+
+Example:
+python benchmark.py node_order
+'''
+
+import time
+import random
+import argparse
+
+from executor import g, setup_bash_patterns, find_circle, transitive_reduction
+from executor import Workflow, LocalExecutor, CWLExecutor, AirflowExecutor, ArgoExecutor, NextflowExecutor, SnakemakeExecutor
+
+def synthetic_tools(n, max_dependencies=5, seed=0):
+    '''
+    n tool nodes. Every tool depends on up to max_dependencies of the tools before it (a DAG).
+    The tools are shuffled, so that the order of the nodes is not a topological order
+    '''
+
+    rnd = random.Random(seed)
+    tools = []
+    for i in range(n):
+        dependencies = rnd.sample(range(i), min(i, rnd.randint(0, max_dependencies)))
+        tools.append({
+            'name': 'tool{}'.format(i),
+            'version': '1',
+            'edit': 1,
+            'dependencies': ['tool{}/1/1'.format(j) for j in dependencies],
+            'variables': [{'name': 'var{}'.format(k), 'value': '', 'description': ''} for k in range(2)],
+        })
+    rnd.shuffle(tools)
+    return tools
+
+def synthetic_workflow(n_tools, n_steps, seed=0):
+    '''
+    A workflow object (as the one that views.download_workflow creates) with the synthetic_tools and n_steps steps.
+    The main step calls all other steps. Every step uses a tool. The first step sets the output.
+    '''
+
+    belongto = {'name': 'benchmark', 'edit': 1}
+    tools = synthetic_tools(n_tools, seed=seed)
+    for tool in tools:
+        tool.update({
+            'id': Workflow.get_tool_dash_id(tool), 'type': 'tool', 'label': Workflow.get_tool_slash_id(tool), 'belongto': belongto,
+            'installation_commands': 'echo "installing {}"\n'.format(tool['name']) * 10,
+            'validation_commands': 'echo "validating {}"\n'.format(tool['name']),
+        })
+
+    step_ids = ['step__step{}__benchmark__1'.format(i) for i in range(n_steps)]
+    steps = [{
+        'id': step_id, 'type': 'step', 'name': step_id.split('__')[1], 'main': False, 'sub_main': False, 'belongto': belongto,
+        'bash': 'echo "{}"\n'.format(step_id) * 10 + 'output__result__benchmark__1=done\n' * (i == 0), 'steps': [], 
+        'tools': [tools[i % n_tools]['id']] if n_tools else [], 'inputs': [], 'outputs': ['output__result__benchmark__1'] if i == 0 else [],
+    } for i, step_id in enumerate(step_ids)]
+    steps.insert(0, {
+        'id': 'step__main__benchmark__1', 'type': 'step', 'name': 'main', 'main': True, 'sub_main': False, 'belongto': belongto,
+        'bash': ''.join('echo before\n{}\n'.format(step_id) for step_id in step_ids), 'steps': step_ids, 
+        'tools': [], 'inputs': [], 'outputs': [],
+    })
+
+    nodes = [
+        {'id': 'benchmark__1', 'type': 'workflow', 'name': 'benchmark', 'edit': 1, 'belongto': None, 'label': 'benchmark/1'},
+        {'id': 'output__result__benchmark__1', 'type': 'output', 'name': 'result', 'description': 'result', 'belongto': belongto},
+    ] + tools + steps
+
+    return {
+        'arguments': {},
+        'workflow': {'elements': {'nodes': [{'data': node} for node in nodes], 'edges': []}},
+        'token': None,
+        'nice_id': None,
+    }
+
+def timeit(f, repeat=3):
+    '''
+    Best time of repeat runs (seconds)
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def benchmark_node_order(sizes):
+    '''
+    Workflow.get_node_order (tool installation order)
+    '''
+
+    workflow = Workflow.__new__(Workflow) # get_node_order does not need a parsed workflow
+    for n in sizes:
+        tools = synthetic_tools(n)
+        elapsed = timeit(lambda: workflow.get_node_order(
+            node_iterator = lambda: iter(tools),
+            id_getter = Workflow.get_tool_slash_id,
+            dependency_getter = lambda x: x['dependencies'],
+        ))
+        print ('get_node_order  tools: {:>6}  time: {:.4f}s'.format(n, elapsed))
+
+def benchmark_circles(sizes):
+    '''
+    find_circle (Workflow.check_tool_dependencies_for_circles) on DAGs with many diamonds
+    '''
+
+    for n in sizes:
+        graph = {Workflow.get_tool_slash_id(tool): tool['dependencies'] for tool in synthetic_tools(n, max_dependencies=10)}
+        elapsed = timeit(lambda: find_circle(graph))
+        print ('find_circle     tools: {:>6}  time: {:.4f}s'.format(n, elapsed))
+
+def benchmark_reduction(sizes):
+    '''
+    transitive_reduction (BaseExecutor.transitive_reduction) on the graph of CompiledWorkflow: 
+    An init node before all steps and a final node after all steps. Every step runs after up to 5 steps before it.
+    '''
+
+    for n in sizes:
+        rnd = random.Random(0)
+        steps = ['step{}'.format(i) for i in range(n)]
+        edges = [(steps[j], steps[i]) for i in range(n) for j in rnd.sample(range(i), min(i, 5))]
+        edges += [('OBC_INIT', step) for step in steps] + [(step, 'OBC_FINAL') for step in steps]
+        elapsed = timeit(lambda: transitive_reduction(edges))
+        print ('reduction       steps: {:>6}  time: {:.4f}s'.format(n, elapsed))
+
+def benchmark_variables(sizes):
+    '''
+    Workflow.get_tool_dependent_variables (the variables of all direct and indirect dependencies of every tool)
+    '''
+
+    workflow = Workflow.__new__(Workflow)
+    for n in sizes:
+        tools = synthetic_tools(n)
+        workflow.nodes_by_type = {Workflow.TOOL_TYPE: tools}
+        workflow.tool_slash_id_d = {Workflow.get_tool_slash_id(tool): tool for tool in tools}
+        elapsed = timeit(workflow.get_tool_dependent_variables)
+        print ('variables       tools: {:>6}  time: {:.4f}s'.format(n, elapsed))
+
+def benchmark_build(sizes):
+    '''
+    Script generation (Executor.build) for every executor. Sizes are the number of tools. There are as many steps as tools.
+    The workflow is parsed once, before timing. Every build compiles it again (Workflow.compiled), except from the last line ("all"),
+    where all executors render the same CompiledWorkflow.
+    '''
+
+    setup_bash_patterns(type('A', (), {'server': 'http://127.0.0.1:8200/platform', 'insecure': False}))
+    g['silent'] = True
+    builds = [
+        ('sh', LocalExecutor, lambda e: e.build(output=None)),
+        ('cwltargz', CWLExecutor, lambda e: e.build(output=None, output_format='cwltargz', workflow_id='benchmark')),
+        ('airflow', AirflowExecutor, lambda e: e.build(output=None, workflow_id='benchmark')),
+        ('argo', ArgoExecutor, lambda e: e.build(output=None, workflow_id='benchmark')),
+        ('nextflow', NextflowExecutor, lambda e: e.build(output=None, workflow_id='benchmark')),
+        ('snakemake', SnakemakeExecutor, lambda e: e.build(output=None, workflow_id='benchmark')),
+    ]
+
+    for n in sizes:
+        workflow = Workflow(workflow_object=synthetic_workflow(n, n), askinput='NO', obc_server='http://127.0.0.1:8200/platform', workflow_id='benchmark')
+        def build_one(executor_class, build):
+            workflow.compiled = None
+            build(executor_class(workflow))
+
+        def build_all():
+            workflow.compiled = None
+            for _, executor_class, build in builds:
+                build(executor_class(workflow))
+
+        for name, executor_class, build in builds:
+            elapsed = timeit(lambda: build_one(executor_class, build))
+            print ('build {:<10}tools: {:>6}  time: {:.4f}s'.format(name, n, elapsed))
+
+        elapsed = timeit(build_all)
+        print ('build {:<10}tools: {:>6}  time: {:.4f}s'.format('all', n, elapsed))
+
+BENCHMARKS = {
+    'node_order': lambda args: benchmark_node_order(args.sizes or [1000, 5000, 20000]),
+    'circles': lambda args: benchmark_circles(args.sizes or [1000, 5000, 20000]),
+    'reduction': lambda args: benchmark_reduction(args.sizes or [1000, 5000, 10000]),
+    'variables': lambda args: benchmark_variables(args.sizes or [100, 500, 1000]),
+    'build': lambda args: benchmark_build(args.sizes or [50, 200]),
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OpenBio-C executor benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run: {} (default: all)'.format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--sizes', type=int, nargs='+', help='Sizes of the synthetic workflows')
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if not name in BENCHMARKS:
+            parser.error('Unknown benchmark: {}'.format(name))
+
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](args)
@@ -6,15 +6,15 @@ import csv
 import copy
 import json
 import base64
+import hashlib
 import random
 import string
+import threading
 import logging
 import bashlex
 import tarfile
 import zipfile
 
-import networkx as nx
-
 try:
     import zlib
     compression = zipfile.ZIP_DEFLATED
@@ -23,7 +23,7 @@ except (ImportError, AttributeError):
 
 import argparse 
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -32,20 +32,131 @@ class OBC_Executor_Exception(Exception):
 	'''
 	pass
 
-def detect_circles(graph, start, end):
+def find_circle(graph):
     '''
-    https://stackoverflow.com/questions/40833612/find-all-cycles-in-a-graph-implementation
+    graph: dictionary. node --> list of nodes. Nodes that are not keys of graph are ignored.
+    Returns a circle as a list of nodes: [a, b, start] for start --> a --> b --> start , or None.
+    One iterative DFS with three colors. O(nodes + edges)
     '''
-    fringe = [(start, [])]
-    while fringe:
-        state, path = fringe.pop()
-        if path and state == end:
-            yield path
+
+    WHITE, GRAY, BLACK = 0, 1, 2 # Not visited, in the current path, done
+    color = {node: WHITE for node in graph}
+
+    for root in graph:
+        if color[root] != WHITE:
             continue
-        for next_state in graph[state]:
-            if next_state in path:
-                continue
-            fringe.append((next_state, path+[next_state]))
+
+        color[root] = GRAY
+        path = [root]
+        stack = [iter(graph[root])]
+        while stack:
+            for next_node in stack[-1]:
+                if not next_node in color:
+                    continue
+                if color[next_node] == GRAY:
+                    return path[path.index(next_node)+1:] + [next_node]
+                if color[next_node] == WHITE:
+                    color[next_node] = GRAY
+                    path.append(next_node)
+                    stack.append(iter(graph[next_node]))
+                    break
+            else:
+                color[path.pop()] = BLACK
+                stack.pop()
+
+    return None
+
+class DAG:
+    '''
+    A directed graph with the (read only) interface of networkx.DiGraph that the executors use:
+    nodes(), predecessors(node), successors(node) and edges (in this order: for every node, its successors).
+    '''
+
+    def __init__(self, nodes, successors):
+        '''
+        nodes: list of nodes
+        successors: list of lists. The successors of nodes[i] are successors[i]
+        '''
+        self.succ = OrderedDict((node, []) for node in nodes)
+        self.pred = OrderedDict((node, []) for node in nodes)
+        for node, node_successors in zip(nodes, successors):
+            for successor in node_successors:
+                self.succ[node].append(successor)
+                self.pred[successor].append(node)
+
+    def nodes(self,):
+        return list(self.succ)
+
+    def successors(self, node):
+        return iter(self.succ[node])
+
+    def predecessors(self, node):
+        return iter(self.pred[node])
+
+    @property
+    def edges(self,):
+        return [(node, successor) for node, node_successors in self.succ.items() for successor in node_successors]
+
+def transitive_reduction(edges):
+    '''
+    edges: list of (a, b) for a --> b. The graph should be acyclic
+    Returns the transitive reduction as a DAG: The edge a --> b is kept only if b cannot be reached from any other successor of a.
+
+    The nodes are indexed with integers. The descendants of every node are a bitset (an int) that is the union of the
+    successors and the descendants of the successors. These are computed once per node in reverse topological order.
+    
+    The nodes, the edges and their order are the same as networkx.transitive_reduction(networkx.DiGraph(edges)):
+    nodes in order of appearance in edges and, for every node, its remaining successors in the order of a python set (as networkx does).
+    '''
+
+    index = {}
+    successors = []
+    for a, b in edges:
+        for node in (a, b):
+            if not node in index:
+                index[node] = len(index)
+                successors.append([])
+        if not index[b] in successors[index[a]]:
+            successors[index[a]].append(index[b])
+    nodes = list(index)
+    n = len(nodes)
+
+    # Topological order (Kahn)
+    in_degree = [0] * n
+    for node_successors in successors:
+        for successor in node_successors:
+            in_degree[successor] += 1
+    order = [node for node in range(n) if not in_degree[node]]
+    for node in order: # order grows while we iterate 
+        for successor in successors[node]:
+            in_degree[successor] -= 1
+            if not in_degree[successor]:
+                order.append(successor)
+    if len(order) != n:
+        raise OBC_Executor_Exception('Error: 6913: The dependencies of the steps contain a circle')
+
+    descendants = [0] * n
+    reduced = [None] * n
+    for node in reversed(order):
+        node_descendants = 0
+        for successor in successors[node]:
+            node_descendants |= descendants[successor] | (1 << successor)
+        descendants[node] = node_descendants
+
+        # Remove the successors that are descendants of other successors. 
+        # This is done with the same set operations as networkx, so that the remaining successors are in the same order
+        remaining = set(nodes[x] for x in successors[node])
+        remaining_bits = 0
+        for successor in successors[node]:
+            remaining_bits |= 1 << successor
+        for successor in successors[node]:
+            remove = descendants[successor] & remaining_bits
+            if remove and (remaining_bits >> successor) & 1:
+                remaining_bits ^= remove
+                remaining -= {nodes[x] for x in successors[node] if (remove >> x) & 1}
+        reduced[node] = list(remaining)
+
+    return DAG(nodes, reduced)
 
 bash_patterns = {
     'check_envsanity': r'''
@@ -100,6 +211,71 @@ function update_server_status()
     fi
 }
 
+''',
+    'update_server_status_batch': r'''
+# Batch reporting. update_server_status only appends the status to a spool file. 
+# A background sender (started with the first status) posts the new lines of the spool to the server every OBC_STATUS_INTERVAL seconds.
+# Only the sender uses (and updates) the token.
+function obc_status_send()
+{
+    local size=$(wc -c < "${OBC_STATUS_SPOOL}")
+    if (( size <= obc_status_offset )); then
+        return
+    fi
+
+    local statuses=$(tail -c +$((obc_status_offset+1)) "${OBC_STATUS_SPOOL}" | head -c $((size-obc_status_offset)) | sed -e 's/\\/\\\\/g' -e 's/"/\\"/g' -e 's/.*/"&"/' | paste -s -d, -)
+    local c=$(curl {insecure}-s --header "Content-Type: application/json" --request POST -d "{\"token\": \"${obc_current_token}\", \"statuses\": [${statuses}]}" {server}/report_batch/)
+
+    if [[ $c == *'"success": true'* ]]; then
+        obc_current_token=$(obc_parse_json "$c" "token")
+        obc_status_offset=$size
+    elif [[ $c == *'"success": false'* ]]; then
+        obc_error_message=$(obc_parse_json "$c" "error_message")
+        echo "Server Return Error: $obc_error_message"
+        obc_status_offset=$size # Sending it again will not help
+    else
+        echo "Server does not respond, or unknown error" # Try again in the next round
+    fi
+}
+
+function obc_status_sender()
+{
+    local obc_status_offset=0
+    while true ; do
+        obc_status_send
+        if [ -e "${OBC_STATUS_SPOOL}.stop" ] || ! kill -0 ${OBC_STATUS_PARENT} 2> /dev/null ; then
+            obc_status_send # Whatever was appended after the last send
+            break
+        fi
+        sleep ${OBC_STATUS_INTERVAL:-2}
+    done
+    rm -f "${OBC_STATUS_SPOOL}" "${OBC_STATUS_SPOOL}.stop"
+}
+
+function update_server_status()
+{
+
+    if [[ $obc_current_token =~ ^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$ ]]; then
+
+        if [ -z "${OBC_STATUS_SPOOL}" ] ; then
+            export OBC_STATUS_SPOOL=$(mktemp)
+            export OBC_STATUS_PARENT=$$
+            obc_status_sender &
+            OBC_STATUS_SENDER_PID=$!
+        fi
+
+        echo "$1" >> "${OBC_STATUS_SPOOL}"
+
+        if [[ $1 == "workflow finished "* ]]; then
+            # Wait until everything has been sent
+            touch "${OBC_STATUS_SPOOL}.stop"
+            wait ${OBC_STATUS_SENDER_PID} 2> /dev/null
+        fi
+    else
+        : 
+    fi
+}
+
 ''',
   'base64_decode': r'''
 function obc_base64_decode() {
@@ -117,10 +293,12 @@ function obc_validate() {
 if [ -n "${OBC_WORK_PATH}" ] ; then
     export OBC_REPORT_PATH=${OBC_WORK_PATH}/${OBC_NICE_ID}.html
     export OBC_REPORT_DIR=${OBC_WORK_PATH}/${OBC_NICE_ID}
+    export OBC_REPORT_LOG=${OBC_WORK_PATH}/${OBC_NICE_ID}.jsonl
+    export OBC_REPORT_TEMPLATE=${OBC_WORK_PATH}/${OBC_NICE_ID}_template.html
     mkdir -p ${OBC_REPORT_DIR}
     echo "OBC: Report filename: ${OBC_REPORT_PATH}"
 
-cat > ${OBC_REPORT_PATH} << OBCENDOFFILE
+cat > ${OBC_REPORT_TEMPLATE} << OBCENDOFFILE
 <!DOCTYPE html>
 <html lang="en">
    <head>
@@ -146,6 +324,8 @@ cat > ${OBC_REPORT_PATH} << OBCENDOFFILE
    </body>
 </html>
 OBCENDOFFILE
+    cp ${OBC_REPORT_TEMPLATE} ${OBC_REPORT_PATH}
+    : > ${OBC_REPORT_LOG}
 fi
 
 ''',
@@ -153,12 +333,29 @@ fi
 
 export OBC_REPORT_PATH=${OBC_WORK_PATH}/${OBC_NICE_ID}.html
 export OBC_REPORT_DIR=${OBC_WORK_PATH}/${OBC_NICE_ID}
+export OBC_REPORT_LOG=${OBC_WORK_PATH}/${OBC_NICE_ID}.jsonl
+export OBC_REPORT_TEMPLATE=${OBC_WORK_PATH}/${OBC_NICE_ID}_template.html
+
+function obc_report_escape() {
+    # HTML escape $1 into OBC_REPORT_ESCAPED. The result is also a valid JSON string (no quotes, backslashes or control characters)
+    local amp='&amp;' lt='&lt;' gt='&gt;' quot='&quot;' apos='&#39;' backslash='&#92;' br='<br>' tab='&#9;'
+    local v=${1//&/"$amp"}
+    v=${v//</"$lt"}
+    v=${v//>/"$gt"}
+    v=${v//\"/"$quot"}
+    v=${v//\'/"$apos"}
+    v=${v//\\/"$backslash"}
+    v=${v//$'\n'/"$br"}
+    v=${v//$'\t'/"$tab"}
+    OBC_REPORT_ESCAPED=${v//[$'\001'-$'\037']/}
+}
 
 function REPORT() {
+    # Appends one line to OBC_REPORT_LOG: {"tag": <TAG>, "variable": <VAR>, "html": <the <li> of the report>}
+    # The report (OBC_REPORT_PATH) is rendered from these lines once, with obc_render_report
     if [ -n "${OBC_WORK_PATH}" ] ; then
-        local VAR=$1
         local TIMENOW=$(date)
-        local WHOCALLEDME=$(caller 0 | awk '{print $2}')
+        local WHOCALLEDME=${FUNCNAME[1]}
 
         if [ -z $3 ] ; then
             local TAG=INTERMEDIATE_VARIABLE
@@ -167,50 +364,114 @@ function REPORT() {
         fi
 
         if [ ${TAG} == "INTERMEDIATE_VARIABLE" ] ; then
-            local EXTRA="${TIMENOW}. Called from: ${WHOCALLEDME}"
+            obc_report_escape "${TIMENOW}. Called from: ${WHOCALLEDME}"
+            local EXTRA=${OBC_REPORT_ESCAPED}
         else
             local EXTRA=""
         fi
 
-        local FILEKIND=$(file "${2}")
-        # echo "OBC: FILE RESULT ${FILEKIND}"
-        if [[ $FILEKIND == *"PNG image data"* ]]; then
-           local NEWFILENAME=${OBC_REPORT_DIR}/$(basename ${2})
-           local LOCALFILENAME=${OBC_NICE_ID}/$(basename ${2})
-           cp ${2} ${NEWFILENAME}
-           local HTML="<li>${EXTRA} ${VAR}: <br><img src=\"${LOCALFILENAME}\"></li>\\\\n      <!-- {{${TAG}}} -->\\\\n"
-        elif [[ $FILEKIND == *"PDF document"* ]]; then
-           local NEWFILENAME=${OBC_REPORT_DIR}/$(basename ${2})
-           local LOCALFILENAME=${OBC_NICE_ID}/$(basename ${2})
-           cp ${2} ${NEWFILENAME}
-           local HTML="<li>${EXTRA} ${VAR}: <br><a href=\"${LOCALFILENAME}\">${LOCALFILENAME}</a></li>\\\\n      <!-- {{${TAG}}} -->\\\\n"
+        obc_report_escape "${1}"
+        local VAR=${OBC_REPORT_ESCAPED}
+
+        # PNG and PDF files are copied in the report. Check the first bytes of the file
+        local SIGNATURE=""
+        if [ -f "${2}" ] ; then
+            read -r -n 4 SIGNATURE < "${2}" || :
+        fi
+
+        if [[ $SIGNATURE == ?PNG ]]; then
+           cp "${2}" "${OBC_REPORT_DIR}/${2##*/}"
+           obc_report_escape "${OBC_NICE_ID}/${2##*/}"
+           local HTML="<li>${EXTRA} ${VAR}: <br><img src='${OBC_REPORT_ESCAPED}'></li>"
+        elif [[ $SIGNATURE == %PDF ]]; then
+           cp "${2}" "${OBC_REPORT_DIR}/${2##*/}"
+           obc_report_escape "${OBC_NICE_ID}/${2##*/}"
+           local HTML="<li>${EXTRA} ${VAR}: <br><a href='${OBC_REPORT_ESCAPED}'>${OBC_REPORT_ESCAPED}</a></li>"
         else
-           local VALUE=$(echo "${2}" | sed 's/&/\\\&amp;/g; s/</\\\&lt;/g; s/>/\\\&gt;/g; s/"/\\\&quot;/g; s/'"'"'/\\\&#39;/g')
-           local HTML="<li>${EXTRA} ${VAR}=${VALUE}</li>\\\\n      <!-- {{${TAG}}} -->\\\\n"
+           obc_report_escape "${2}"
+           local HTML="<li>${EXTRA} ${VAR}=${OBC_REPORT_ESCAPED}</li>"
         fi
 
-        sed -i -e "s|<\!-- {{${TAG}}} -->|${HTML}|" ${OBC_REPORT_PATH}
-        sed 's/\\n/\
-/g' ${OBC_REPORT_PATH} > ${OBC_REPORT_PATH}.tmp
-        mv ${OBC_REPORT_PATH}.tmp ${OBC_REPORT_PATH}
+        obc_report_escape "${TAG}"
+        printf '{"tag": "%s", "variable": "%s", "html": "%s"}\n' "${OBC_REPORT_ESCAPED}" "${VAR}" "${HTML}" >> "${OBC_REPORT_LOG}"
+    fi
+}
+
+function obc_render_report() {
+    # Create the report from the template: The entries of every tag (in OBC_REPORT_LOG) are placed before the <!-- {{TAG}} --> line
+    # Steps that run at the same time may render it at the same time, so every process writes its own .tmp file
+    if [ -n "${OBC_WORK_PATH}" ] ; then
+        local line
+        while IFS= read -r line ; do
+            if [[ $line == *'<!-- {{'*'}} -->'* ]] ; then
+                local TAG=${line#*'{{'}
+                TAG=${TAG%%'}}'*}
+                sed -n 's/^{"tag": "'"${TAG}"'", "variable": "[^"]*", "html": "\(.*\)"}$/      \1/p' "${OBC_REPORT_LOG}"
+            fi
+            printf '%s\n' "${line}"
+        done < "${OBC_REPORT_TEMPLATE}" > "${OBC_REPORT_PATH}.$$.tmp"
+        mv "${OBC_REPORT_PATH}.$$.tmp" "${OBC_REPORT_PATH}"
     fi
 }
 
 ''',
 'final_report': r'''
 
+obc_render_report
+
 OBC_REPORT_TGZ=${OBC_WORK_PATH}/${OBC_NICE_ID}.tgz
 
 #echo "RUNNING: "
 #echo "tar zcf ${OBC_REPORT_TGZ} -C ${OBC_WORK_PATH} ${OBC_NICE_ID}.html ${OBC_NICE_ID}/"
 
-tar zcf ${OBC_REPORT_TGZ} -C ${OBC_WORK_PATH} ${OBC_NICE_ID}.html ${OBC_NICE_ID}/
+tar zcf ${OBC_REPORT_TGZ} -C ${OBC_WORK_PATH} ${OBC_NICE_ID}.html ${OBC_NICE_ID}.jsonl ${OBC_NICE_ID}/
 
 ''',
 'function_PARALLEL': r'''
+# PARALLEL runs at most OBC_MAX_PARALLEL jobs at the same time (not set or 0: no limit).
+# If some jobs fail, OBC_ERROR has their exit codes and PARALLEL returns 1.
+# obc_parallel_start and obc_parallel_reap use the PIDS and failed arrays of PARALLEL.
+
+function obc_parallel_reap() {
+    # Remove the jobs that have finished from PIDS
+    local running=()
+    local pid
+    for pid in "${PIDS[@]}" ; do
+        if kill -0 ${pid} 2> /dev/null ; then
+            running+=(${pid})
+        else
+            wait ${pid}
+            local exit_code=$?
+            if [ ${exit_code} -ne 0 ] ; then
+                failed+=("${pid}:${exit_code}")
+            fi
+        fi
+    done
+    PIDS=("${running[@]}")
+}
+
+function obc_parallel_start() {
+    # Run $1 in the background when there is a free job slot
+    if [[ ${OBC_MAX_PARALLEL} =~ ^[0-9]+$ ]] && [ ${OBC_MAX_PARALLEL} -gt 0 ] ; then
+        obc_parallel_reap
+        while [ ${#PIDS[@]} -ge ${OBC_MAX_PARALLEL} ] ; do
+            if (( BASH_VERSINFO[0] > 4 || (BASH_VERSINFO[0] == 4 && BASH_VERSINFO[1] >= 3) )) ; then
+                wait -n # Until a job finishes
+            else
+                sleep 1
+            fi
+            obc_parallel_reap
+        done
+    fi
+
+    eval ${1} &
+    PIDS+=($!)
+}
+
 function PARALLEL() {
     local line_counter=0
-    local PIDS=() # 
+    local PIDS=() # The jobs that are running
+    local failed=() # pid:exit code of the jobs that failed
 
     if [[ $2 == *$'\n'* ]] ; then 
       while IFS= read -r line; do
@@ -242,21 +503,31 @@ function PARALLEL() {
           done
 
           #echo "Calling step: $1"
-          eval ${1} &
-          P=$!
-          PIDS=("${PIDS[@]}" ${P})
+          obc_parallel_start "${1}"
 
       done <<< "$2"
     else
       for var in "$@" ; do
         #echo ${var}
-        eval ${var} &
-        P=$!
-        IDS=("${PIDS[@]}" ${P})
+        obc_parallel_start "${var}"
       done
     fi
 
-    wait "${PIDS[@]}"
+    # Wait only for these jobs (wait without arguments waits for all background processes)
+    obc_parallel_reap
+    local pid
+    for pid in "${PIDS[@]}" ; do
+        wait ${pid}
+        local exit_code=$?
+        if [ ${exit_code} -ne 0 ] ; then
+            failed+=("${pid}:${exit_code}")
+        fi
+    done
+
+    if [ ${#failed[@]} -gt 0 ] ; then
+        OBC_ERROR="PARALLEL: ${#failed[@]} jobs failed (pid:exit code): ${failed[*]}"
+        return 1
+    fi
 
     OBC_ERROR=""
 }
@@ -304,15 +575,342 @@ def setup_bash_patterns(args):
     '''
     bash_patterns['update_server_status'] = bash_patterns['update_server_status'].replace('{server}', args.server) # .format does not work since it contains "{"
     bash_patterns['update_server_status'] = bash_patterns['update_server_status'].replace('{insecure}', '-k ' if args.insecure else '')
+    bash_patterns['update_server_status_batch'] = bash_patterns['update_server_status_batch'].replace('{server}', args.server)
+    bash_patterns['update_server_status_batch'] = bash_patterns['update_server_status_batch'].replace('{insecure}', '-k ' if args.insecure else '')
 
 
 ## Helper functions
+class ChunkBuffer:
+    '''
+    A write-only file object. It keeps what has been written until pop()
+    Used to stream archives (see BaseExecutor.stream_targz) 
+    '''
+
+    def __init__(self,):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self,):
+        pass
+
+    def pop(self,):
+        ret = b''.join(self.chunks)
+        self.chunks = []
+        return ret
+
+class Emitter:
+    '''
+    Collects the fragments (str) of a script.
+    Fragments are kept in a list and are joined (getvalue) or written (write_to) only once at the end.
+    Growing a string with += in a loop copies it again and again.
+
+    ret = Emitter('first line\n')
+    ret += 'second line\n'
+    ret.emit('third', ' line\n')
+    '''
+
+    def __init__(self, *fragments):
+        self.fragments = []
+        self.emit(*fragments)
+
+    def emit(self, *fragments):
+        '''
+        A fragment can also be an Emitter
+        '''
+        for fragment in fragments:
+            if isinstance(fragment, Emitter):
+                self.fragments.extend(fragment.fragments)
+            else:
+                self.fragments.append(fragment)
+        return self
+
+    def __iadd__(self, fragment):
+        if type(fragment) is str:
+            self.fragments.append(fragment) # The common case
+            return self
+        return self.emit(fragment)
+
+    def getvalue(self,):
+        return ''.join(self.fragments)
+
+    def write_to(self, f):
+        '''
+        f is anything with a write method (file, stream). For sockets use socket.makefile('w')
+        '''
+        for fragment in self.fragments:
+            f.write(fragment)
+
 def base64_encode(s):
     '''
     Takes a string and converts it to a base64 string
     '''
     return base64.b64encode(s.encode()).decode('ascii')
 
+class LRUCache:
+    '''
+    A dictionary with at most maxsize items. When it is full, the least recently used item is removed.
+    It is shared by the threads of the server, so it is locked.
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if not key in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def clear(self,):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self,):
+        return len(self.items)
+
+### Break down of step bash scripts. See Workflow.break_down_step_generator
+
+def get_level(command, steps):
+    '''
+    What is the level with which a script is calling a step?
+    command does not necessarily has to be a bashlex command class node 
+    '''
+
+    def recursive(command, current_level):
+        if hasattr(command, 'word'):
+            if command.word in steps:  
+                return current_level, command.word
+
+        if hasattr(command, 'parts'):
+            for part in command.parts:
+                ret = recursive(part, current_level+1)
+                if ret:
+                    return ret
+
+        if hasattr(command, 'command'):
+            ret = recursive(command.command, current_level+1)
+            if ret:
+                return ret
+
+        if hasattr(command, 'list'):
+            for l in command.list:
+                ret = recursive(l, current_level+1)
+                if ret:
+                    return ret
+
+        return False
+
+    return recursive(command, 1)
+
+def parse_parallel_constant(bash, delimiter=','):
+    '''
+    STEPS=
+    A,B
+    1,2
+    3,4
+    5,6
+    7,8
+    9,10
+
+    returns:
+    {
+        'variable': 'STEPS',
+        'content': [[]]
+    }
+    '''
+
+    m = re.match(r'([\w]+)=[\s]*(.+)', bash, flags=re.DOTALL)
+    if not m:
+        return {}
+
+    ret = {
+        'variable': m.group(1),
+        'content': [],
+    }
+
+    CSV_content = m.group(2)
+    CSV_f = io.StringIO(CSV_content)
+    try:
+        CSV_reader = csv.reader(CSV_f, delimiter=delimiter)
+    except csv.Error as e:
+        return {}
+
+    first = True
+    for line in CSV_reader:
+        if not line:
+            continue
+
+        if first:
+            ret['header'] = line
+            first = False
+            continue
+
+        ret['content'].append(line)
+
+    CSV_f.close() # <-- is there any meaning on this?
+
+    return ret
+
+def parse_parrallel_call_1(bash):
+    '''
+    PARALLEL step__new_step__test5__1 ${STEPS}
+
+    Returns:
+    {
+        'step': step__new_step__test5__1,
+        'variable': STEPS
+    }
+    '''
+    m=re.match(r'PARALLEL[\s]+(?P<step_name>step__[\w]+__[\w]+__[\d]+)[\s]+((\$(?P<var_name1>[\w]+))|(\${(?P<var_name2>[\w]+)}))', bash)
+    if m:
+        calling_step = m.group('step_name')
+        calling_variable = m.group('var_name1') or m.group('var_name2')
+        if calling_variable:
+
+            return {
+                'step': calling_step,
+                'variable': calling_variable
+            }
+
+    return {}
+
+def parse_parallel_call_2(bash):
+    '''
+    PARALLEL step_1 step_2 , ....
+    '''
+
+    m = re.match(r'PARALLEL(?P<steps>([\s]+[\w]+)+)', bash)
+    if m:
+        return m.group('steps').strip().split()
+    return []
+
+# bash, calling steps --> what parse_step_bash returns
+bash_parse_cache = LRUCache(maxsize=1024)
+
+def parse_step_bash(bash, calling_steps):
+    '''
+    Parse the bash of a step with bashlex and extract, for every main command (the children of the root node):
+    level: The level in which it calls a step (see get_level) or False
+    command: Is this a command with parts? Only these can be calls and assignments
+    assignment: The parse_parallel_constant of a single assignment or word. None if it is not
+    parallel_call_1, parallel_call_1_pos: A PARALLEL step ${VARIABLE} call (see parse_parrallel_call_1) of a calling step
+    parallel_call_2, parallel_call_2_pos: A PARALLEL step_1 step_2 ... call (see parse_parallel_call_2) of calling steps
+    call_pos: A single word that is a calling step
+    The positions are in: '{\\n:\\n' + bash + '\\n}' 
+
+    bashlex is slow, so this is done once for every bash and calling steps, for all executors and all requests (see bash_parse_cache).
+    The returned list is shared. Do not change it.
+    '''
+
+    key = (bash, tuple(calling_steps))
+    ret = bash_parse_cache.get(key)
+    if not ret is None:
+        return ret
+
+    # https://stackoverflow.com/questions/12404661/what-is-the-use-case-of-noop-in-bash
+    # bashlex Cannot parse empty strings!
+    bash_to_parse = '{\n:\n' + bash + '\n}'  
+
+    try:
+        p = bashlex.parse(bash_to_parse)
+    except bashlex.errors.ParsingError as e:
+        message = 'Could not parse bash script (error 2320):\n'
+        message += bash_to_parse + '\n'
+        message += 'Error: {}'.format(str(e))
+        raise OBC_Executor_Exception(message)
+
+    if not type(p) is list:
+        raise OBC_Executor_Exception('Could not parse bash script. Error 2301')
+
+    if not len(p):
+        raise OBC_Executor_Exception('Could not parse bash script. Is it empty? Error 2302')
+
+    if not type(p[0]) is bashlex.ast.node:
+        raise OBC_Executor_Exception('Could not parse bash script. Error 2303')
+
+    if not hasattr(p[0], 'list'):
+        raise OBC_Executor_Exception('Could not parse bash script. Error 2304')
+
+    if not type(p[0].list[0]) is bashlex.ast.node:
+        raise OBC_Executor_Exception('Could not parse bash script. Error 2305')
+
+    if not type(p[0].list[1]) is bashlex.ast.node:
+        raise OBC_Executor_Exception('Could not parse bash script. Error 2306')
+
+    if not hasattr(p[0].list[1], 'parts'):
+        raise OBC_Executor_Exception('Could not parse bash script. Error 2307')
+
+    if not len(p[0].list[1].parts):
+        raise OBC_Executor_Exception('Could not parse bash script. Error 2308')
+
+    # Main commands are the children of the root node. The first is the ':' that we added
+    ret = []
+    for main_command in p[0].list[1].parts[1:]:
+        command = {
+            'level': get_level(main_command, calling_steps),
+            'command': main_command.kind == 'command' and hasattr(main_command, 'parts'),
+            'assignment': None,
+            'parallel_call_1': None,
+            'parallel_call_1_pos': None,
+            'parallel_call_2': None,
+            'parallel_call_2_pos': None,
+            'call_pos': None,
+        }
+
+        if not command['command']:
+            if command['level']:
+                ret.append(command)
+            continue
+
+        # Check if this is a CommandNode(parts=[AssignmentNode(parts=[] pos=(118, 152) word='STEPS=\nA,B\n1,2\n3,4\n5,6\n7,8\n9,10\n')] pos=(118, 152))
+        # OR 
+        # Check if this is a CommandNode(pos=(0, 20), parts=[WordNode(pos=(0, 20), word='VAR1=\nA,B\n1,2\n3,4\n'),])
+        # word='VAR1=\nA,B\n1,2\n3,4\n' --> THIS IS A WordNode !
+        # word='VAR=\nA,B\n1,2\n3,4\n' --> THIS IS A AssignmentNode 
+        if len(main_command.parts) == 1:
+            if main_command.parts[0].kind in ['assignment', 'word']:
+                # This is an assignment
+                command['assignment'] = parse_parallel_constant(main_command.parts[0].word)
+
+        # This is a command
+        # check for PARALLEL step__new_step__test5__1 ${STEPS}
+        if len(main_command.parts) == 3 and all(hasattr(x,'word') for x in main_command.parts): # Make sure that it contains only word nodes #186 
+            line_to_match = ' '.join(x.word for x in main_command.parts)
+            parallel_call = parse_parrallel_call_1(line_to_match)
+            if parallel_call and parallel_call['step'] in calling_steps:
+                command['parallel_call_1'] = parallel_call
+                command['parallel_call_1_pos'] = (main_command.parts[0].pos[0], main_command.parts[2].pos[1])
+
+        # check for PARALLEL step_step_1, step_step_2, ....
+        if len(main_command.parts) > 1 and all(hasattr(x,'word') for x in main_command.parts): # Make sure that it contains only word nodes #186
+            line_to_match = ' '.join(x.word for x in main_command.parts)
+            parallel_call_2 = parse_parallel_call_2(line_to_match)
+            if parallel_call_2 and all(x in calling_steps for x in parallel_call_2):
+                command['parallel_call_2'] = parallel_call_2
+                command['parallel_call_2_pos'] = (main_command.parts[0].pos[0], main_command.parts[-1].pos[1])
+
+        # We are looking for a command with a single part (function call). It should be a single word that is a calling step
+        if len(main_command.parts) == 1 and main_command.parts[0].kind == 'word' and main_command.parts[0].word in calling_steps:
+            command['call_pos'] = main_command.parts[0].pos
+
+        ret.append(command)
+
+    bash_parse_cache.set(key, ret)
+    return ret
+
 class Workflow:
     '''
     '''
@@ -356,6 +954,7 @@ class Workflow:
         self.askinput = askinput
         self.obc_server = obc_server
         self.workflow_id = workflow_id
+        self.compiled = None # See BaseExecutor.compile
         self.parse_workflow_filename()
 
     def __str__(self,):
@@ -378,26 +977,30 @@ class Workflow:
         for tool in tool_installation_order:
             yield tool
 
-    def get_tool_dependent_variables(self, tool, include_this_tool=False):
+    def get_tool_dependent_variables(self,):
         '''
-        Get the variables for which this tool is dependent
-        include_this_tool: If True, include also the variables of this tool
+        Get the variables for which every tool is dependent (from all its direct and indirect dependencies)
+        Returns a dictionary. Keys are tool slash ids. Values are lists of (variable, dependent tool) without duplicates.
+        The order is: for each dependency, its variables and then the variables for which it is dependent.
+        The tools are visited in installation order, so the list of a dependency is always computed before the tools that depend on it.
         '''
 
-        def recursion(tool, the_list):
+        ret = {}
+        for tool in self.get_tool_installation_order():
+            the_list = []
+            seen = set() # (tool slash id, variable name)
             for tool_slash_id in tool['dependencies']:
                 tool_d = self.tool_slash_id_d[tool_slash_id]
-                for variable in tool_d['variables']:
-                    the_list.append((variable, tool_d))
-                recursion(tool_d, the_list)
+                for variable, dependent_tool in [(variable, tool_d) for variable in tool_d['variables']] + ret[tool_slash_id]:
+                    key = (self.get_tool_slash_id(dependent_tool), variable['name'])
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    the_list.append((variable, dependent_tool))
 
-        the_list = []
-        recursion(tool, the_list)
-        if include_this_tool:
-            for variable in tool['variables']:
-                the_list.append((variable, tool))
+            ret[self.get_tool_slash_id(tool)] = the_list
 
-        return the_list
+        return ret
 
     def parse_workflow_filename(self, ):
         '''
@@ -412,6 +1015,8 @@ class Workflow:
         else:
             raise OBC_Executor_Exception('Both workflow_filename and workflow_string are empty')
 
+        self.build_indexes()
+
         self.input_parameters = self.get_input_parameters()
         self.root_workflow = self.get_root_workflow()
         self.root_workflow_id = self.root_workflow['id']
@@ -483,22 +1088,23 @@ class Workflow:
                     self.input_parameter_values[root_input_node['id']] = {'value': None, 'description': root_input_node['description']}
 
         # Check that all outpus will be eventually set
+        output_setters = defaultdict(list) # output id --> the steps that set it
+        for step_node in self.step_iterator():
+            for output_id in step_node['outputs']:
+                output_setters[output_id].append(step_node)
+
         self.output_parameter_step_setters = {}
         for root_output_node in self.root_inputs_outputs['outputs']:
             found_output_filling_step = False
-            for step_node in self.node_iterator():
-                if not self.is_step(step_node):
-                    continue
-
-                if root_output_node['id'] in step_node['outputs']:
-                    if not self.output_parameter_step_setters.get(root_output_node['id']) in [None, step_node]:
-                        message = 'OBC: Output variable: {} is set by more than one steps:\n'.format(root_output_node['id'])
-                        message += '   {}\n'.format(self.output_parameter_step_setters[root_output_node['id']]['id'])
-                        message += '   {}\n'.format(step_node['id'])
-                        raise OBC_Executor_Exception(message)
+            for step_node in output_setters[root_output_node['id']]:
+                if not self.output_parameter_step_setters.get(root_output_node['id']) in [None, step_node]:
+                    message = 'OBC: Output variable: {} is set by more than one steps:\n'.format(root_output_node['id'])
+                    message += '   {}\n'.format(self.output_parameter_step_setters[root_output_node['id']]['id'])
+                    message += '   {}\n'.format(step_node['id'])
+                    raise OBC_Executor_Exception(message)
 
-                    self.output_parameter_step_setters[root_output_node['id']] = step_node
-                    found_output_filling_step = True
+                self.output_parameter_step_setters[root_output_node['id']] = step_node
+                found_output_filling_step = True
 
             if not found_output_filling_step and (not self.askinput in ['BASH']):
                 # If askinput = BASH don't raise exception 
@@ -526,13 +1132,16 @@ class Workflow:
         # Create a dictionary. Keys are tool slash id. values are tools
         self.tool_slash_id_d = {self.get_tool_slash_id(tool):tool for tool in self.tool_iterator()}
 
+        # The variables for which every tool is dependent. Computed once for all tools
+        tool_dependent_variables = self.get_tool_dependent_variables()
+
         # Create a dictionary. Keys are tool ids. Values are tuples: (variables from which they depend from, dependent tool)
         # This does not contain the variables of the tool that is the key
-        self.tool_dependent_variables = {self.get_tool_dash_id(tool, no_dots=True):self.get_tool_dependent_variables(tool) for tool in self.tool_iterator()} 
+        self.tool_dependent_variables = {self.get_tool_dash_id(tool, no_dots=True):tool_dependent_variables[self.get_tool_slash_id(tool)] for tool in self.tool_iterator()} 
 
         # Create a dictionary. Keys are tool ids. Values are tuples: (variables from which they depend from, dependent tool)
         # It also contains the variables of the tool that is the key
-        self.tool_variables = {self.get_tool_dash_id(tool, no_dots=True):self.get_tool_dependent_variables(tool, include_this_tool=True) for tool in self.tool_iterator()} 
+        self.tool_variables = {self.get_tool_dash_id(tool, no_dots=True):tool_dependent_variables[self.get_tool_slash_id(tool)] + [(variable, tool) for variable in tool['variables']] for tool in self.tool_iterator()} 
 
         # Create a dictionary. Keys are step ids. Values are tool objects
         self.step_ids = {step['id']:step for step in self.step_iterator()}
@@ -594,21 +1203,16 @@ class Workflow:
         '''
 
         # Get all tools
-        all_tools = [node for node in self.node_iterator() if self.is_tool(node)]
+        all_tools = list(self.tool_iterator())
 
         # Contruct the tool graph
         graph = {self.get_tool_slash_id(tool): tool['dependencies'] for tool in all_tools}
 
-        for tool_id in graph.keys():
-            circles = detect_circles(graph, tool_id, tool_id)
-            try:
-                circle = next(circles)
-            except StopIteration as e:
-                pass # This is supposed to happen
-            else:
-                message = 'Found circular tool dependency!'
-                message += '\n' + ' --> '.join(circle)
-                raise OBC_Executor_Exception(message)
+        circle = find_circle(graph)
+        if circle:
+            message = 'Found circular tool dependency!'
+            message += '\n' + ' --> '.join(circle)
+            raise OBC_Executor_Exception(message)
 
     def check_step_calls_for_circles(self,):
         '''
@@ -617,15 +1221,9 @@ class Workflow:
         #Construct the step graph
         graph = {step['id']: step['steps'] for step in self.step_iterator()}
 
-        for step_id in graph.keys():
-            circles = detect_circles(graph, step_id, step_id)
-            try:
-                circle = next(circles)
-            except StopIteration as e:
-                pass
-            else:
-                circle_str = ' --> '.join(circle)
-                return circle_str
+        circle = find_circle(graph)
+        if circle:
+            return ' --> '.join(circle)
 
         return ''
 
@@ -645,6 +1243,9 @@ class Workflow:
         ret += 'OBC_WORKFLOW_EDIT={}\n'.format(self.root_workflow['edit'])
         ret += 'OBC_NICE_ID="{}"\n'.format(self.nice_id_global)
         ret += 'OBC_SERVER="{}"\n'.format(self.obc_server)
+        max_parallel = self.get_max_parallel()
+        if max_parallel:
+            ret += 'OBC_MAX_PARALLEL=${{OBC_MAX_PARALLEL:-{}}} # The environment variable overrides the workflow option\n'.format(max_parallel)
         ret += 'echo "OBC: Workflow name: ${OBC_WORKFLOW_NAME}"\n'
         ret += 'echo "OBC: Workflow edit: ${OBC_WORKFLOW_EDIT}"\n'
         ret += f'echo "OBC: Workflow report: {self.nice_id}"\n'
@@ -657,7 +1258,7 @@ class Workflow:
         Bash commands for reading input/output
         '''
 
-        ret = '\n'
+        ret = Emitter('\n')
         if self.input_unset_variables:
 
             # Read unset variables from the command line
@@ -671,7 +1272,7 @@ class Workflow:
                 ret += '   read -p "{}=" {}\n'.format(unset_variable['id'], unset_variable['id'])
                 ret += 'fi\n'
 
-        return ret
+        return ret.getvalue()
 
     @staticmethod
     def create_input_parameter_message(variable_id, variable_description):
@@ -686,7 +1287,7 @@ class Workflow:
         Help from: https://stackoverflow.com/questions/192249/how-do-i-parse-command-line-arguments-in-bash 
         '''
 
-        ret = ''
+        ret = Emitter()
         ret += 'for i in "$@"\n'
         ret += 'do\n'
         ret += 'case $i in\n'
@@ -700,7 +1301,7 @@ class Workflow:
         ret += 'esac\n'
         ret += 'done\n\n'
 
-        return ret
+        return ret.getvalue()
 
 
     def get_tool_bash_commands(self, tool, 
@@ -724,7 +1325,7 @@ class Workflow:
         tool_id = Workflow.get_tool_dash_id(tool, no_dots=True)
 
         # Add Bash commands
-        ret =  '### BASH INSTALLATION COMMANDS FOR TOOL: {}\n'.format(tool['label'])
+        ret = Emitter('### BASH INSTALLATION COMMANDS FOR TOOL: {}\n'.format(tool['label']))
         ret += 'echo "OBC: INSTALLING TOOL: {}"\n'.format(tool['label'])
         if update_server_status:
             ret += Workflow.bash_tool_installation_started(tool) + '\n'
@@ -786,45 +1387,45 @@ class Workflow:
             ret += 'ENDOFFILE\n'
 
 
-        return ret
+        return ret.getvalue()
 
 
     def get_input_bash_commands(self,):
         '''
         '''
-        ret = '### SET ROOT WORKFLOW INPUT PARAMETERS\n'
+        ret = Emitter('### SET ROOT WORKFLOW INPUT PARAMETERS\n')
         for variable, data in self.input_parameter_values.items():
             ret += '{}="{}" #  {}\n'.format(variable, data['value'], data['description'])
         ret += '### END OF SET ROOT WORKFLOW INPUT PARAMETERS'
 
-        return ret
+        return ret.getvalue()
 
     def get_output_bash_commands(self,):
-        ret = '### PRINT OUTPUT PARAMETERS\n'
+        ret = Emitter('### PRINT OUTPUT PARAMETERS\n')
         ret += 'echo "OBC: Output Variables:"\n'
         for output_parameter in self.output_parameters:
             ret += 'echo "OBC: {} = ${{{}}}"\n'.format(output_parameter['id'], output_parameter['id'])
             ret += 'REPORT {} ${{{}}} OUTPUT_VARIABLE \n'.format(output_parameter['id'], output_parameter['id'])
         ret += '### END OF PRINTING OUTPUT PARAMETERS\n'
 
-        return ret
+        return ret.getvalue()
 
     def get_step_bash_commands(self, ):
         '''
         TODO: CREATE AN ORDERING ACCORDING TO WORKFLOWS!
         '''
-        ret = '### SETTING BASH FUNCTIONS FOR STEPS\n\n'
-        for a_node in self.node_iterator():
-            if not self.is_step(a_node):
-                continue
-
+        ret = Emitter('### SETTING BASH FUNCTIONS FOR STEPS\n\n')
+        for a_node in self.step_iterator():
             ret += '# STEP: {}\n'.format(a_node['id'])
             ret += '{} () {{\n'.format(a_node['id'])
             #ret += ':\n' # No op in case a_node['bash'] is empty 
+            # Steps that PARALLEL runs are called from obc_parallel_start. The caller is the step that called PARALLEL
+            ret += "OBC_CALLER_FRAME=0\n"
             ret += "OBC_WHOCALLEDME=$(caller 0 | awk '{print $2}') \n"
-            ret += 'if [ ${OBC_WHOCALLEDME} == "PARALLEL" ] ; then \n '
-            ret += "   OBC_WHOCALLEDME=$(caller 1 | awk '{print $2}') \n"
-            ret += "fi\n"
+            ret += 'while [ "${OBC_WHOCALLEDME}" == "PARALLEL" ] || [ "${OBC_WHOCALLEDME}" == "obc_parallel_start" ] ; do \n'
+            ret += '   let "OBC_CALLER_FRAME=OBC_CALLER_FRAME+1"\n'
+            ret += "   OBC_WHOCALLEDME=$(caller ${OBC_CALLER_FRAME} | awk '{print $2}') \n"
+            ret += "done\n"
 #            ret += "if [ ${OBC_WHOCALLEDME} != \"main\" ] ; then \n"
 #            ret += "   OBC_WHOCALLEDME=${OBC_WHOCALLEDME:6}\n" # :6 =  step__step1__callme__1 --> step1__callme__1
 #            ret += "fi\n"
@@ -836,7 +1437,7 @@ class Workflow:
 
         ret += '### END OF SETTING BASH FUNCTIONS FOR STEPS\n'
 
-        return ret
+        return ret.getvalue()
 
     def get_main_step_bash_commands(self,):
         '''
@@ -922,139 +1523,124 @@ class Workflow:
         node_iterator: iterator through all nodes of a given type
         id_getter: Function. Takes a node. Returns an id of the node
         dependency_getter: Functions. Takes a node. Returns a list of dependencies
-        '''
-
-        def has_dependency(node, list_of_nodes):
-            '''
-            '''
-
-            all_dependencies = [id_getter(n) for n in list_of_nodes]
-            return all(n in all_dependencies for n in dependency_getter(node))
 
-        ret = []
+        Kahn's algorithm. O(nodes + dependencies)
+        The order is: first the nodes without dependencies, then the nodes that depend only on them, and so on.
+        Nodes of the same round keep the order of node_iterator.
+        '''
 
-        # Get all nodes that have dependencies 
-        dependencies_notok = []
+        nodes = list(node_iterator())
+        ids = [id_getter(node) for node in nodes]
+        all_ids = set(ids)
 
+        dependants = defaultdict(list) # id --> indexes of the nodes that depend on it
+        remaining = [] # index --> number of dependencies that have not been resolved
+        for index, node in enumerate(nodes):
+            dependencies = set(dependency_getter(node))
+            missing = dependencies - all_ids
+            if missing:
+                raise OBC_Executor_Exception('{} depends on {} which does not exist in this workflow'.format(ids[index], ', '.join(sorted(missing))))
 
-        for node in node_iterator():
-            if dependency_getter(node):
-                dependencies_notok.append(node)
-            else:
-                ret.append(node)
+            remaining.append(len(dependencies))
+            for dependency in dependencies:
+                dependants[dependency].append(index)
 
-        steps = 0
-        while True:
-            # If all dependencies have been resolved, break
-            if not dependencies_notok:
-                break
+        ret = []
+        resolved = set()
+        current = [index for index in range(len(nodes)) if not remaining[index]]
+        while current:
+            ret.extend(nodes[index] for index in current)
 
-            steps += 1
-            current_notok = []
             found_on_this_round = []
+            for index in current:
+                if ids[index] in resolved:
+                    continue
+                resolved.add(ids[index])
+                for dependant in dependants[ids[index]]:
+                    remaining[dependant] -= 1
+                    if not remaining[dependant]:
+                        found_on_this_round.append(dependant)
 
-            for node in dependencies_notok:
-                if has_dependency(node, ret):
-                    found_on_this_round.append(node)
-                else:
-                    current_notok.append(node)
+            current = sorted(found_on_this_round)
 
-            ret.extend(found_on_this_round)
-            dependencies_notok = current_notok
+        if len(ret) < len(nodes):
+            unresolved = sorted({ids[index] for index in range(len(nodes)) if remaining[index]})
+            raise OBC_Executor_Exception('Could not resolve the dependencies of: {} (circular dependency?)'.format(', '.join(unresolved)))
 
         return ret
 
 
-    def get_tool_installation_order_DEPERECATED(self, ):
+    def get_input_parameters(self, ):
         '''
-        Get a list of tools in dependency order.
         '''
 
-        def has_dependency(tool, list_of_tools):
-            '''
-            Checks if the tool has all its dependencies on the list of tools
-            '''
-
-            all_dependencies = [self.get_tool_slash_id(t) for t in list_of_tools]
-            return all(t in all_dependencies for t in tool['dependencies'])
-
-
-        ret = []
-
-        # Get all tools
-        all_tools = [a_node for a_node in self.node_iterator() if self.is_tool(a_node)]
-
-        # Get all tools that have dependencies 
-        dependencies_notok = []
-
-        for tool in all_tools:
-            if tool['dependencies']:
-                dependencies_notok.append(tool)
-            else:
-                ret.append(tool)
-
-        steps = 0
-        while True:
-
-            # If all dependencies have been resolved, break
-            if not dependencies_notok:
-                break
+        return self.workflow.get('arguments', [])
 
-            steps += 1
+    def get_max_parallel(self,):
+        '''
+        The OBC_MAX_PARALLEL workflow option (in the arguments, next to the input parameters): 
+        How many jobs PARALLEL runs at the same time (see bash_patterns['function_PARALLEL']). None: No limit
+        '''
 
-            current_notok = []
-            found_on_this_round = []
-            for tool in dependencies_notok:
-                if has_dependency(tool, ret):
-                    found_on_this_round.append(tool)
-                else:
-                    current_notok.append(tool)
+        value = self.input_parameters.get('OBC_MAX_PARALLEL') if isinstance(self.input_parameters, dict) else None
+        if value is None or value == '':
+            return None
 
-            ret.extend(found_on_this_round)
-            dependencies_notok = current_notok
-	
-        return ret	
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            value = 0
+        if value < 1:
+            raise OBC_Executor_Exception('Error: 6914: OBC_MAX_PARALLEL should be a positive integer. Found: {}'.format(self.input_parameters['OBC_MAX_PARALLEL']))
 
+        return value
 
-    def get_input_parameters(self, ):
+    def build_indexes(self,):
         '''
+        Index all nodes in one pass. All lookups use these:
+        self.nodes: all nodes
+        self.nodes_by_type: type --> list of nodes
+        self.nodes_by_belongto: belongto id (see self.belongto) --> type --> list of nodes
+        self.nodes_by_id: id --> node
+        The lists keep the order of the nodes in the workflow.
+        The integrity of the nodes is checked later (parse_workflow_filename), so missing keys are tolerated here.
         '''
 
-        return self.workflow.get('arguments', [])
+        self.nodes = [node['data'] for node in self.workflow['workflow']['elements']['nodes']]
+        self.nodes_by_type = defaultdict(list)
+        self.nodes_by_belongto = defaultdict(lambda: defaultdict(list))
+        self.nodes_by_id = {}
+
+        for node in self.nodes:
+            node_type = node.get('type')
+            self.nodes_by_type[node_type].append(node)
+            self.nodes_by_belongto[self.belongto(node) if node.get('belongto') else None][node_type].append(node)
+            self.nodes_by_id[node.get('id')] = node
 
     def node_iterator(self,):
         '''
         '''
-        for node in self.workflow['workflow']['elements']['nodes']:
-            yield node['data']
+        return iter(self.nodes)
 
     def tool_iterator(self,):
         '''
         '''
-        for node in self.node_iterator():
-            if self.is_tool(node):
-                yield node
+        return iter(self.nodes_by_type[self.TOOL_TYPE])
 
     def step_iterator(self,):
         '''
         '''
-        for node in self.node_iterator():
-            if self.is_step(node):
-                yield node
+        return iter(self.nodes_by_type[self.STEP_TYPE])
 
     def inputs_iterator(self,):
         '''
         '''
-        for node in self.node_iterator():
-            if self.is_input(node):
-                yield node
+        return iter(self.nodes_by_type[self.INPUT_TYPE])
 
     def outputs_iterator(self,):
         '''
         '''
-        for node in self.node_iterator():
-            if self.is_output(node):
-                yield node
+        return iter(self.nodes_by_type[self.OUTPUT_TYPE])
 
     def is_root_workflow(self, workflow):
         '''
@@ -1067,7 +1653,8 @@ class Workflow:
 
         ret = None
 
-        for node in self.node_iterator():
+        # The nodes that do not belong to a workflow
+        for node in (node for nodes in self.nodes_by_belongto[None].values() for node in nodes):
             if self.is_root_workflow(node):
                 if not ret is None:
                     raise OBC_Executor_Exception('Integrity Error: Found more than one root workflow')
@@ -1082,7 +1669,7 @@ class Workflow:
     def get_all_workflows(self,):
         '''
         '''
-        return [node for node in self.node_iterator() if self.is_workflow(node)]
+        return list(self.nodes_by_type[self.WORKFLOW_TYPE])
 
     def node_2_str(self, node):
         '''
@@ -1137,11 +1724,8 @@ class Workflow:
             message = f'Cannot get input/ouputs from a no-network node \nNode: \n{self.node_2_str(node)}'
             raise OBC_Executor_Exception(message)
 
-        ret = {'inputs': [], 'outputs': []}
-
-        for a_node in self.node_iterator(): 
-            if self.is_input_output(a_node) and self.belongto(a_node) == node['id']:
-                ret[a_node['type'] + 's'].append(a_node)
+        belongto = self.nodes_by_belongto[node['id']]
+        ret = {'inputs': list(belongto[self.INPUT_TYPE]), 'outputs': list(belongto[self.OUTPUT_TYPE])}
 
         return ret
 
@@ -1152,12 +1736,7 @@ class Workflow:
             message = f'Cannot get steps from a no-network node \nNode: \n{self.node_2_str(node)}'
             raise OBC_Executor_Exception(message)
 
-        ret = []
-        for a_node in self.node_iterator():
-            if self.is_step(a_node) and self.belongto(a_node) == node['id']:
-                ret.append(a_node)
-
-        return ret
+        return list(self.nodes_by_belongto[node['id']][self.STEP_TYPE])
 
     def get_root_step(self,):
         '''
@@ -1208,13 +1787,13 @@ class Workflow:
         '''
         '''
 
-        ret = ''
+        ret = Emitter()
         ret += 'OBC_START=$(eval "declare")\n'
         ret += bash + '\n'
         ret += 'OBC_CURRENT=$(eval "declare")\n'
         ret += 'comm -3 <(echo "$OBC_START" | grep -v "_=" | sort) <(echo "$OBC_CURRENT" | grep -v OBC_START | grep -v PIPESTATUS | grep -v "_=" | sort) > {}\n'.format(save_to)
 
-        return ret
+        return ret.getvalue()
 
 
     def step_tool_variables(self, step):
@@ -1262,38 +1841,6 @@ class Workflow:
         if c:
             raise OBC_Executor_Exception('Found circle in step calls:\n{}\n. Cannot break down workflow.'.format(c))
 
-        def get_level(command, steps):
-            '''
-            What is the level with which a script is calling a step?
-            command does not necessarily has to be a bashlex command class node 
-            '''
-
-            def recursive(command, current_level):
-                if hasattr(command, 'word'):
-                    if command.word in steps:  
-                        return current_level, command.word
-
-                if hasattr(command, 'parts'):
-                    for part in command.parts:
-                        ret = recursive(part, current_level+1)
-                        if ret:
-                            return ret
-
-                if hasattr(command, 'command'):
-                    ret = recursive(command.command, current_level+1)
-                    if ret:
-                        return ret
-
-                if hasattr(command, 'list'):
-                    for l in command.list:
-                        ret = recursive(l, current_level+1)
-                        if ret:
-                            return ret
-
-                return False
-
-            return recursive(command, 1)
-
         def save_variables(bash, read_from, save_to, input_tool_variables, input_workflow_variables):
             '''
             read_from is either None or __VARS_sh (no dot)
@@ -1312,89 +1859,6 @@ class Workflow:
 
             return ret
 
-        def parse_parallel_constant(bash, delimiter=','):
-            '''
-            STEPS=
-            A,B
-            1,2
-            3,4
-            5,6
-            7,8
-            9,10
-
-            returns:
-            {
-                'variable': 'STEPS',
-                'content': [[]]
-            }
-            '''
-
-            m = re.match(r'([\w]+)=[\s]*(.+)', bash, flags=re.DOTALL)
-            if not m:
-                return {}
-
-            ret = {
-                'variable': m.group(1),
-                'content': [],
-            }
-
-            CSV_content = m.group(2)
-            CSV_f = io.StringIO(CSV_content)
-            try:
-                CSV_reader = csv.reader(CSV_f, delimiter=delimiter)
-            except csv.Error as e:
-                return {}
-
-            first = True
-            for line in CSV_reader:
-                if not line:
-                    continue
-
-                if first:
-                    ret['header'] = line
-                    first = False
-                    continue
-
-                ret['content'].append(line)
-
-            CSV_f.close() # <-- is there any meaning on this?
-
-            return ret
-
-        def parse_parrallel_call_1(bash):
-            '''
-            PARALLEL step__new_step__test5__1 ${STEPS}
-
-            Returns:
-            {
-                'step': step__new_step__test5__1,
-                'variable': STEPS
-            }
-            '''
-            m=re.match(r'PARALLEL[\s]+(?P<step_name>step__[\w]+__[\w]+__[\d]+)[\s]+((\$(?P<var_name1>[\w]+))|(\${(?P<var_name2>[\w]+)}))', bash)
-            if m:
-                calling_step = m.group('step_name')
-                calling_variable = m.group('var_name1') or m.group('var_name2')
-                if calling_variable:
-
-                    return {
-                        'step': calling_step,
-                        'variable': calling_variable
-                    }
-
-            return {}
-
-        def parse_parallel_call_2(bash):
-            '''
-            PARALLEL step_1 step_2 , ....
-            '''
-
-            m = re.match(r'PARALLEL(?P<steps>([\s]+[\w]+)+)', bash)
-            if m:
-                return m.group('steps').strip().split()
-            return []
-
-
         def create_json(bash, step, step_breaked_id, is_last, output_variables):
             '''
             Create a json file with the output variables
@@ -1447,58 +1911,28 @@ ENDOFFILE
                 return
 
             # Add variables from parallel
+            prefix = ''
+            last_assignment = None # Used for PARALLEL 
             if parallel_variables:
                 to_add= '\n'.join([r'{}="{}"'.format(k,v) for k,v in parallel_variables.items()])
-                bash = '\n' + to_add + '\n' + bash
+                prefix = '\n' + to_add + '\n'
+                # This is what the last of these assignments would set (bashlex removes the quotes)
+                last_assignment = parse_parallel_constant('{}={}'.format(*list(parallel_variables.items())[-1]))
 
             # https://stackoverflow.com/questions/12404661/what-is-the-use-case-of-noop-in-bash
             # bashlex Cannot parse empty strings!
-            bash_to_parse = '{\n:\n' + bash + '\n}'  
+            bash_to_parse = '{\n:\n' + prefix + bash + '\n}'  
             calling_steps = step['steps']
 
             # Get the input variables of this step.
             # We need to add them in every breaked step in order to read from the command line 
             input_tool_variables = [variable['input_name'] for variable in self.step_tool_variables(step)]
-            
-
-            try:
-                p = bashlex.parse(bash_to_parse)
-            except bashlex.errors.ParsingError as e:
-                message = 'Could not parse bash script (error 2320):\n'
-                message += bash_to_parse + '\n'
-                message += 'Error: {}'.format(str(e))
-                raise OBC_Executor_Exception(message)
 
-            if not type(p) is list:
-                raise OBC_Executor_Exception('Could not parse bash script. Error 2301')
-
-            if not len(p):
-                raise OBC_Executor_Exception('Could not parse bash script. Is it empty? Error 2302')
-
-            if not type(p[0]) is bashlex.ast.node:
-                raise OBC_Executor_Exception('Could not parse bash script. Error 2303')
-
-            if not hasattr(p[0], 'list'):
-                raise OBC_Executor_Exception('Could not parse bash script. Error 2304')
-
-            if not type(p[0].list[0]) is bashlex.ast.node:
-                raise OBC_Executor_Exception('Could not parse bash script. Error 2305')
-
-            if not type(p[0].list[1]) is bashlex.ast.node:
-                raise OBC_Executor_Exception('Could not parse bash script. Error 2306')
-
-            if not hasattr(p[0].list[1], 'parts'):
-                raise OBC_Executor_Exception('Could not parse bash script. Error 2307')
-
-            if not len(p[0].list[1].parts):
-                raise OBC_Executor_Exception('Could not parse bash script. Error 2308')
-
-            # Main commands are the children of the root node
-            main_commands = p[0].list[1].parts
-            found_call = False
-            start = 2 # Remove '{\n'
-            read_from = None
-            last_assignment = None # Used for PARALLEL 
+            # The bash of the step is parsed once (see parse_step_bash). The positions do not include the prefix
+            main_commands = parse_step_bash(bash, calling_steps)
+            found_call = False
+            start = 2 # Remove '{\n'
+            read_from = None
 
             run_afters = [] # List of all the steps that are run in this break down
             if run_after is None:
@@ -1509,69 +1943,43 @@ ENDOFFILE
                 this_is_a_parallel_call_1 = False
                 this_is_a_parallel_call_2 = False
 
-                level_tuple = get_level(main_command, calling_steps)
+                level_tuple = main_command['level']
                 if level_tuple:
                     level, called_step = level_tuple
                     if level>2:
                         raise OBC_Executor_Exception('Step: {} calls step: {} in a secondary scope (if,while,for,function..). This is not supported.'.format(
                             step['id'], called_step))
 
-                if not main_command.kind == 'command':
+                if not main_command['command']:
                     continue
 
-                if not hasattr(main_command, 'parts'):
-                    continue
+                if not main_command['assignment'] is None:
+                    last_assignment = main_command['assignment']
 
-                # Check if this is a CommandNode(parts=[AssignmentNode(parts=[] pos=(118, 152) word='STEPS=\nA,B\n1,2\n3,4\n5,6\n7,8\n9,10\n')] pos=(118, 152))
-                # OR 
-                # Check if this is a CommandNode(pos=(0, 20), parts=[WordNode(pos=(0, 20), word='VAR1=\nA,B\n1,2\n3,4\n'),])
-                # word='VAR1=\nA,B\n1,2\n3,4\n' --> THIS IS A WordNode !
-                # word='VAR=\nA,B\n1,2\n3,4\n' --> THIS IS A AssignmentNode 
-                if len(main_command.parts) == 1:
-                    if main_command.parts[0].kind in ['assignment', 'word']:
-                        # This is an assignment
-                        assignment_word = main_command.parts[0].word
-                        #print ('BEFORE parse_parallel_constant')
-                        last_assignment = parse_parallel_constant(assignment_word)
-
-                # This is a command
                 # check for PARALLEL step__new_step__test5__1 ${STEPS}
-                if len(main_command.parts) == 3 and all(hasattr(x,'word') for x in main_command.parts): # Make sure that it contains only word nodes #186 
-                    line_to_match = ' '.join(x.word for x in main_command.parts)
-                    parallel_call = parse_parrallel_call_1(line_to_match)
-                    #print ('Last assignment:', last_assignment)
-                    if  parallel_call and \
-                        last_assignment and \
-                        parallel_call['variable'] == last_assignment['variable'] and \
-                        parallel_call['step'] in calling_steps:
-                            #print ('THIS IS A VALID PARALLEL CALL')
-                            this_is_a_parallel_call_1 = True
-                            pos = (main_command.parts[0].pos[0], main_command.parts[2].pos[1])
+                parallel_call = main_command['parallel_call_1']
+                #print ('Last assignment:', last_assignment)
+                if  parallel_call and \
+                    last_assignment and \
+                    parallel_call['variable'] == last_assignment['variable']:
+                        #print ('THIS IS A VALID PARALLEL CALL')
+                        this_is_a_parallel_call_1 = True
+                        pos = main_command['parallel_call_1_pos']
 
                 # check for PARALLEL step_step_1, step_step_2, ....
-                if len(main_command.parts) > 1 and all(hasattr(x,'word') for x in main_command.parts): # Make sure that it contains only word nodes #186
-                    line_to_match = ' '.join(x.word for x in main_command.parts)
-                    parallel_call_2 = parse_parallel_call_2(line_to_match)
-                    if parallel_call_2 and all(x in calling_steps for x in parallel_call_2):
-                        this_is_a_parallel_call_2 = True
-                        pos = (main_command.parts[0].pos[0], main_command.parts[-1].pos[1])
+                parallel_call_2 = main_command['parallel_call_2']
+                if parallel_call_2:
+                    this_is_a_parallel_call_2 = True
+                    pos = main_command['parallel_call_2_pos']
 
                 if not (this_is_a_parallel_call_1 or this_is_a_parallel_call_2):
-                    # We are looking for a command with a single part (function call)
-                    if not len(main_command.parts) == 1:
+                    # A single word that is a calling step
+                    if not main_command['call_pos']:
                         continue
 
-                    # It should be a single word
-                    if not main_command.parts[0].kind == 'word':
-                        continue
+                    pos = main_command['call_pos']
 
-                    word = main_command.parts[0].word
-
-                    #It should be a calling step
-                    if not word in calling_steps:
-                        continue
-
-                    pos = main_command.parts[0].pos
+                pos = (pos[0] + len(prefix), pos[1] + len(prefix))
 
                 #This is a calling step!
                 found_call = True
@@ -1675,6 +2083,10 @@ class BaseExecutor():
     '''
     '''
     load_obc_functions_bash = r'. ${OBC_WORK_PATH}/obc_functions.sh' + '\n'
+    # Render the report when the script exits, even if it fails or is stopped (see bash_patterns['function_REPORT'])
+    render_report_on_exit_bash = 'trap obc_render_report EXIT\n'
+    # Steps render the report only if they fail. Otherwise it is rendered once, by final_report
+    render_report_on_failure_bash = "trap 'obc_rc=$?; [ ${obc_rc} -eq 0 ] || obc_render_report' EXIT\n"
 
     def __init__(self, workflow):
         if not isinstance(workflow, Workflow):
@@ -1698,7 +2110,7 @@ class BaseExecutor():
 
         Either from_variable or from_workflow should be True. Not both.
         '''
-        bash = 'touch {}\n'.format(self.file_with_input_parameters)
+        bash = Emitter('touch {}\n'.format(self.file_with_input_parameters))
         for name, parameter in self.workflow.input_parameter_values.items():
 
             assert sum([from_variable, from_workflow]) == 1 # Only one should be true
@@ -1714,7 +2126,7 @@ class BaseExecutor():
                 VALUE=value,
             ) + '\n'
 
-        return bash
+        return bash.getvalue()
 
 
 
@@ -1758,13 +2170,10 @@ class BaseExecutor():
 
         Return an airflow DAG without redundancies 
         Applies https://en.wikipedia.org/wiki/Transitive_reduction 
-        Method: https://networkx.github.io/documentation/stable/reference/algorithms/generated/networkx.algorithms.dag.transitive_reduction.html 
+        See transitive_reduction
         '''
-        G = nx.DiGraph()
         edges = [(run_before, run_after) for run_after, run_befores in run_afters.items() for run_before in run_befores]
-        G.add_edges_from(edges)
-        DAG = nx.transitive_reduction(G)
-        return DAG
+        return transitive_reduction(edges)
 
     def obc_init_step(self,):
         # Create init step for report
@@ -1788,16 +2197,8 @@ OBCENDOFFILE
     def obc_final_step(self, previous_tools, previous_steps_vars):
         # CREATE FINAL OPERATOR
         # Add all variables from previous tools
-        load_tool_vars = ''
-        for tool_filename in previous_tools:
-            load_tool_vars += '. {}\n'.format(tool_filename)
-
         # Load all variables from previous steps
-        load_step_vars = ''
-        for step_filename in previous_steps_vars:
-            load_step_vars += '. {}\n'.format(step_filename)
-
-        bash = load_tool_vars + load_step_vars + self.load_obc_functions_bash
+        bash = Emitter(self.load_variables_bash(previous_tools), self.load_variables_bash(previous_steps_vars), self.load_obc_functions_bash)
 
         # Add output varables
         for output_parameter in self.workflow.output_parameters:
@@ -1809,31 +2210,45 @@ OBCENDOFFILE
         # The final step, prints the output variables in json format
         export_json = '"{' + ', '.join([r'''\"{A}\": \"${{{A}}}\"'''.format(A=x['id']) for x in self.workflow.output_parameters]) + '}"'
         export_json = "echo " + export_json + '\n'
-        bash = bash + export_json
+        bash += export_json
 
-        return bash
+        return bash.getvalue()
 
-    def add_init_and_final_in_graph(self, init_step_name, final_step_name, run_afters, previous_tools, step_inter_ids):
-        #Add 'OBC_AIRFLOW_INIT' BEFORE ALL TOOLS
-        for tool_id in previous_tools:
-            if tool_id in run_afters:
-                run_afters[tool_id].append(init_step_name)
-            else:
-                run_afters[tool_id] = [init_step_name]
+    @staticmethod
+    def load_variables_bash(filenames):
+        '''
+        Source (.) all these files
+        '''
+        return ''.join('. {}\n'.format(filename) for filename in filenames)
 
-        #Add 'OBC_AIRFLOW_INIT' BEFORE ALL STEPS
-        for step_inter_id in step_inter_ids:
-            if step_inter_id in run_afters:
-                run_afters[step_inter_id].append(init_step_name)
-            else:
-                run_afters[step_inter_id] = [init_step_name]
+    def step_bash(self, step, previous_tools, step_vars_filename):
+        '''
+        The bash of a breaked step (see Workflow.break_down_step_generator) in the executors with one script per step.
+        It loads the variables of all tools, the input parameters and the variables of the steps that run before it.
+        Then it runs the step and saves its variables in step_vars_filename
+        '''
+
+        # Add all variables from previous tools
+        bash = Emitter(self.load_variables_bash(previous_tools))
+        bash += self.load_file_with_input_parameters()
+
+        # Load all variables from: input_parameters + previous steps
+        bash += self.load_variables_bash(self.create_step_vars_filename(run_after_step) for run_after_step in step['run_after'] or [])
+        bash += self.load_obc_functions_bash
+        bash += self.render_report_on_failure_bash
+
+        # The step. declare_decorate_bash saves its variables
+        bash += self.workflow.declare_decorate_bash(step['bash'], step_vars_filename)
 
-        # Add to the first step, the last tool
-        if previous_tools:
-            run_afters[step_inter_ids[0]].append(previous_tools[-1])
+        return bash.getvalue()
 
-        #Add 'OBC_AIRFLOW_FINAL' AFTER ALL STEPS
-        run_afters[final_step_name] = step_inter_ids + [init_step_name]
+    def compile(self,):
+        '''
+        The CompiledWorkflow of self.workflow. It is built once for every Workflow and it is shared by all executors
+        '''
+        if self.workflow.compiled is None:
+            self.workflow.compiled = CompiledWorkflow(self.workflow)
+        return self.workflow.compiled
 
     def initial_variabes(self,):
         ret  = 'export OBC_WORKFLOW_NAME={}\n'.format(self.workflow.root_workflow['name'])
@@ -1847,140 +2262,244 @@ OBCENDOFFILE
     def create_targz(self, output, files):
         '''
         Adapted from: https://stackoverflow.com/questions/740820/python-write-string-directly-to-tarfile
+        output is None: return the bytes of the archive
         '''
 
         if output is None:
-            args = []
-            fileIO = io.BytesIO()
-            kwargs = {'fileobj': fileIO, 'mode': 'w:gz'}
-        else:
-            # Check for file extension
-            if not os.path.splitext(output)[1].lower() in ['.tgz', '.gz']:
-                output = output + '.tgz'
+            return b''.join(self.stream_targz(files))
 
-            args = [output, "w:gz"]
-            kwargs = {}
+        # Check for file extension
+        if not os.path.splitext(output)[1].lower() in ['.tgz', '.gz']:
+            output = output + '.tgz'
 
-        with tarfile.open(*args, **kwargs) as tar:
+        with tarfile.open(output, "w:gz") as tar:
             for filename in files:
-                content = files[filename].encode('utf-8')
-                file = io.BytesIO(content)
-                info = tarfile.TarInfo(name=filename)
-                info.size = len(content)
-                tar.addfile(tarinfo=info, fileobj=file)
-        if output:
-            log_info('Created tar gz file: {}'.format(output))
-
-        if output is None:
-            fileIO.flush()
-            return fileIO.getvalue()
+                self.add_to_tar(tar, filename, files[filename])
+        log_info('Created tar gz file: {}'.format(output))
 
     def create_zip(self, output, files):
         '''
+        output is None: return the bytes of the archive
         '''
 
         if output is None:
-            fileIO = io.BytesIO()
-            args = [fileIO, 'w']
-        else:
-            # Check for file extension
-            if os.path.splitext(output)[1].lower() != '.zip':
-                output = output + '.zip'
+            return b''.join(self.stream_zip(files))
 
-            args = [output, 'w']
+        # Check for file extension
+        if os.path.splitext(output)[1].lower() != '.zip':
+            output = output + '.zip'
 
-        with zipfile.ZipFile(*args) as zipf:
+        with zipfile.ZipFile(output, 'w') as zipf:
             for filename in files:
-                content = files[filename].encode('utf-8')
-                #file = io.BytesIO(content)
-                zipf.writestr(filename, content, compress_type=compression)
-        if output:
-            log_info('Created zip file: {}'.format(output))
+                zipf.writestr(filename, files[filename].encode('utf-8'), compress_type=compression)
+        log_info('Created zip file: {}'.format(output))
 
-        if output is None:
-            fileIO.flush()
-            return fileIO.getvalue()
+    def add_to_tar(self, tar, filename, content):
+        '''
+        Add a file with this (str) content to tar
+        '''
+        content = content.encode('utf-8')
+        info = tarfile.TarInfo(name=filename)
+        info.size = len(content)
+        tar.addfile(tarinfo=info, fileobj=io.BytesIO(content))
+
+    def stream_targz(self, files):
+        '''
+        Generate the tar.gz archive of files in chunks (bytes). 
+        Only the compressed output of the last member is kept in memory 
+        '''
+
+        buffer = ChunkBuffer()
+        with tarfile.open(fileobj=buffer, mode='w|gz') as tar:
+            for filename in files:
+                self.add_to_tar(tar, filename, files[filename])
+                chunk = buffer.pop()
+                if chunk:
+                    yield chunk
+        yield buffer.pop()
+
+    def stream_zip(self, files):
+        '''
+        See stream_targz. zipfile writes data descriptors when the output is not seekable 
+        '''
+
+        buffer = ChunkBuffer()
+        with zipfile.ZipFile(buffer, 'w') as zipf:
+            for filename in files:
+                zipf.writestr(filename, files[filename].encode('utf-8'), compress_type=compression)
+                chunk = buffer.pop()
+                if chunk:
+                    yield chunk
+        yield buffer.pop()
+
+
+class CompiledWorkflow:
+    '''
+    What all the executors with one script per tool / step (CWL, Airflow, Argo, Nextflow, Snakemake) need from a Workflow.
+    It does not depend on the output format. The executors only render it (see BaseExecutor.compile)
+
+    init_bash: The report initialization (obc_init_step)
+    input_parameters_bash: Saves the input parameters (save_input_parameters)
+    tools: List of {'id', 'vars_filename', 'bash'} in installation order
+    steps: List of {'id', 'vars_filename', 'bash', 'run_after'}. The breaked steps (break_down_step_generator). id is the step_inter_id
+    final_bash: Reports the output variables (obc_final_step)
+    dag: The transitive reduction of the dependencies. The init and the final steps are called INIT and FINAL.
+         INIT runs before all tools, the tools run one after the other, the steps run after all tools and after their run_after, FINAL runs after everything.
+    '''
+
+    INIT = 'OBC_INIT'
+    FINAL = 'OBC_FINAL'
+
+    def __init__(self, workflow):
+        executor = BaseExecutor(workflow)
+
+        self.init_bash = executor.obc_init_step()
+        self.input_parameters_bash = executor.save_input_parameters(from_workflow=True)
+
+        run_afters = {self.INIT: []}
+
+        self.tools = []
+        previous_tools = []
+        for tool in workflow.tool_bash_script_generator():
+            tool_id = workflow.get_tool_dash_id(tool, no_dots=True)
+            tool_vars_filename = os.path.join('${OBC_WORK_PATH}', Workflow.get_tool_vars_filename(tool))
+
+            bash = workflow.get_tool_bash_commands(
+                tool=tool, 
+                validation=True, 
+                update_server_status=False,
+                read_variables_from_command_line=False,
+                variables_json_filename=None,
+                variables_sh_filename_read = previous_tools,
+                variables_sh_filename_write = tool_vars_filename,
+            )
+
+            run_afters[tool_id] = [self.INIT] + [x['id'] for x in self.tools]
+            self.tools.append({'id': tool_id, 'vars_filename': tool_vars_filename, 'bash': bash})
+            previous_tools.append(tool_vars_filename)
+
+        tool_ids = [x['id'] for x in self.tools]
+
+        self.steps = []
+        for step in workflow.break_down_step_generator(
+            enable_read_arguments_from_commandline=False,
+            enable_save_variables_to_json=False,
+            enable_save_variables_to_sh=False,
+            ):
+
+            step_inter_id = '{}__{}'.format(step['id'], str(step['count']))
+            step_vars_filename = executor.create_step_vars_filename(step_inter_id) # os.path.join('${OBC_WORK_PATH}', step_inter_id + '.sh')
+
+            run_afters[step_inter_id] = [self.INIT] + tool_ids + (step['run_after'] or [])
+            self.steps.append({
+                'id': step_inter_id, 
+                'vars_filename': step_vars_filename, 
+                'bash': executor.step_bash(step, previous_tools, step_vars_filename), 
+                'run_after': step['run_after'],
+            })
+
+        self.final_bash = executor.obc_final_step(previous_tools, [x['vars_filename'] for x in self.steps])
+        run_afters[self.FINAL] = [self.INIT] + tool_ids + [x['id'] for x in self.steps]
+
+        self.dag = executor.transitive_reduction(run_afters)
+
+    def dag_nodes(self, init_name, final_name):
+        '''
+        Yields (node, predecessors, successors) of the dag. INIT and FINAL are renamed to init_name and final_name
+        '''
+        names = {self.INIT: init_name, self.FINAL: final_name}
+        for node in self.dag.nodes():
+            yield (
+                names.get(node, node), 
+                [names.get(x, x) for x in self.dag.predecessors(node)], 
+                [names.get(x, x) for x in self.dag.successors(node)],
+            )
+
+    def dag_edges(self, init_name, final_name):
+        '''
+        The edges (run_before, run_after) of the dag. See dag_nodes
+        '''
+        names = {self.INIT: init_name, self.FINAL: final_name}
+        return [(names.get(a, a), names.get(b, b)) for a, b in self.dag.edges]
 
 
 class LocalExecutor(BaseExecutor):
     '''
     Creates a unique BIG script!
+    report_batch: Report the status to the server in batches, from a background process (see bash_patterns['update_server_status_batch'])
     '''
 
+    def __init__(self, workflow, report_batch=False):
+        super().__init__(workflow)
+        self.report_batch = report_batch
+
     def build(self, output):
         '''
         output: if string then consider this a file name
-                if None then create a in-memory file and return the string 
+                if None then return the string 
+                otherwise this is a file object (stream, socket.makefile('w'), ...). The script is written there
         '''
 
-        if type(output) is str:
-            opener = open
-            opener_args = [output, 'w']
-            opener_kwargs = {}
-        elif output is None:
-            opener = io.StringIO
-            opener_args = ['w']
-            opener_kwargs = {'newline': '\n'}
-        else:
+        if not (type(output) is str or output is None or hasattr(output, 'write')):
             raise OBC_Executor_Exception('Unknown type of output in build: {}'.format(type(output).__name__))
 
-        ret = None
+        script = Emitter()
 
-        with opener(*opener_args, **opener_kwargs) as f:
+        # Print basic info of executed workflow
+        script += self.workflow.show_basic_info()
 
-            # Print basic info of executed workflow
-            f.write(self.workflow.show_basic_info())
+        # Ask for input parameters
+        script += self.workflow.get_input_parameters_read_bash_commands()
 
-            # Ask for input parameters
-            f.write(self.workflow.get_input_parameters_read_bash_commands())
+        # Set current token
+        script += self.workflow.get_token_set_bash_commands()
 
-            # Set current token
-            f.write(self.workflow.get_token_set_bash_commands())
-
-            #Insert essential functions
-            f.write(bash_patterns['check_envsanity'])
-            f.write(bash_patterns['parse_json'])
-            f.write(bash_patterns['update_server_status'])
-            f.write(bash_patterns['base64_decode'])
-            f.write(bash_patterns['validate'])
-            f.write((bash_patterns['init_report'] + bash_patterns['function_REPORT'] + bash_patterns['function_PARALLEL']) 
-                .replace('{{OBC_SERVER}}', str(self.workflow.obc_server)) 
-                .replace('{{OBC_WORKFLOW_NAME}}', self.workflow.root_workflow['name']) 
-                .replace('{{OBC_WORKFLOW_EDIT}}', str(self.workflow.root_workflow['edit'])) 
-            )
+        #Insert essential functions
+        script += bash_patterns['check_envsanity']
+        script += bash_patterns['parse_json']
+        script += bash_patterns['update_server_status_batch' if self.report_batch else 'update_server_status']
+        script += bash_patterns['base64_decode']
+        script += bash_patterns['validate']
+        script += ((bash_patterns['init_report'] + bash_patterns['function_REPORT'] + bash_patterns['function_PARALLEL']) 
+            .replace('{{OBC_SERVER}}', str(self.workflow.obc_server)) 
+            .replace('{{OBC_WORKFLOW_NAME}}', self.workflow.root_workflow['name']) 
+            .replace('{{OBC_WORKFLOW_EDIT}}', str(self.workflow.root_workflow['edit'])) 
+        )
+        script += self.render_report_on_exit_bash
 
-            # Set the OBC_REPORT_PATH parameter 
+        # Set the OBC_REPORT_PATH parameter 
 
 
-            f.write(Workflow.bash_workflow_starts(self.workflow.root_workflow))
+        script += Workflow.bash_workflow_starts(self.workflow.root_workflow)
 
-            # INSTALLATION TOOL BASH
-            for tool in self.workflow.tool_bash_script_generator():
-                f.write(self.workflow.get_tool_bash_commands(tool))
+        # INSTALLATION TOOL BASH
+        for tool in self.workflow.tool_bash_script_generator():
+            script += self.workflow.get_tool_bash_commands(tool)
 
-            # INPUT PARAMETERS BASH
-            f.write(self.workflow.get_input_bash_commands())
+        # INPUT PARAMETERS BASH
+        script += self.workflow.get_input_bash_commands()
 
-            # STEP FUNCTIONS BASH
-            f.write(self.workflow.get_step_bash_commands())
+        # STEP FUNCTIONS BASH
+        script += self.workflow.get_step_bash_commands()
 
-            # CALL MAIN STEP
-            f.write(self.workflow.get_main_step_bash_commands())
+        # CALL MAIN STEP
+        script += self.workflow.get_main_step_bash_commands()
 
-            # PRINT OUTPUT PARAMETERS
-            f.write(self.workflow.get_output_bash_commands())
+        # PRINT OUTPUT PARAMETERS
+        script += self.workflow.get_output_bash_commands()
 
-            f.write(Workflow.bash_workflow_ends(self.workflow.root_workflow))
+        script += Workflow.bash_workflow_ends(self.workflow.root_workflow)
 
+        if output is None:
             # Get srtring content of file
-            if output is None:
-                f.flush()
-                ret = f.getvalue()
+            return script.getvalue()
 
         if type(output) is str:
+            with open(output, 'w') as f:
+                script.write_to(f)
             log_info(f'Created file: {output}')
-
-        return ret
+        else:
+            script.write_to(output)
 
 
 class CWLExecutor(BaseExecutor):
@@ -2214,8 +2733,9 @@ steps:
         return '\n   {}:\n      type: stdout'.format(output_id)
 
 
-    def build(self, output, shell='bash', output_format='cwltargz', workflow_id=None):
+    def build(self, output, shell='bash', output_format='cwltargz', workflow_id=None, stream=False):
         '''
+        stream: Return a generator of the chunks of the archive (cwltargz, cwlzip and output is None)
         '''
 
         env_variables = self.get_environment_variables(workflow_id=workflow_id)
@@ -2223,10 +2743,8 @@ steps:
         # Get the essential variables that have not been set 
         # We will set these variable from the input yml file
 
-        previous_tools = []
-        tool_ids = []
+        compiled = self.compile()
         files = {}
-        run_afters = {}
 
         
         # Create init step
@@ -2236,8 +2754,8 @@ steps:
 
         bash = Workflow.read_arguments_from_commandline(input_parameters)
         #bash += self.save_input_parameters(from_variable=True)
-        bash += self.save_input_parameters(from_workflow=True)
-        bash += self.obc_init_step()
+        bash += compiled.input_parameters_bash
+        bash += compiled.init_bash
 
         files['OBC_CWL_INIT.sh'] = bash 
 
@@ -2252,83 +2770,19 @@ steps:
         )
 
         # Add tools
-        for tool_index, tool in enumerate(self.workflow.tool_bash_script_generator()):
-
-            tool_vars_filename = os.path.join('${OBC_WORK_PATH}', Workflow.get_tool_vars_filename(tool))
-            tool_id = self.workflow.get_tool_dash_id(tool, no_dots=True)
-            tool_id_sh_fn = self.create_tool_id_sh_fn(tool_id)
-            
-            bash = self.workflow.get_tool_bash_commands(
-                tool=tool, 
-                validation=True, 
-                update_server_status=False,
-                read_variables_from_command_line=False,
-                variables_json_filename=None,
-                variables_sh_filename_read = previous_tools,
-                variables_sh_filename_write = tool_vars_filename,
-            )
-            files[tool_id_sh_fn] = bash
-            
-            if tool_ids:
-                run_afters[tool_id] = copy.copy(tool_ids)          
-            tool_ids.append(tool_id)
-            previous_tools.append(tool_vars_filename)
-            
+        for tool in compiled.tools:
+            files[self.create_tool_id_sh_fn(tool['id'])] = tool['bash']
 
         # Add steps
-        previous_steps_vars = []
-        step_inter_ids = []
-        
-        for step in self.workflow.break_down_step_generator(
-            enable_read_arguments_from_commandline=False,
-            enable_save_variables_to_json=False,
-            enable_save_variables_to_sh=False,
-            ):
-
-            step_id = step['id']
-            count = step['count']
-            bash = step['bash']
-            step_inter_id = '{}__{}'.format(step_id, str(count))
-            step_inter_ids.append(step_inter_id)
-            step_vars_filename = self.create_step_vars_filename(step_inter_id) # os.path.join('${OBC_WORK_PATH}', step_inter_id + '.sh')
-
-            if step['run_after']:
-                run_afters[step_inter_id] = step['run_after']
-
-            # Add declare. This should be first
-            bash = self.workflow.declare_decorate_bash(bash, step_vars_filename)
-
-            # Add all variables from previous tools
-            load_tool_vars = ''
-            for tool_filename in previous_tools:
-                load_tool_vars += '. {}\n'.format(tool_filename)
-            
-            # Load all variables from: input_parameters + previous steps
-            load_step_vars = ''
-            if step['run_after']:
-                for run_after_step in step['run_after']:
-                    load_step_vars += '. {}\n'.format(self.create_step_vars_filename(run_after_step))
-            
-            bash = load_tool_vars + self.load_file_with_input_parameters() + load_step_vars + self.load_obc_functions_bash + bash
-
-            previous_steps_vars.append(step_vars_filename)
-
-            step_inter_id_sh_fn = self.create_step_inter_id_sh_fn(step_inter_id)
-            files[step_inter_id_sh_fn] = bash
+        for step in compiled.steps:
+            files[self.create_step_inter_id_sh_fn(step['id'])] = step['bash']
 
         # Create final step
-        files['OBC_CWL_FINAL.sh'] = self.obc_final_step(previous_tools, previous_steps_vars)
-
-        # Add INIT and FINAL in the graph
-        self.add_init_and_final_in_graph('OBC_CWL_INIT', 'OBC_CWL_FINAL', run_afters, tool_ids, step_inter_ids) 
-
-        #Create DAG
-        DAG = self.transitive_reduction(run_afters)
+        files['OBC_CWL_FINAL.sh'] = compiled.final_bash
 
         steps_cwl = []
-        for node in DAG.nodes:
-            #print (node + ' --> ', list(DAG.predecessors(node)))
-            predecessors = list(DAG.predecessors(node))
+        for node, predecessors, _ in compiled.dag_nodes('OBC_CWL_INIT', 'OBC_CWL_FINAL'):
+            #print (node + ' --> ', predecessors)
             fn = self.create_step_inter_id_cwl_fn(node) # The CWL individual file for each step
 
             if node == 'OBC_CWL_FINAL':
@@ -2391,8 +2845,12 @@ steps:
 
 
         if output_format == 'cwltargz':
+            if stream:
+                return self.stream_targz(files)
             return self.create_targz(output, files)
         elif output_format == 'cwlzip':
+            if stream:
+                return self.stream_zip(files)
             return self.create_zip(output, files)
         elif output_format == 'cwl':
             for filename, content in files.items():
@@ -2446,13 +2904,11 @@ dag = DAG(
         return '{% raw %}\n' + bash + '\n{% endraw %}\n'
 
 
-    def create_DAG(self, run_afters):
+    def create_DAG(self, compiled):
         '''
-        Create an Airflow format of the transitive reduction of the graph
+        Create an Airflow format of the transitive reduction of the graph (see CompiledWorkflow)
         '''
-        #print (DAG.edges)
-        DAG = self.transitive_reduction(run_afters)
-        return '\n'.join('{} >> {}'.format(edge[0], edge[1]) for edge in DAG.edges)
+        return '\n'.join('{} >> {}'.format(edge[0], edge[1]) for edge in compiled.dag_edges('OBC_AIRFLOW_INIT', 'OBC_AIRFLOW_FINAL'))
 
     def build(self, output, output_format='airflow', workflow_id=None, obc_client=False):
         '''
@@ -2469,9 +2925,11 @@ dag = DAG(
         else:
             envs = ''
 
+        compiled = self.compile()
+
         # Create init step
-        bash = self.obc_init_step()
-        bash += self.save_input_parameters(from_workflow=True)
+        bash = compiled.init_bash
+        bash += compiled.input_parameters_bash
         bash = self.raw_jinja2(bash)
 
         airflow_bash = self.bash_operator_pattern.format(
@@ -2481,90 +2939,23 @@ dag = DAG(
         )
 
         init_operators = [airflow_bash]
-        run_afters = {}
 
         # CREATE TOOL OPERATORS
-        previous_tools = []
-        tool_bash_operators = []
-        tool_ids = []
-        for tool_index, tool in enumerate(self.workflow.tool_bash_script_generator()):
-
-            tool_vars_filename = os.path.join('${OBC_WORK_PATH}', Workflow.get_tool_vars_filename(tool))
-            tool_id = self.workflow.get_tool_dash_id(tool, no_dots=True)
-            
-            bash = self.workflow.get_tool_bash_commands(
-                tool=tool, 
-                validation=True, 
-                update_server_status=False,
-                read_variables_from_command_line=False,
-                variables_json_filename=None,
-                variables_sh_filename_read = previous_tools,
-                variables_sh_filename_write = tool_vars_filename,
-            )
-            bash = self.raw_jinja2(bash)
-            airflow_bash = self.bash_operator_pattern.format(
-                ID=tool_id,
-                BASH=bash,
-                ENVS=envs,
-            )
-
-
-            tool_bash_operators.append(airflow_bash)
-            if tool_ids:
-                run_afters[tool_id] = copy.copy(tool_ids)
-            tool_ids.append(tool_id)
-
-            previous_tools.append(tool_vars_filename)
+        tool_bash_operators = [self.bash_operator_pattern.format(
+            ID=tool['id'],
+            BASH=self.raw_jinja2(tool['bash']),
+            ENVS=envs,
+        ) for tool in compiled.tools]
 
         # CREATE STEP OPERATORS
-        previous_steps_vars = []
-        step_inter_ids = []
-        step_bash_operators = []
-        for step in self.workflow.break_down_step_generator(
-            enable_read_arguments_from_commandline=False,
-            enable_save_variables_to_json=False,
-            enable_save_variables_to_sh=False,
-            ):
-
-            step_id = step['id']
-            count = step['count']
-            bash = step['bash']
-            step_inter_id = '{}__{}'.format(step_id, str(count))
-            step_inter_ids.append(step_inter_id)
-            step_vars_filename = self.create_step_vars_filename(step_inter_id) # os.path.join('${OBC_WORK_PATH}', step_inter_id + '.sh')
-
-            if step['run_after']:
-                run_afters[step_inter_id] = step['run_after']
-
-            # Add declare. This should be first
-            bash = self.workflow.declare_decorate_bash(bash, step_vars_filename)
-
-            # Add all variables from previous tools
-            load_tool_vars = ''
-            for tool_filename in previous_tools:
-                load_tool_vars += '. {}\n'.format(tool_filename)
-            
-            # Load all variables from previous steps
-            load_step_vars = ''
-            if step['run_after']:
-                for run_after_step in step['run_after']:
-                    load_step_vars += '. {}\n'.format(self.create_step_vars_filename(run_after_step))
-            
-            bash = load_tool_vars + self.load_file_with_input_parameters() + load_step_vars + self.load_obc_functions_bash + bash
-
-            previous_steps_vars.append(step_vars_filename)
-
-            bash = self.raw_jinja2(bash)
-            airflow_bash = self.bash_operator_pattern.format(
-                ID = step_inter_id,
-                BASH = bash,
-                ENVS=envs,
-            )
-            step_bash_operators.append(airflow_bash)
+        step_bash_operators = [self.bash_operator_pattern.format(
+            ID = step['id'],
+            BASH = self.raw_jinja2(step['bash']),
+            ENVS=envs,
+        ) for step in compiled.steps]
 
         # Create final step
-        bash = self.obc_final_step(previous_tools, previous_steps_vars) 
-        bash = self.raw_jinja2(bash) # Wrap in jinja2 verbatim . https://stackoverflow.com/questions/25359898/escape-jinja2-syntax-in-a-jinja2-template 
+        bash = self.raw_jinja2(compiled.final_bash) # Wrap in jinja2 verbatim . https://stackoverflow.com/questions/25359898/escape-jinja2-syntax-in-a-jinja2-template 
         airflow_bash = self.bash_operator_pattern.format(
             ID='OBC_AIRFLOW_FINAL',
             BASH=bash,
@@ -2572,10 +2963,8 @@ dag = DAG(
         )
         final_operators = [airflow_bash]
 
-        # Add INIT and FINAL in the run_afters graph
-        self.add_init_and_final_in_graph('OBC_AIRFLOW_INIT', 'OBC_AIRFLOW_FINAL', run_afters, tool_ids, step_inter_ids) 
         # Create dag
-        DAG = self.create_DAG(run_afters)
+        DAG = self.create_DAG(compiled)
 
         airflow_python = self.pattern.format(
             WORKFLOW_ID = workflow_id if workflow_id else self.workflow.root_workflow_id,
@@ -2670,10 +3059,10 @@ spec:
 
     @staticmethod
     def yaml_intend(text, indent=9):
-        ret = ''
+        ret = Emitter()
         for line in text.split('\n'):
             ret += ' '*indent + line + '\n'
-        return ret
+        return ret.getvalue()
 
     def build(self, output, output_format='argo', workflow_id=None, obc_client=False):
         '''
@@ -2681,14 +3070,11 @@ spec:
         '''
 
         variables = self.get_environment_variables(obc_client=obc_client, workflow_id=workflow_id)
-        
-        # List of all argo_dags. First we store them. Then we add the dependent steps after transitive reduction (TR)
-        # ARGO does not apply TR. This makes the graph overly dense and complex 
-        argo_dags = ['TASKOBCINIT']
+        compiled = self.compile()
 
         # Create init step
-        bash = self.obc_init_step()
-        bash += self.save_input_parameters(from_workflow=True)
+        bash = compiled.init_bash
+        bash += compiled.input_parameters_bash
 
         argo_bash = self.SCRIPT_TEMPLATE.format(
             ARGO_ROOT = ArgoExecutor.ARGO_ROOT,
@@ -2698,122 +3084,16 @@ spec:
         )
         init_bash_scripts = [argo_bash]
 
-
-        run_afters = {'TASKOBCINIT': []}
-
-
-        # CREATE TOOL OPERATORS ARGO
-        previous_tools = []
-        tool_bash_scripts = []
-        tool_ids = []
-        for tool_index, tool in enumerate(self.workflow.tool_bash_script_generator()):
-
-            tool_vars_filename = os.path.join('${OBC_WORK_PATH}', Workflow.get_tool_vars_filename(tool))
-            tool_id = self.workflow.get_tool_dash_id(tool, no_dots=True)
-            
-            bash = self.workflow.get_tool_bash_commands(
-                tool=tool, 
-                validation=True, 
-                update_server_status=False,
-                read_variables_from_command_line=False,
-                variables_json_filename=None,
-                variables_sh_filename_read = previous_tools,
-                variables_sh_filename_write = tool_vars_filename,
-            )
-            
-            argo_bash = self.SCRIPT_TEMPLATE.format(
-                ARGO_ROOT = ArgoExecutor.ARGO_ROOT,
-                ID = ArgoExecutor.argo_workflow_id(tool_id),
-                BASH = ArgoExecutor.yaml_intend(bash),
-                ENVS = ArgoExecutor.yaml_variables(variables),
-            )
-
-            tool_bash_scripts.append(argo_bash)
-
-            run_afters[tool_id] = ['TASKOBCINIT'] # All tools run after TASKOBCINIT
-            if tool_ids:
-                run_afters[tool_id] += copy.copy(tool_ids)
-                
-            tool_ids.append(tool_id)
-
-            argo_dags.append(tool_id)
-            #dags.append(self.DAG_TEMPLATE.format(
-            #    TASK_NAME = ArgoExecutor.argo_workflow_id('TASK-' + tool_id),
-            #    DEPENDENCIES = ', '.join(
-            #        ['TASKOBCINIT'] + \
-            #        [ArgoExecutor.argo_workflow_id('TASK-'+x) for x in this_tool_run_after]
-            #        ), 
-            #    TEMPLATE_NAME = ArgoExecutor.argo_workflow_id(tool_id)
-            #))
-
-
-            previous_tools.append(tool_vars_filename)
-
-
-        # CREATE STEP OPERATORS ARGO
-        previous_steps_vars = []
-        step_inter_ids = []
-        step_bash_scripts = []
-        all_step_inter_ids = []
-        for step in self.workflow.break_down_step_generator(
-            enable_read_arguments_from_commandline=False,
-            enable_save_variables_to_json=False,
-            enable_save_variables_to_sh=False,
-            ):
-
-            step_id = step['id']
-            count = step['count']
-            bash = step['bash']
-            step_inter_id = '{}__{}'.format(step_id, str(count))
-            all_step_inter_ids.append(step_inter_id)
-            step_inter_ids.append(step_inter_id)
-            step_vars_filename = self.create_step_vars_filename(step_inter_id) # os.path.join('${OBC_WORK_PATH}', step_inter_id + '.sh')
-
-            run_afters[step_inter_id] = ['TASKOBCINIT'] + tool_ids
-            if step['run_after']:
-                run_afters[step_inter_id] += step['run_after']
-
-            # Add declare. This should be first
-            bash = self.workflow.declare_decorate_bash(bash, step_vars_filename)
-
-            # Add all variables from previous tools
-            load_tool_vars = ''
-            for tool_filename in previous_tools:
-                load_tool_vars += '. {}\n'.format(tool_filename)
-            
-            # Load all variables from previous steps
-            load_step_vars = ''
-            if step['run_after']:
-                for run_after_step in step['run_after']:
-                    load_step_vars += '. {}\n'.format(self.create_step_vars_filename(run_after_step))
-            
-            bash = load_tool_vars + self.load_file_with_input_parameters() + load_step_vars + self.load_obc_functions_bash + bash
-
-            previous_steps_vars.append(step_vars_filename)
-
-            
-            argo_bash = self.SCRIPT_TEMPLATE.format(
-                ARGO_ROOT = ArgoExecutor.ARGO_ROOT,
-                ID = ArgoExecutor.argo_workflow_id(step_inter_id),
-                BASH = ArgoExecutor.yaml_intend(bash),
-                ENVS = ArgoExecutor.yaml_variables(variables),
-            )
-            step_bash_scripts.append(argo_bash)
-
-            argo_dags.append(step_inter_id)
-            #dags.append(self.DAG_TEMPLATE.format(
-            #    TASK_NAME = ArgoExecutor.argo_workflow_id('TASK-' + step_inter_id),
-            #    DEPENDENCIES = ', '.join(
-            #        ['TASKOBCINIT'] + \
-            #        [ArgoExecutor.argo_workflow_id('TASK-'+x) for x in tool_ids] + \
-            #        [ArgoExecutor.argo_workflow_id('TASK-'+x) for x in run_afters.get(step_inter_id, [])]
-            #    ), 
-            #    TEMPLATE_NAME = ArgoExecutor.argo_workflow_id(step_inter_id)
-            #))
-
+        # CREATE TOOL AND STEP OPERATORS ARGO
+        tool_and_step_bash_scripts = [self.SCRIPT_TEMPLATE.format(
+            ARGO_ROOT = ArgoExecutor.ARGO_ROOT,
+            ID = ArgoExecutor.argo_workflow_id(node['id']),
+            BASH = ArgoExecutor.yaml_intend(node['bash']),
+            ENVS = ArgoExecutor.yaml_variables(variables),
+        ) for node in compiled.tools + compiled.steps]
 
         # Create final step
-        bash = self.obc_final_step(previous_tools, previous_steps_vars) 
+        bash = compiled.final_bash
          
         argo_bash = self.SCRIPT_TEMPLATE.format(
             ARGO_ROOT = ArgoExecutor.ARGO_ROOT,
@@ -2823,21 +3103,10 @@ spec:
         )
         final_bash_scripts = [argo_bash]
 
-        # Build the run_afters so that 'SCRIPTOBCINIT' is before everything
-        # and 'SCRIPTOBCFINAL' is after everything 
-        # We did this when filling the run_afters dictionary so we don't have to call it
-        #self.add_init_and_final_in_graph('SCRIPTOBCINIT', 'SCRIPTOBCFINAL', run_afters, tool_ids, step_inter_ids) 
-
-        argo_dags.append('TASKOBCFINAL')
-        run_afters['TASKOBCFINAL'] = ['TASKOBCINIT'] + tool_ids + all_step_inter_ids 
-
-        #print (run_afters)
-
         # Create the DAGS part of the YAML
+        # ARGO does not apply transitive reduction. This makes the graph overly dense and complex. So we use the reduced graph of CompiledWorkflow
         dags = []
-        DAG = self.transitive_reduction(run_afters)
-        for node in DAG.nodes():
-            predecessors = list(DAG.predecessors(node))
+        for node, predecessors, _ in compiled.dag_nodes('TASKOBCINIT', 'TASKOBCFINAL'):
 
             def create_task_name(node):
                 if node in ['TASKOBCINIT', 'TASKOBCFINAL']:
@@ -2863,7 +3132,7 @@ spec:
 
         argo = self.WORKFLOW_TEMPLATE.format(
             WORKFLOW_NAME = ArgoExecutor.argo_workflow_id(workflow_id if workflow_id else self.workflow.root_workflow_id),
-            SCRIPTS = '\n'.join(init_bash_scripts + tool_bash_scripts + step_bash_scripts + final_bash_scripts),
+            SCRIPTS = '\n'.join(init_bash_scripts + tool_and_step_bash_scripts + final_bash_scripts),
             DAGS = ''.join(dags)
         )
 
@@ -2965,108 +3234,28 @@ process {PROCESS_NAME} {{
 
         #variables = self.get_environment_variables(obc_client=obc_client, workflow_id=workflow_id)
 
+        compiled = self.compile()
         nextflow_process = {}
         
         # Create init step
         bash = self.initial_variabes() # Use this ONLY for NEXFLOW
-        bash += self.obc_init_step()
-        bash += self.save_input_parameters(from_workflow=True)
-
+        bash += compiled.init_bash
+        bash += compiled.input_parameters_bash
 
         nextflow_process['PROCESSOBCINIT'] = {'BASH': bash}
 
-        run_afters = {'PROCESSOBCINIT': []}
-
-        # CREATE TOOL OPERATORS Nextflow
-        previous_tools = []
-        #tool_bash_scripts = []
-        tool_ids = []
-        for tool_index, tool in enumerate(self.workflow.tool_bash_script_generator()):
-
-            tool_vars_filename = os.path.join('${OBC_WORK_PATH}', Workflow.get_tool_vars_filename(tool))
-            tool_id = self.workflow.get_tool_dash_id(tool, no_dots=True)
-            
-            bash = self.initial_variabes()
-            bash += self.workflow.get_tool_bash_commands(
-                tool=tool, 
-                validation=True, 
-                update_server_status=False,
-                read_variables_from_command_line=False,
-                variables_json_filename=None,
-                variables_sh_filename_read = previous_tools,
-                variables_sh_filename_write = tool_vars_filename,
-            )
-
-            nextflow_process[tool_id] = {'BASH': bash}
-        
-            run_afters[tool_id] = ['PROCESSOBCINIT'] # All tools run after PROCESSOBCINIT
-            if tool_ids:
-                run_afters[tool_id] += copy.copy(tool_ids)
-                
-            tool_ids.append(tool_id)
-
-            #argo_dags.append(tool_id)
-
-            previous_tools.append(tool_vars_filename)
-
-
-        # CREATE STEP OPERATORS Nextflow
-        previous_steps_vars = []
-        step_inter_ids = []
-        step_bash_scripts = []
-        all_step_inter_ids = []
-        for step in self.workflow.break_down_step_generator(
-            enable_read_arguments_from_commandline=False,
-            enable_save_variables_to_json=False,
-            enable_save_variables_to_sh=False,
-            ):
-
-            step_id = step['id']
-            count = step['count']
-            bash = step['bash']
-            step_inter_id = '{}__{}'.format(step_id, str(count))
-            all_step_inter_ids.append(step_inter_id)
-            step_inter_ids.append(step_inter_id)
-            step_vars_filename = self.create_step_vars_filename(step_inter_id) # os.path.join('${OBC_WORK_PATH}', step_inter_id + '.sh')
-
-            run_afters[step_inter_id] = ['PROCESSOBCINIT'] + tool_ids
-            if step['run_after']:
-                run_afters[step_inter_id] += step['run_after']
-
-            # Add declare. This should be first
-            bash = self.workflow.declare_decorate_bash(bash, step_vars_filename)
-
-            # Add all variables from previous tools
-            load_tool_vars = ''
-            for tool_filename in previous_tools:
-                load_tool_vars += '. {}\n'.format(tool_filename)
-            
-            # Load all variables from previous steps
-            load_step_vars = ''
-            if step['run_after']:
-                for run_after_step in step['run_after']:
-                    load_step_vars += '. {}\n'.format(self.create_step_vars_filename(run_after_step))
-            
-            bash = self.initial_variabes() + load_tool_vars + self.load_file_with_input_parameters() + load_step_vars + self.load_obc_functions_bash + bash
-
-            previous_steps_vars.append(step_vars_filename)
-
-            nextflow_process[step_inter_id] = {'BASH': bash}
+        # CREATE TOOL AND STEP OPERATORS Nextflow
+        for node in compiled.tools + compiled.steps:
+            nextflow_process[node['id']] = {'BASH': self.initial_variabes() + node['bash']}
 
         # Create final step
-        bash = self.initial_variabes() + self.obc_final_step(previous_tools, previous_steps_vars) 
+        bash = self.initial_variabes() + compiled.final_bash
 
         nextflow_process['PROCESSOBCFINAL'] = {'BASH': bash}
-        
-        run_afters['PROCESSOBCFINAL'] = ['PROCESSOBCINIT'] + tool_ids + all_step_inter_ids 
-        #print (run_afters)
 
         # Create the DAGS part of the YAML
         processes = []
-        DAG = self.transitive_reduction(run_afters)
-        for node in DAG.nodes():
-            predecessors = list(DAG.predecessors(node))
-            successors = list(DAG.successors(node))
+        for node, predecessors, successors in compiled.dag_nodes('PROCESSOBCINIT', 'PROCESSOBCFINAL'):
 
             def create_channel_mame(node_from, node_to):
                 return node_from + '__' + node_to
@@ -3119,14 +3308,14 @@ rule {RULE_ID}:
 
         touch = '\ntouch {}\n'.format(self.create_rule_filename(node))
 
-        ret = '    shell:\n'
+        ret = Emitter('    shell:\n')
         #ret += '        ' + repr(shell + touch) + '\n'
         ret +=  '        r"""\n'
         ret += shell.replace('{', '{{').replace('}', '}}')
         ret += touch
         ret +=  '        """\n'
 
-        return ret
+        return ret.getvalue()
     
     def create_rule_filename(self, rule):
        return os.path.join(self.OBC_DONE_DIR, rule + '.done' ) 
@@ -3140,98 +3329,25 @@ rule {RULE_ID}:
         self.OBC_DONE_DIR =  'OBC_' + self.RANDOM_ID
 
 
+        compiled = self.compile()
         snakemake_rules = {}
         
         # Create init step
         bash = 'mkdir -p {}\n'.format(self.OBC_DONE_DIR)
         bash += self.initial_variabes() # Load OBC_WORKFLOW, OBC
-        bash += self.obc_init_step()
-        bash += self.save_input_parameters(from_workflow=True)
-
+        bash += compiled.init_bash
+        bash += compiled.input_parameters_bash
 
         snakemake_rules['RULEOBCINIT'] = {'BASH': bash}
 
-        run_afters = {'RULEOBCINIT': []}
-
-        # CREATE TOOL OPERATORS Snakemake
-        previous_tools = []
-        tool_ids = []
-        for tool_index, tool in enumerate(self.workflow.tool_bash_script_generator()):
-
-            tool_vars_filename = os.path.join('${OBC_WORK_PATH}', Workflow.get_tool_vars_filename(tool))
-            tool_id = self.workflow.get_tool_dash_id(tool, no_dots=True)
-            
-            bash = self.initial_variabes()
-            bash += self.workflow.get_tool_bash_commands(
-                tool=tool, 
-                validation=True, 
-                update_server_status=False,
-                read_variables_from_command_line=False,
-                variables_json_filename=None,
-                variables_sh_filename_read = previous_tools,
-                variables_sh_filename_write = tool_vars_filename,
-            )
-
-            snakemake_rules[tool_id] = {'BASH': bash}
-        
-            run_afters[tool_id] = ['RULEOBCINIT'] # All tools run after PROCESSOBCINIT
-            if tool_ids:
-                run_afters[tool_id] += copy.copy(tool_ids)
-                
-            tool_ids.append(tool_id)
-
-            previous_tools.append(tool_vars_filename)
-
-        # CREATE STEP OPERATORS Snakemake
-        previous_steps_vars = []
-        step_inter_ids = []
-        step_bash_scripts = []
-        all_step_inter_ids = []
-        for step in self.workflow.break_down_step_generator(
-            enable_read_arguments_from_commandline=False,
-            enable_save_variables_to_json=False,
-            enable_save_variables_to_sh=False,
-            ):
-
-            step_id = step['id']
-            count = step['count']
-            bash = step['bash']
-            step_inter_id = '{}__{}'.format(step_id, str(count))
-            all_step_inter_ids.append(step_inter_id)
-            step_inter_ids.append(step_inter_id)
-            step_vars_filename = self.create_step_vars_filename(step_inter_id) # os.path.join('${OBC_WORK_PATH}', step_inter_id + '.sh')
-
-            run_afters[step_inter_id] = ['RULEOBCINIT'] + tool_ids
-            if step['run_after']:
-                run_afters[step_inter_id] += step['run_after']
-
-            # Add declare. This should be first
-            bash = self.workflow.declare_decorate_bash(bash, step_vars_filename)
-
-            # Add all variables from previous tools
-            load_tool_vars = ''
-            for tool_filename in previous_tools:
-                load_tool_vars += '. {}\n'.format(tool_filename)
-            
-            # Load all variables from previous steps
-            load_step_vars = ''
-            if step['run_after']:
-                for run_after_step in step['run_after']:
-                    load_step_vars += '. {}\n'.format(self.create_step_vars_filename(run_after_step))
-            
-            bash = self.initial_variabes() + load_tool_vars + self.load_file_with_input_parameters() + load_step_vars + self.load_obc_functions_bash + bash
-
-            previous_steps_vars.append(step_vars_filename)
-
-            snakemake_rules[step_inter_id] = {'BASH': bash}
+        # CREATE TOOL AND STEP OPERATORS Snakemake
+        for node in compiled.tools + compiled.steps:
+            snakemake_rules[node['id']] = {'BASH': self.initial_variabes() + node['bash']}
 
         # Create final step snakemake
-        bash = self.initial_variabes() + self.obc_final_step(previous_tools, previous_steps_vars) 
+        bash = self.initial_variabes() + compiled.final_bash
 
         snakemake_rules['RULEOBCFINAL'] = {'BASH': bash}
-        
-        run_afters['RULEOBCFINAL'] = ['RULEOBCINIT'] + tool_ids + all_step_inter_ids 
-        #print (run_afters)
 
         # Create the DAGS part of the YAML
         rules = [SnakemakeExecutor.RULE_TEMPLATE.format(
@@ -3240,10 +3356,7 @@ rule {RULE_ID}:
             OUTPUT = SnakemakeExecutor.create_input_output('output', []),
             SHELL = '',
         )]
-        DAG = self.transitive_reduction(run_afters)
-        for node in DAG.nodes():
-            predecessors = list(DAG.predecessors(node))
-            #successors = list(DAG.successors(node))
+        for node, predecessors, _ in compiled.dag_nodes('RULEOBCINIT', 'RULEOBCFINAL'):
 
             rules.append(SnakemakeExecutor.RULE_TEMPLATE.format(
                 RULE_ID=node,
@@ -3258,12 +3371,36 @@ rule {RULE_ID}:
 
         return snakemake
 
-def create_bash_script(workflow_object, server, output_format, workflow_id=None, obc_client=False):
+# key of the workflow object --> Workflow (with its CompiledWorkflow). See get_compiled_workflow
+workflow_cache = LRUCache(maxsize=32)
+
+def get_compiled_workflow(workflow_object, server, workflow_id):
+    '''
+    The Workflow (askinput='NO') of the CWL, Airflow, Argo, Nextflow and Snakemake executors.
+    It is kept in workflow_cache, so when more than one format of the same workflow is requested, the workflow is parsed and compiled only once.
+    Without a workflow_id the nice id is random, so it is not cached.
+    '''
+
+    if not workflow_id:
+        return Workflow(workflow_object = workflow_object, askinput='NO', obc_server=server, workflow_id=workflow_id)
+
+    key = hashlib.sha1(json.dumps([workflow_object, server, workflow_id], sort_keys=True).encode('utf-8')).hexdigest()
+    w = workflow_cache.get(key)
+    if w is None:
+        w = Workflow(workflow_object = workflow_object, askinput='NO', obc_server=server, workflow_id=workflow_id)
+        w.compiled = BaseExecutor(w).compile()
+        workflow_cache.set(key, w)
+
+    return w
+
+def create_bash_script(workflow_object, server, output_format, workflow_id=None, obc_client=False, stream=False, report_batch=False):
     '''
     convenient function called by server
     server: the server to report to
     workflow_id: The ID of the workflow. Used in airflow
     obc_client: True/False. Do we have to generate a script for the obc client?
+    stream: True/False. Return the archive (cwltargz, cwlzip) as a generator of chunks
+    report_batch: True/False. The sh script reports its status in batches (see LocalExecutor)
     '''
 
     args = type('A', (), {
@@ -3278,26 +3415,26 @@ def create_bash_script(workflow_object, server, output_format, workflow_id=None,
 
     if output_format == 'sh':
         w = Workflow(workflow_object = workflow_object, askinput='BASH', obc_server=server)
-        e = LocalExecutor(w)
+        e = LocalExecutor(w, report_batch=report_batch)
         return e.build(output=None)
     elif output_format in ['cwltargz', 'cwlzip']:
-        w = Workflow(workflow_object = workflow_object, askinput='NO', obc_server=server, workflow_id=workflow_id)
+        w = get_compiled_workflow(workflow_object, server, workflow_id)
         e = CWLExecutor(w)
-        return e.build(output=None, output_format=output_format, workflow_id=workflow_id)
+        return e.build(output=None, output_format=output_format, workflow_id=workflow_id, stream=stream)
     elif output_format in ['airflow']:
-        w = Workflow(workflow_object = workflow_object, askinput='NO', obc_server=server, workflow_id=workflow_id)
+        w = get_compiled_workflow(workflow_object, server, workflow_id)
         e = AirflowExecutor(w)
         return e.build(output=None, output_format='airflow', workflow_id=workflow_id, obc_client=obc_client)
     elif output_format in ['argo']:
-        w = Workflow(workflow_object = workflow_object, askinput='NO', obc_server=server, workflow_id=workflow_id)
+        w = get_compiled_workflow(workflow_object, server, workflow_id)
         e = ArgoExecutor(w)
         return e.build(output=None, output_format='argo', workflow_id=workflow_id, obc_client=obc_client)
     elif output_format in ['nextflow']:
-        w = Workflow(workflow_object = workflow_object, askinput='NO', obc_server=server, workflow_id=workflow_id)
+        w = get_compiled_workflow(workflow_object, server, workflow_id)
         e = NextflowExecutor(w)
         return e.build(output=None, output_format='nextflow', workflow_id=workflow_id, obc_client=obc_client)
     elif output_format in ['snakemake']:
-        w = Workflow(workflow_object = workflow_object, askinput='NO', obc_server=server, workflow_id=workflow_id)
+        w = get_compiled_workflow(workflow_object, server, workflow_id)
         e = SnakemakeExecutor(w)
         return e.build(output=None, output_format='snakemake', workflow_id=workflow_id, obc_client=obc_client)
 
@@ -3332,6 +3469,7 @@ if __name__ == '__main__':
         default='sh')
     parser.add_argument('-O', '--output', dest='output', help='The output filename. default is script.sh, workflow.cwl and workflow.tar.gz, depending on the format', default='script')
     parser.add_argument('--insecure', dest='insecure', help="Pass insecure option (-k) to curl", default=False, action="store_true")
+    parser.add_argument('--report-batch', dest='report_batch', help="sh: Report the status to the server in batches, from a background process", default=False, action="store_true")
     parser.add_argument('--silent', dest='silent', help="Do not print logging info", default=False, action="store_true")
     parser.add_argument('--askinput', dest='askinput', 
         help="Where to get input parameters from. Available options are: 'JSON', during convert JSON to BASH, 'BASH' ask for input in bash, 'NO' do not ask for input.", 
@@ -3362,7 +3500,7 @@ if __name__ == '__main__':
     w = Workflow(args.workflow_filename, askinput=args.askinput)
 
     if args.format == 'sh':
-        e = LocalExecutor(w)
+        e = LocalExecutor(w, report_batch=args.report_batch)
         if args.output == 'script':
             args.output = 'script.sh'
         e.build(output = args.output)
@@ -70,6 +70,21 @@ except ImportError:
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# The cached tool / workflow details (app/detail_cache.py) are invalidated on every change.
+# The invalidations come from the web server and from scripts/workflow_update_worker.py, which is another process.
+# So the cache must be shared by all processes: The default is a directory. With more than one host use a shared cache (i.e. memcached or redis).
+# A per process cache (LocMemCache) would serve stale documents for up to TIMEOUT seconds.
+try:
+	from .obc_private import CACHES
+except ImportError:
+	CACHES = {
+		'default': {
+			'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+			'LOCATION': os.path.join(BASE_DIR, 'cache'),
+			'TIMEOUT': 300,
+		}
+	}
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.1/howto/deployment/checklist/
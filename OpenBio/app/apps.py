@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class AppConfig(AppConfig):
     name = 'app'
+
+    def ready(self):
+        # Connect the signals that maintain the search index
+        import app.search
+        # Connect the signals that invalidate the cached tool / workflow details
+        import app.detail_cache
@@ -0,0 +1,75 @@
+'''
+Cache of the compiled workflows (BASH, CWL, Airflow, ...) that download_workflow and the REST API return.
+
+The key is made from everything that the output depends on: the workflow (pk, edit and a hash of its graph),
+the format, the input parameters, the workflow_id, obc_client and the server url.
+Since the graph is part of the key, a changed workflow gets a new key. Nothing needs to be invalidated.
+
+Outputs that contain a report token (see download_workflow) or random ids (see is_cacheable) are different for every download and are not cached.
+The cache backend is settings.CACHES . The key is also used as the ETag of the REST API (see rest_views.workflow_complete)
+'''
+
+import hashlib
+
+import simplejson
+
+from django.core.cache import cache
+
+# Increase this when the output of the executor changes
+VERSION = 6
+
+# Seconds. The key of a changed workflow changes, so this only limits the size of the cache
+TIMEOUT = 60 * 60 * 24
+
+def is_cacheable(download_type, workflow_id):
+    '''
+    Is the output of the executor the same every time?
+    Without a workflow_id the executor puts a random nice id in the output (executor.Workflow.nice_id_local).
+    BASH always uses a random nice id (create_bash_script does not pass the workflow_id to the sh Workflow).
+    Snakemake always uses a random done directory (executor.SnakemakeExecutor.RANDOM_ID)
+    '''
+    if download_type == 'JSON':
+        return True
+
+    return bool(workflow_id) and not download_type in ['BASH', 'SNAKEMAKE']
+
+def get_key(workflow, download_type, arguments, workflow_id, obc_client, server_url):
+    '''
+    workflow is a database Workflow object
+    '''
+    content = simplejson.dumps([
+        VERSION,
+        workflow.pk,
+        workflow.edit,
+        hashlib.md5(workflow.workflow.encode('utf-8')).hexdigest(),
+        download_type,
+        arguments,
+        workflow_id,
+        bool(obc_client),
+        server_url,
+    ], sort_keys=True)
+
+    return 'workflow_artifact_' + hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def get_artifact(key):
+    '''
+    None if it is not cached. str or bytes (CWLTARGZ, CWLZIP)
+    '''
+    return cache.get(key)
+
+def set_artifact(key, artifact):
+    cache.set(key, artifact, TIMEOUT)
+
+def stream_artifact(key, chunks):
+    '''
+    Yield the chunks of an artifact (see executor.BaseExecutor.stream_targz) and cache it after the last one.
+    key is None: do not cache it 
+    '''
+    parts = []
+    for chunk in chunks:
+        if key:
+            parts.append(chunk)
+        yield chunk
+
+    if key:
+        set_artifact(key, b''.join(parts))
@@ -0,0 +1,68 @@
+'''
+Cache of the tool and workflow detail documents (what tools_search_3 and workflows_search_3 return).
+The documents do not contain anything user specific. views.py adds the votes of the user at request time.
+The cache backend is settings.CACHES .
+
+A document is deleted from the cache (with the signals at the end of this file) when anything that it shows changes:
+* Tool: its fields, its variables, its dependencies (the tools that depend on it show it in their dependencies tree), its validation (callback), its votes.
+* Workflow: its fields (also the graph that WorkflowJSON updates), its votes.
+* Comment: the thread of the tool / workflow. Comment votes change the upvotes/downvotes of the comment.
+All these are saved with .save() after they change (see tools_add, workflows_add, ro_finalize_delete, callback, updownvote_*, qa_add_comment, ...)
+'''
+
+import hashlib
+
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from app.models import Tool, Workflow, Comment
+
+def tool_key(name, version, edit):
+    '''
+    Tools are searched with iexact, so the key is lower case
+    '''
+    return 'tool_detail_' + hashlib.md5('/'.join([name.lower(), version.lower(), str(edit)]).encode('utf-8')).hexdigest()
+
+def workflow_key(name, edit):
+    '''
+    See tool_key
+    '''
+    return 'workflow_detail_' + hashlib.md5('/'.join([name.lower(), str(edit)]).encode('utf-8')).hexdigest()
+
+def get_document(key):
+    '''
+    None if it is not cached
+    '''
+    return cache.get(key)
+
+def set_document(key, document):
+    cache.set(key, document)
+
+def invalidate_workflows(workflows):
+    '''
+    For updates that do not send post_save (i.e. bulk_update)
+    '''
+    cache.delete_many([workflow_key(workflow.name, workflow.edit) for workflow in workflows])
+
+@receiver(post_save, sender=Tool)
+@receiver(post_delete, sender=Tool)
+def detail_cache_tool(sender, instance, **kwargs):
+    # This tool and all the tools that depend on it
+    keys = [tool_key(instance.name, instance.version, instance.edit)]
+    keys.extend(tool_key(*x) for x in Tool.objects.filter(closure_related__dependency_id=instance.pk).values_list('name', 'version', 'edit'))
+    cache.delete_many(keys)
+
+@receiver(post_save, sender=Workflow)
+@receiver(post_delete, sender=Workflow)
+def detail_cache_workflow(sender, instance, **kwargs):
+    cache.delete(workflow_key(instance.name, instance.edit))
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def detail_cache_comment(sender, instance, **kwargs):
+    # The tool / workflow of this thread
+    root_pk = instance.root_id or instance.pk
+    keys = [tool_key(*x) for x in Tool.objects.filter(comment_id=root_pk).values_list('name', 'version', 'edit')]
+    keys.extend(workflow_key(*x) for x in Workflow.objects.filter(comment_id=root_pk).values_list('name', 'edit'))
+    cache.delete_many(keys)
@@ -1,11 +1,16 @@
 from django.db import models
+from django.db import transaction
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 import re
 import uuid
+import datetime
 import random
 import string
 
+from collections import defaultdict
+
 '''
 After making changes here run:
 python manage.py makemigrations
@@ -201,6 +206,72 @@ class Tool(models.Model):
     comment = models.ForeignKey(to='Comment', null=True, on_delete=models.CASCADE, related_name='tool_comment') # The comments of the tool
     
 
+class ToolClosure(models.Model):
+    '''
+    The transitive closure of Tool.dependencies
+    There is one row for every tool and every tool that it depends on (directly or not).
+    This allows to get all the dependencies of a tool in one query.
+    '''
+
+    class Meta:
+        '''
+        https://docs.djangoproject.com/en/2.1/ref/models/options/#unique-together
+        '''
+        unique_together = (('tool', 'dependency'),)
+
+    @staticmethod
+    def update(tools=None):
+        '''
+        Recompute the closure of these tools and of all the tools that depend on them.
+        Call this after the dependencies of a tool change (see views.tools_add)
+        tools=None recomputes the closure of all tools (see scripts/migrate_5.py) 
+        Deleted tools do not need this, their rows are deleted in cascade.
+        '''
+
+        edges = Tool.dependencies.through.objects.all()
+        existing = ToolClosure.objects.all()
+
+        if tools is None:
+            affected = set(Tool.objects.values_list('pk', flat=True))
+        else:
+            tool_pks = {tool.pk for tool in tools}
+            # The tools that depend on these tools, directly or not. 
+            # The closure of the direct dependants might not be up to date, so also get them from the dependencies
+            dependant_pks = set(edges.filter(to_tool_id__in=tool_pks).values_list('from_tool_id', flat=True))
+            affected = tool_pks | dependant_pks | set(existing.filter(dependency_id__in=tool_pks | dependant_pks).values_list('tool_id', flat=True))
+            edges = edges.filter(from_tool_id__in=affected)
+            existing = existing.filter(tool_id__in=affected)
+
+        dependencies = defaultdict(list)
+        for from_pk, to_pk in edges.values_list('from_tool_id', 'to_tool_id'):
+            dependencies[from_pk].append(to_pk)
+
+        # The closure of the dependencies that are not affected is correct
+        closure = defaultdict(set)
+        not_affected = {to_pk for from_pk in affected for to_pk in dependencies[from_pk] if not to_pk in affected}
+        for tool_pk, dependency_pk in ToolClosure.objects.filter(tool_id__in=not_affected).values_list('tool_id', 'dependency_id'):
+            closure[tool_pk].add(dependency_pk)
+
+        computed = set(not_affected)
+        def compute(tool_pk):
+            if tool_pk in computed:
+                return closure[tool_pk]
+            computed.add(tool_pk) # Before the recursion. Protects from circular dependencies
+            for dependency_pk in dependencies[tool_pk]:
+                closure[tool_pk].add(dependency_pk)
+                closure[tool_pk].update(compute(dependency_pk))
+            return closure[tool_pk]
+
+        with transaction.atomic():
+            existing.delete()
+            ToolClosure.objects.bulk_create([
+                ToolClosure(tool_id=tool_pk, dependency_id=dependency_pk)
+                for tool_pk in affected for dependency_pk in compute(tool_pk) if dependency_pk != tool_pk
+            ], batch_size=500)
+
+    tool = models.ForeignKey(Tool, null=False, on_delete=models.CASCADE, related_name='closure_related')
+    dependency = models.ForeignKey(Tool, null=False, on_delete=models.CASCADE, related_name='closure_dependants_related')
+
 class ToolValidations(models.Model):
     '''
     This is like a log entry.
@@ -290,6 +361,70 @@ class Workflow(models.Model):
     draft = models.BooleanField() # Is this a draft Workflow?
     comment = models.ForeignKey(to='Comment', null=True, on_delete=models.CASCADE, related_name='workflow_comment') # The comments of the tool
 
+class WorkflowUpdateJob(models.Model):
+    '''
+    A background job that updates the graphs of the workflows that use an edited / finalized tool or workflow (see views.WorkflowJSON)
+    tools_add, workflows_add and ro_finalize_delete create the jobs. scripts/workflow_update_worker.py runs them.
+    A running job updates updated_at when it is claimed and when it reports progress. 
+    If this does not happen for STALE_AFTER, its worker has crashed or was killed and the job is queued again (see requeue_stale)
+    '''
+
+    STALE_AFTER = datetime.timedelta(minutes=10)
+
+    TOOL = 'tool'
+    WORKFLOW = 'workflow'
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    @staticmethod
+    def enqueue(ro, obj):
+        '''
+        ro: 'tool' or 'workflow'. obj: the Tool or Workflow
+        If there is already a queued job for this object, return this one
+        '''
+        job = WorkflowUpdateJob.objects.filter(ro=ro, object_pk=obj.pk, status=WorkflowUpdateJob.QUEUED).first()
+        if job is None:
+            job = WorkflowUpdateJob.objects.create(ro=ro, object_pk=obj.pk)
+        return job
+
+    def claim(self,):
+        '''
+        Mark a queued job as running. 
+        Returns False if another worker got it first.
+        '''
+        return WorkflowUpdateJob.objects.filter(pk=self.pk, status=WorkflowUpdateJob.QUEUED).update(status=WorkflowUpdateJob.RUNNING, updated_at=timezone.now()) == 1
+
+    @staticmethod
+    def requeue_stale():
+        '''
+        Queue again the running jobs that have not been updated for STALE_AFTER. 
+        Returns the number of these jobs
+        '''
+        now = timezone.now()
+        return WorkflowUpdateJob.objects.filter(
+            status=WorkflowUpdateJob.RUNNING, 
+            updated_at__lt=now - WorkflowUpdateJob.STALE_AFTER,
+        ).update(status=WorkflowUpdateJob.QUEUED, updated_at=now)
+
+    ro = models.CharField(max_length=16) # tool or workflow
+    object_pk = models.IntegerField() # The pk of the tool or workflow
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    progress = models.IntegerField(default=0) # Number of workflows updated so far
+    total = models.IntegerField(default=0) # Number of workflows to update
+    error = models.TextField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
 class ReportToken(models.Model):
     '''
     Each report has multiple Tokens 
@@ -326,18 +461,31 @@ class ReportToken(models.Model):
         (STEP_FINISHED_CODE, STEP_FINISHED),
     )
 
+    # All STATUS_CHOICES in one compiled pattern. Every choice is a group named status_<code> and its fields are renamed to status_<code>_<field>
+    STATUS_RE = re.compile('|'.join(
+        '(?P<status_{code}>{status_re})'.format(code=status_code, status_re=status_re.replace('(?P<', '(?P<status_{}_'.format(status_code)))
+        for status_code, status_re in STATUS_CHOICES
+    ))
+
+    # status_<code> --> (code, [(group name, field)])
+    STATUS_GROUPS = {
+        'status_{}'.format(status_code): (status_code, [('status_{}_{}'.format(status_code, field), field) for field in re.compile(status_re).groupindex])
+        for status_code, status_re in STATUS_CHOICES
+    }
+
     @staticmethod
     def parse_response_status(status):
         '''
         Used from views.report to parse the received status
+        Returns None if the status is unknown
         '''
-        for status_code, status_re in ReportToken.STATUS_CHOICES:
-            m = re.match(status_re, status)
-            if m:
-                return {'status_code': status_code, 'status_fields': m.groupdict()}
+        m = ReportToken.STATUS_RE.match(status)
+        if not m:
+            return None
 
-        # We don't need this here to return None, left for readability
-        return None
+        # The choice that matched is the last group that closed
+        status_code, groups = ReportToken.STATUS_GROUPS[m.lastgroup]
+        return {'status_code': status_code, 'status_fields': {field: m.group(group) for group, field in groups}}
             
 
 
@@ -381,6 +529,70 @@ class Report(models.Model):
     tokens = models.ManyToManyField(ReportToken, related_name='report_related')
     created_at = models.DateTimeField(auto_now_add=True)
 
+class ReportEvent(models.Model):
+    '''
+    One status of a Report (see views.report and views.report_batch). Append only.
+    The status is stored parsed (ReportToken.parse_response_status). The tokens are only used to authenticate the executor.
+    To create the events of the reports before this table, run: python scripts/backfill_report_events.py
+    '''
+
+    # status_code --> the start of the status (ReportToken.STATUS_CHOICES)
+    STATUS_PREFIX = {
+        ReportToken.WORKFLOW_STARTED_CODE: 'workflow started',
+        ReportToken.WORKFLOW_FINISHED_CODE: 'workflow finished',
+        ReportToken.TOOL_STARTED_CODE: 'tool started',
+        ReportToken.TOOL_FINISHED_CODE: 'tool finished',
+        ReportToken.STEP_STARTED_CODE: 'step started',
+        ReportToken.STEP_FINISHED_CODE: 'step finished',
+    }
+
+    class Meta:
+        indexes = [
+                models.Index(
+                    fields=['report', 'created_at',],
+                    name='ReportEvent_idx',
+                ),
+            ]
+
+    report = models.ForeignKey(Report, null=False, on_delete=models.CASCADE, related_name='events')
+    status_code = models.PositiveSmallIntegerField(choices=[(code, prefix) for code, prefix in STATUS_PREFIX.items()])
+    name = models.CharField(max_length=255) # The workflow, tool or step
+    caller = models.CharField(max_length=255, null=True) # Only for STEP_STARTED
+    created_at = models.DateTimeField(default=timezone.now) # Not auto_now_add, so that scripts/backfill_report_events.py can keep the time of the old statuses
+
+    @staticmethod
+    def from_status(report, status):
+        '''
+        An (unsaved) event from a status that the executor sends. None if the status is unknown
+        report can be None and set before saving (see views.report_save_events)
+        '''
+        status_fields = ReportToken.parse_response_status(status)
+        if status_fields is None:
+            return None
+
+        return ReportEvent(
+            report=report, 
+            status_code=status_fields['status_code'], 
+            name=status_fields['status_fields']['name'], 
+            caller=status_fields['status_fields'].get('caller'),
+        )
+
+    @property
+    def status(self):
+        '''
+        The status as the executor sent it
+        '''
+        return ' '.join([self.STATUS_PREFIX[self.status_code], self.name] + ([self.caller] if self.caller else []))
+
+    def status_fields(self):
+        '''
+        Same as ReportToken.parse_response_status(self.status)
+        '''
+        fields = {'name': self.name}
+        if self.status_code == ReportToken.STEP_STARTED_CODE:
+            fields['caller'] = self.caller
+        return {'status_code': self.status_code, 'status_fields': fields}
+
 class ReferenceField(models.Model):
     '''
     This is a tuple of keys/values that come from parsing the BIBTEX entry
@@ -442,6 +654,29 @@ class Comment(models.Model):
     upvotes = models.IntegerField() # Number of upvotes
     downvotes = models.IntegerField() # Number of downvotes
 
+    # Denormalized position in the thread. Set on insert (see save). For old comments run scripts/migrate_4.py
+    root = models.ForeignKey(to='Comment', null=True, on_delete=models.CASCADE, related_name='comment_root') # The root comment of the thread. None if this is the root
+    depth = models.IntegerField(default=0) # 0 for the root
+    path = models.TextField(default='') # The pks of the ancestors, starting from the root. i.e. '12/34/' 
+
+    def thread_path(self,):
+        '''
+        The path of the children of this comment.
+        All comments of the subthread of this comment have a path that starts with this.
+        '''
+        return '{}{}/'.format(self.path, self.pk)
+
+    def save(self, *args, **kwargs):
+        '''
+        Set root, depth, path when the comment is inserted 
+        '''
+        if self._state.adding and self.parent:
+            self.root_id = self.parent.root_id or self.parent.pk
+            self.depth = self.parent.depth + 1
+            self.path = self.parent.thread_path()
+
+        super().save(*args, **kwargs)
+
 
 class UpDownCommentVote(models.Model):
     '''
@@ -516,3 +751,51 @@ class UpDownWorkflowVote(models.Model):
 
 
 
+
+class SearchEntry(models.Model):
+    '''
+    One searchable object of the main search (all_search_2).
+    Together with SearchGram this is an inverted (trigram) index.
+    It is maintained by the signals in app/search.py. To rebuild it from scratch run:
+    python scripts/rebuild_search_index.py
+    '''
+
+    TOOL = 'tool'
+    WORKFLOW = 'workflow'
+    REFERENCE = 'reference'
+    USER = 'user'
+    QA = 'qa'
+
+    TYPE_CHOICES = (
+        (TOOL, TOOL),
+        (WORKFLOW, WORKFLOW),
+        (REFERENCE, REFERENCE),
+        (USER, USER),
+        (QA, QA),
+    )
+
+    class Meta:
+        '''
+        https://docs.djangoproject.com/en/2.1/ref/models/options/#unique-together
+        '''
+        unique_together = (('object_type', 'object_pk'),)
+
+    object_type = models.CharField(choices=TYPE_CHOICES, max_length=20)
+    object_pk = models.IntegerField() # The pk of the indexed Tool, Workflow, ...
+    title = models.TextField() # Normalized main field (name, username, title). Used for ranking
+    text = models.TextField() # Normalized concatenation of all searchable fields
+    parent_pk = models.IntegerField(null=True) # The pk of the object that this was forked from (for comments: the root of the thread). Used to build result trees
+
+class SearchGram(models.Model):
+    '''
+    One trigram of a SearchEntry
+    '''
+
+    class Meta:
+        '''
+        The unique index starts with gram, so this is also the lookup index
+        '''
+        unique_together = (('gram', 'entry'),)
+
+    gram = models.CharField(max_length=3)
+    entry = models.ForeignKey(SearchEntry, null=False, on_delete=models.CASCADE, related_name='grams')
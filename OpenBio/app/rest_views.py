@@ -11,8 +11,11 @@ from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.renderers import BaseRenderer, JSONRenderer, BrowsableAPIRenderer
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import parse_etags, quote_etag
 
-from .views import download_workflow # Import from main views
+from .views import download_workflow, download_workflow_creates_report, get_server_url # Import from main views
+from . import artifact_cache
 
 import re
 import simplejson
@@ -113,6 +116,23 @@ class CustomBrowsableAPIRenderer(BrowsableAPIRenderer):
 def return_binary(format_):
     return format_ in ['CWLTARGZ', 'CWLZIP']
 
+def download_workflow_args(workflow, format_, workflow_id, input_parameters, do_url_quote, return_bytes, stream=False, report_batch=False):
+    '''
+    The arguments of views.download_workflow for a saved workflow
+    '''
+    return {
+        'workflow': {'name': workflow.name, 'edit': workflow.edit},
+        'workflow_info_editable': False, # This workflow is saved 
+        'download_type': format_,
+        'workflow_id': workflow_id,
+        'obc_client': True, # Declare that we need an airflow DAG explicitly for the OBC client
+        'workflow_options': input_parameters, # Workflow options (input parameters) . An interesting idea is to get them from the REST API. DONE. see #196
+        'do_url_quote': do_url_quote, # In case of binary Do not url encode objects . We need the bytes object
+        'return_bytes': return_bytes, # Return bytes ?
+        'stream': stream, # Return an iterator of bytes (binary only)
+        'report_batch': report_batch, # BASH only. Report the status in batches (see views.report_batch)
+    }
+
 class WorkflowSerializerDAG(serializers.BaseSerializer):
     '''
     Returns a Workflow for execution in various formats
@@ -130,6 +150,9 @@ class WorkflowSerializerDAG(serializers.BaseSerializer):
     def set_workflow_input_parameters(self, input_parameters):
         self.input_parameters = input_parameters
 
+    def set_report_batch(self, report_batch):
+        self.report_batch = report_batch
+
     def to_representation(self, instance):
         '''
         Call run_workflow to get a dag representation of the workflow
@@ -150,16 +173,7 @@ class WorkflowSerializerDAG(serializers.BaseSerializer):
             return_bytes = False
 
         # instance is the workflow object
-        args = {
-            'workflow': {'name': instance.name, 'edit': instance.edit},
-            'workflow_info_editable': False, # This workflow is saved 
-            'download_type': self.format_,
-            'workflow_id': self.workflow_id,
-            'obc_client': True, # Declare that we need an airflow DAG explicitly for the OBC client
-            'workflow_options': self.input_parameters, # Workflow options (input parameters) . An interesting idea is to get them from the REST API. DONE. see #196
-            'do_url_quote': do_url_quote, # In case of binary Do not url encode objects . We need the bytes object
-            'return_bytes': return_bytes, # Return bytes ?
-        }
+        args = download_workflow_args(instance, self.format_, self.workflow_id, self.input_parameters, do_url_quote, return_bytes, report_batch=self.report_batch)
 
         returned_object = download_workflow(self.request, **args)
         if ret_binary:
@@ -220,6 +234,9 @@ def workflow_complete(request, workflow_name, workflow_edit):
         # /?workflow_id=xyz
         workflow_id = request.query_params.get('workflow_id')
 
+        # /?report_batch=true . BASH: The script reports its status in batches (only if the download creates a report)
+        report_batch = request.query_params.get('report_batch', '').lower() in ['1', 'true']
+
         try:
             workflow = Workflow.objects.get(name=workflow_name, edit=int(workflow_edit))
         except ObjectDoesNotExist as e:
@@ -235,22 +252,43 @@ def workflow_complete(request, workflow_name, workflow_edit):
 
 
         
+        # If the output does not contain a report token, it is cached. The cache key is the ETag
+        headers = {}
+        if not download_workflow_creates_report(request, workflow) and artifact_cache.is_cacheable(format_, workflow_id):
+            etag = quote_etag(artifact_cache.get_key(workflow, format_, input_parameters, workflow_id, True, get_server_url(request)))
+            headers['ETag'] = etag
+            if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+            if etag in if_none_match or '*' in if_none_match:
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        if return_binary(format_):
+            # Stream the archive. No serializer / renderer
+            chunks = download_workflow(request, **download_workflow_args(workflow, format_, workflow_id, input_parameters, False, True, stream=True))
+            if isinstance(chunks, HttpResponse):
+                return chunks # This is a fail() response
+
+            if format_ == 'CWLTARGZ':
+                response = StreamingHttpResponse(chunks, content_type=BinaryRenderer_TARGZ.media_type)
+                response['Content-Disposition'] = 'attachment; filename=workflow.tar.gz'
+            else:
+                response = StreamingHttpResponse(chunks, content_type=BinaryRenderer_ZIP.media_type)
+                response['Content-Disposition'] = 'attachment; filename=workflow.zip'
+            for header, value in headers.items():
+                response[header] = value
+            return response
+
         serializer = WorkflowSerializerDAG(workflow, many=False)
         serializer.set_request(request)
         serializer.set_workflow_id(workflow_id)
         serializer.set_workflow_format(format_)
         serializer.set_workflow_input_parameters(input_parameters)
+        serializer.set_report_batch(report_batch)
 
-        filename = None
-        if format_ == 'CWLTARGZ':
-            filename = 'workflow.tar.gz'
-        elif format_ == 'CWLZIP':
-            filename = 'workflow.zip'
+        data = serializer.data
+        if not data.get('success'):
+            headers.pop('ETag', None) # Errors are not cached
 
-        if filename:
-            return Response(serializer.data, headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
-        else:
-            return Response(serializer.data)
+        return Response(data, headers=headers)
 
     else:
         return Response(status=status.HTTP_404_NOT_FOUND)
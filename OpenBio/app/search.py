@@ -0,0 +1,222 @@
+'''
+The search index of the main search (all_search_2).
+
+Every Tool, Workflow, Reference, OBC_user and Comment has a SearchEntry with
+the normalized text of its searchable fields. Every entry has one SearchGram
+per distinct trigram of this text. Words are padded like pg_trgm does:
+'cat' --> '  c', ' ca', 'cat', 'at '
+so a search only visits the entries that contain all the trigrams of the query,
+instead of running icontains over the whole tables.
+Matching, ranking, counting and paging all happen in the database (see match).
+Queries with only short words match the start of the title, since their trigrams are in almost every entry.
+
+The index is updated on save and delete with the signals at the end of this file.
+To rebuild it run: python scripts/rebuild_search_index.py
+'''
+
+import re
+
+from django.db import transaction
+from django.db.models import Count, Case, When, Value, IntegerField, Max, Min
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.html import strip_tags
+
+from app.models import SearchEntry, SearchGram, Tool, Workflow, Reference, OBC_user, Comment
+
+def normalize(text):
+    '''
+    Lower case, single spaces
+    '''
+    return ' '.join(text.lower().split())
+
+def get_words(text):
+    '''
+    The words of a normalized text
+    '''
+    return re.findall(r'\w+', text)
+
+def text_grams(text):
+    '''
+    All (padded) trigrams of a normalized text
+    '''
+    ret = set()
+    for word in get_words(text):
+        padded = '  ' + word + ' '
+        ret.update(padded[i:i+3] for i in range(len(padded)-2))
+    return ret
+
+def query_grams(words):
+    '''
+    The trigrams that an entry must have in order to match the query words.
+    Words with less than 3 characters match the start of a word.
+    '''
+    ret = set()
+    for word in words:
+        if len(word) < 3:
+            ret.add(('  ' + word)[-3:])
+        else:
+            ret.update(word[i:i+3] for i in range(len(word)-2))
+    return ret
+
+def rank_expression(query):
+    '''
+    The rank of a matching entry. Higher is better:
+    4: the title is the query, 3: the title starts with the query, 2: the title contains the query, 1: the text contains the query
+    '''
+    return Case(
+        When(title=query, then=Value(4)),
+        When(title__startswith=query, then=Value(3)),
+        When(title__contains=query, then=Value(2)),
+        When(text__contains=query, then=Value(1)),
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+def match(query, object_type, queryset):
+    '''
+    Search the objects of queryset (which should be a queryset of object_type)
+    Returns the matching SearchEntries (a queryset annotated with rank), best first. Ties are in order of object_pk.
+    If the query is empty, every object of the queryset matches (in order of pk)
+    If all the words of the query are shorter than g['min_word_length'], only the entries whose title starts with the query match.
+    '''
+
+    query = normalize(query)
+    words = get_words(query)
+
+    entries = SearchEntry.objects.filter(
+        object_type=object_type,
+        object_pk__in=queryset.values('pk'),
+    )
+
+    if not words:
+        return entries.annotate(rank=Value(0, output_field=IntegerField())).order_by('object_pk')
+
+    if max(len(word) for word in words) < g['min_word_length']:
+        entries = entries.filter(title__startswith=query)
+    else:
+        grams = query_grams(words)
+        matching_entries = SearchGram.objects.filter(
+            gram__in=grams,
+            entry__object_type=object_type,
+        ).values('entry').annotate(grams_number=Count('gram', distinct=True)).filter(grams_number=len(grams)).values('entry')
+
+        entries = entries.filter(pk__in=matching_entries)
+        for word in words:
+            entries = entries.filter(text__contains=word) # The trigrams matched. The words should also match
+
+    return entries.annotate(rank=rank_expression(query)).order_by('-rank', 'object_pk')
+
+def search(query, object_type, queryset, limit):
+    '''
+    Returns the total number of matches and the pks of the best <limit> matches (ranked)
+    '''
+    matches = match(query, object_type, queryset)
+    return matches.count(), list(matches.values_list('object_pk', flat=True)[:limit])
+
+def search_roots(query, object_type, queryset, limit):
+    '''
+    As search, but every match counts for its root: its parent_pk (or its pk if it has no parent). Used for Q&A threads.
+    A root is ranked by its best match.
+    '''
+    roots = match(query, object_type, queryset).annotate(
+        root=Coalesce('parent_pk', 'object_pk'),
+    ).order_by().values('root').annotate(best=Max('rank'), first=Min('object_pk')).order_by('-best', 'first')
+
+    return roots.count(), [x['root'] for x in roots[:limit]]
+
+### DOCUMENTS
+
+'''
+Each document function returns: title, list of searchable fields, parent pk
+'''
+
+def tool_document(tool):
+    return tool.name, [tool.name, tool.obc_user.user.username], tool.forked_from_id
+
+def workflow_document(workflow):
+    return workflow.name, [workflow.name, workflow.obc_user.user.username], workflow.forked_from_id
+
+def reference_document(reference):
+    return reference.name, [reference.name, strip_tags(reference.html or ''), reference.obc_user.user.username], None
+
+def user_document(obc_user):
+    return obc_user.user.username, [obc_user.user.username, obc_user.affiliation, obc_user.public_info], None
+
+def qa_document(comment):
+    # The search results are threads, so store the root of the thread (None if this is the root)
+    return comment.title, [comment.title, comment.comment, comment.obc_user.user.username], comment.root_id
+
+g = {
+    'min_word_length': 3, # See match
+    # model --> (object_type, document function, select_related of the document function)
+    'documents': {
+        Tool: (SearchEntry.TOOL, tool_document, 'obc_user__user'),
+        Workflow: (SearchEntry.WORKFLOW, workflow_document, 'obc_user__user'),
+        Reference: (SearchEntry.REFERENCE, reference_document, 'obc_user__user'),
+        OBC_user: (SearchEntry.USER, user_document, 'user'),
+        Comment: (SearchEntry.QA, qa_document, 'obc_user__user'),
+    },
+}
+
+### INDEXING
+
+def index_object(obj):
+    '''
+    Add or update obj in the index
+    '''
+    object_type, document, _ = g['documents'][type(obj)]
+    title, fields, parent_pk = document(obj)
+    title = normalize(title or '')
+    text = normalize(' '.join(filter(None, fields)))
+
+    with transaction.atomic():
+        try:
+            entry = SearchEntry.objects.get(object_type=object_type, object_pk=obj.pk)
+        except SearchEntry.DoesNotExist:
+            entry = SearchEntry.objects.create(object_type=object_type, object_pk=obj.pk, title=title, text=text, parent_pk=parent_pk)
+        else:
+            if entry.title == title and entry.text == text and entry.parent_pk == parent_pk:
+                return # Nothing changed (i.e. this was a vote)
+            entry.title = title
+            entry.text = text
+            entry.parent_pk = parent_pk
+            entry.save()
+            entry.grams.all().delete()
+
+        SearchGram.objects.bulk_create([SearchGram(gram=gram, entry=entry) for gram in text_grams(text)])
+
+def unindex_object(obj):
+    '''
+    Remove obj from the index
+    '''
+    object_type, _, _ = g['documents'][type(obj)]
+    SearchEntry.objects.filter(object_type=object_type, object_pk=obj.pk).delete()
+
+def rebuild():
+    '''
+    Drop the index and index everything again
+    '''
+    SearchEntry.objects.all().delete()
+    for model, (_, _, related) in g['documents'].items():
+        for obj in model.objects.select_related(related):
+            index_object(obj)
+
+@receiver(post_save, sender=Tool)
+@receiver(post_save, sender=Workflow)
+@receiver(post_save, sender=Reference)
+@receiver(post_save, sender=OBC_user)
+@receiver(post_save, sender=Comment)
+def search_index_post_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return # Loading fixtures
+    index_object(instance)
+
+@receiver(post_delete, sender=Tool)
+@receiver(post_delete, sender=Workflow)
+@receiver(post_delete, sender=Reference)
+@receiver(post_delete, sender=OBC_user)
+@receiver(post_delete, sender=Comment)
+def search_index_post_delete(sender, instance, **kwargs):
+    unindex_object(instance)
@@ -851,6 +851,9 @@ app.controller("OBC_ctrl", function($scope, $sce, $http, $filter, $timeout, $log
             },
             function(data) {
 
+                // The tools / workflows trees are loaded one level at a time. Remember the search that created them.
+                $scope.main_search_jstree_query = $scope.main_search;
+
                 //Tools
                 $scope.tools_search_tools_number = data['tools_search_tools_number'];
                 angular.copy(data['tools_search_jstree'], $scope.tools_search_jstree_model);
@@ -888,6 +891,73 @@ app.controller("OBC_ctrl", function($scope, $sce, $http, $filter, $timeout, $log
         );
     };
 
+    /*
+    * Load a page of a level of the tools or workflows search tree
+    * what: 'tools' or 'workflows'
+    * parent_id: The jstree id of the parent node ('#' is the top level)
+    * cursor: Where the page starts 
+    * remove_id: The id of the node that is replaced by the results ("Loading.." or "More..")
+    */
+    $scope.search_jstree_level = function(what, parent_id, cursor, remove_id) {
+        var model = $scope[what + '_search_jstree_model'];
+        var parent_node = model.find(function(node) {return node.id === parent_id;});
+
+        $scope.ajax(
+            what + '_search_jstree_level/',
+            {
+                'main_search': $scope.main_search_jstree_query,
+                'parent': parent_node ? parent_node.data : null,
+                'cursor': cursor
+            },
+            function(data) {
+                var nodes = model.filter(function(node) {return node.id !== remove_id;});
+                if (parent_node) {
+                    parent_node.state = {opened: true}; // The tree is redrawn from the model. Keep the parent open.
+                }
+                angular.copy(nodes.concat(data[what + '_search_jstree']), model);
+            },
+            function(data) {
+                $scope.toast(data['error_message'], 'error');
+            },
+            function(statusText) {
+                $scope.toast(statusText, 'error');
+            }
+        );
+    };
+
+    /*
+    * A node on the tools or workflows search tree opened. 
+    * If its children are not loaded (it has a "Loading.." child), load them. 
+    */
+    $scope.search_jstree_open_node = function(what, node) {
+        var placeholder = $scope[what + '_search_jstree_model'].find(function(x) {return x.parent === node.id && x.data.placeholder;});
+        if (placeholder) {
+            $scope.search_jstree_level(what, node.id, 0, placeholder.id);
+        }
+    };
+
+    /*
+    * Is this a "Loading.." or "More.." node? If yes, load the results
+    */
+    $scope.search_jstree_select_special_node = function(what, node) {
+        if (node.data.more) {
+            $scope.search_jstree_level(what, node.parent, node.data.cursor, node.id);
+            return true;
+        }
+        if (node.data.placeholder) {
+            return true;
+        }
+        return false;
+    };
+
+    $scope.tools_search_jstree_open_node = function(e, data) {
+        $scope.search_jstree_open_node('tools', data.node);
+    };
+
+    $scope.workflows_search_jstree_open_node = function(e, data) {
+        $scope.search_jstree_open_node('workflows', data.node);
+    };
+
     /// END OF SEARCH
 
     /// TOOLS 
@@ -2285,6 +2355,10 @@ app.controller("OBC_ctrl", function($scope, $sce, $http, $filter, $timeout, $log
     $scope.tools_search_jstree_select_node = function(e, data) {
         //console.log(data.node.data.name);
 
+        if ($scope.search_jstree_select_special_node('tools', data.node)) {
+            return;
+        }
+
         if ($scope.tools_info_editable) {
             $scope.toast('There are unsaved info on Tools/Data. Save or press Cancel', 'error');
             return;
@@ -3285,6 +3359,10 @@ app.controller("OBC_ctrl", function($scope, $sce, $http, $filter, $timeout, $log
     */
     $scope.workflows_search_jstree_select_node = function(e, data) {
 
+        if ($scope.search_jstree_select_special_node('workflows', data.node)) {
+            return;
+        }
+
         if ($scope.workflows_info_editable) {
             $scope.toast('There are unsaved info on Workflows. Save or press Cancel', 'error');
             return;
@@ -4586,8 +4664,9 @@ app.controller("OBC_ctrl", function($scope, $sce, $http, $filter, $timeout, $log
     /*
     * worfklows --> info (right panel) --> button "Download" --> Pressed
     * download_type = "JSON" or "BASH"
+    * report_batch: (BASH only) The script reports its status to the server in batches
     */
-    $scope.workflow_info_download_pressed = function(download_type) {
+    $scope.workflow_info_download_pressed = function(download_type, report_batch) {
         var workflow_options = window.OBCUI.get_workflow_options();
 
         // Check for uncheck options
@@ -4614,6 +4693,7 @@ app.controller("OBC_ctrl", function($scope, $sce, $http, $filter, $timeout, $log
                     'edit': $scope.workflow_info_edit
                 },
                 'download_type': download_type,
+                'report_batch': Boolean(report_batch),
                 'workflow_info_editable': $scope.workflows_info_editable, // Is this workflow saved?
                 'workflow_json' :  $scope.workflows_info_editable ? cy.json() : {} //If this is editable get the cytoscape graph. otherwise we do not need it. 
             },
@@ -1,3 +1,908 @@
-from django.test import TestCase
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.contrib.auth.models import User, AnonymousUser
+from django.core.cache import cache
+from django.utils import timezone
+from django.conf import settings
+
+from app.models import OBC_user, Tool, Workflow, Report, ReportToken, ReportEvent, Reference, Comment, UpDownCommentVote, \
+    ToolClosure, Variables, WorkflowUpdateJob, SearchEntry, SearchGram
+from app import views, detail_cache, artifact_cache, search
+from ExecutionEnvironment import executor
+
+import io
+import os
+import re
+import sys
+import datetime
+import random
+import shutil
+import tarfile
+import tempfile
+import unittest
+import subprocess
+import simplejson
+
+try:
+    import networkx
+except ImportError:
+    networkx = None # Optional. Used only to check executor.transitive_reduction
 
 # Create your tests here.
+
+def create_obc_user(username, **fields):
+    return OBC_user.objects.create(user=User.objects.create(username=username), email_validated=True, **fields)
+
+def create_tool(obc_user, name, version='1', edit=1, dependencies=None, **fields):
+    '''
+    dependencies: If not None, they are added and the closure of the tool is updated
+    '''
+    tool = Tool.objects.create(name=name, version=version, edit=edit, obc_user=obc_user,
+        installation_commands='', validation_commands='', upvotes=0, downvotes=0, draft=False, **fields)
+    if dependencies is not None:
+        tool.dependencies.add(*dependencies)
+        ToolClosure.update([tool])
+    return tool
+
+def create_workflow(obc_user, name, edit=1, workflow='{}', **fields):
+    return Workflow.objects.create(name=name, edit=edit, obc_user=obc_user,
+        description='', description_html='', workflow=workflow, upvotes=0, downvotes=0, draft=False, **fields)
+
+def create_comment(obc_user, parent=None, title='', comment=''):
+    return Comment.objects.create(obc_user=obc_user, title=title, comment=comment, comment_html='', opinion='note', upvotes=0, downvotes=0, parent=parent)
+
+class UserTestCase(TestCase):
+    '''
+    Tests that need a user (self.user, self.obc_user)
+    '''
+
+    username = 'tester'
+
+    def setUp(self):
+        self.obc_user = create_obc_user(self.username)
+        self.user = self.obc_user.user
+
+class SearchQueriesTestCase(UserTestCase):
+    '''
+    The number of queries of the main search should not depend on the number of results
+    '''
+
+    def create_objects(self, start, end):
+        '''
+        Objects of each type. Forks, replies, and reports of forks
+        '''
+        for i in range(start, end):
+            obc_user = create_obc_user('user{}'.format(i), affiliation='searchable')
+            tool = create_tool(self.obc_user, 'searchable', version=str(i))
+            create_tool(obc_user, 'searchable', version=str(i), edit=2, forked_from=tool)
+            workflow = create_workflow(obc_user, 'searchable{}'.format(i))
+            fork = create_workflow(obc_user, 'searchable{}'.format(i), edit=2, forked_from=workflow)
+            report = Report.objects.create(obc_user=self.obc_user, workflow=fork)
+            report.tokens.add(ReportToken.objects.create(status=ReportToken.UNUSED, active=False))
+            report.tokens.add(ReportToken.objects.create(status='workflow started searchable', active=True))
+            Reference.objects.create(obc_user=obc_user, name='searchable{}'.format(i), title='', url='https://www.openbio.eu', html='searchable')
+            question = create_comment(obc_user, title='searchable')
+            answer = create_comment(obc_user, question, comment='searchable')
+            create_comment(obc_user, answer, comment='searchable')
+
+    def count_queries(self, main_search):
+        request = RequestFactory().get('/platform/all_search_2/', {'main_search': main_search})
+        request.user = self.user
+
+        with CaptureQueriesContext(connection) as context:
+            response = views.all_search_2(request)
+        self.assertEqual(response.status_code, 200)
+        return simplejson.loads(response.content), len(context.captured_queries)
+
+    def test_constant_number_of_queries(self):
+        self.create_objects(0, 2)
+        _, few = self.count_queries('searchable')
+
+        self.create_objects(2, 12)
+        data, many = self.count_queries('searchable')
+
+        self.assertEqual(data['tools_search_tools_number'], 24)
+        self.assertEqual(data['main_search_reports_number'], 12)
+        self.assertEqual(data['main_search_qa_number'], 12)
+        self.assertEqual(few, many)
+
+class SearchIndexTestCase(UserTestCase):
+    '''
+    app/search.py: The index follows the objects, ranking happens in the database
+    '''
+
+    username = 'packager'
+
+    def ranked(self, query):
+        pks = search.search(query, SearchEntry.TOOL, Tool.objects.all(), 100)[1]
+        names = Tool.objects.in_bulk(pks)
+        return [names[pk].name for pk in pks]
+
+    def test_index(self):
+        tool = create_tool(self.obc_user, 'SamTools')
+        entry = SearchEntry.objects.get(object_type=SearchEntry.TOOL, object_pk=tool.pk)
+        self.assertEqual((entry.title, entry.text), ('samtools', 'samtools packager'))
+        self.assertIn('  s', set(entry.grams.values_list('gram', flat=True)))
+
+        # Save updates the entry, delete removes it
+        tool.name = 'bcftools'
+        tool.save()
+        self.assertEqual(self.ranked('samtools'), [])
+        self.assertEqual(self.ranked('bcftools'), ['bcftools'])
+        tool.delete()
+        self.assertFalse(SearchEntry.objects.filter(object_type=SearchEntry.TOOL).exists())
+
+    def test_ranking(self):
+        for name in ['bcf-samtools', 'zlib', 'samtools-extra', 'samtools']:
+            create_tool(self.obc_user, name)
+        create_tool(create_obc_user('samtools_fan'), 'bwa')
+
+        # title == query, title starts with query, title contains query, text contains query
+        with self.assertNumQueries(2):
+            number, _ = search.search('SamTools', SearchEntry.TOOL, Tool.objects.all(), 2)
+        self.assertEqual(number, 4)
+        self.assertEqual(self.ranked('SamTools'), ['samtools', 'samtools-extra', 'bcf-samtools', 'bwa'])
+
+        # All the trigrams of 'abcd' are in 'abcx-xbcd' but the words are also needed
+        create_tool(self.obc_user, 'abcx-xbcd')
+        self.assertEqual(self.ranked('abcd'), [])
+        self.assertEqual(self.ranked('tools extra'), ['samtools-extra'])
+
+        # Empty query: everything in order of pk
+        self.assertEqual(self.ranked(''), ['bcf-samtools', 'zlib', 'samtools-extra', 'samtools', 'bwa', 'abcx-xbcd'])
+
+    def test_short_query(self):
+        # Short words only match the start of the title
+        for name in ['samtools', 'busa', 'sra']:
+            create_tool(self.obc_user, name)
+        self.assertEqual(self.ranked('S'), ['samtools', 'sra'])
+        self.assertEqual(self.ranked('sa'), ['samtools'])
+        self.assertEqual(self.ranked('bu sa'), [])
+        self.assertEqual(self.ranked('busa'), ['busa'])
+
+    def test_rebuild(self):
+        for name in ['samtools', 'samtools-extra', 'zlib']:
+            create_tool(self.obc_user, name)
+        before = self.ranked('samtools')
+        grams = SearchGram.objects.count()
+
+        SearchEntry.objects.all().delete()
+        search.rebuild()
+        self.assertEqual(self.ranked('samtools'), before)
+        self.assertEqual(SearchGram.objects.count(), grams)
+
+    def test_roots(self):
+        # One result per Q&A thread, ranked by its best comment
+        def comment(title, text, parent=None):
+            return create_comment(self.obc_user, parent, title=title, comment=text)
+        first = comment('installation', 'samtools does not compile')
+        comment('', 'samtools needs zlib', parent=first)
+        second = comment('samtools', '')
+
+        number, roots = search.search_roots('samtools', SearchEntry.QA, Comment.objects.all(), 10)
+        self.assertEqual((number, roots), (2, [second.pk, first.pk]))
+
+class SearchJSTreeTestCase(UserTestCase):
+    '''
+    The tools / workflows search trees are loaded one level and one page at a time
+    '''
+
+    def create_tool(self, name, version, edit, forked_from=None):
+        return create_tool(self.obc_user, name, version=version, edit=edit, forked_from=forked_from)
+
+    def level(self, view, parent=None, cursor=0):
+        '''
+        The nodes of a level: name/version/edit of the results, "forks" for a placeholder, "more:<cursor>" for the "More.." node
+        '''
+        request = RequestFactory().post('/platform/', simplejson.dumps({'main_search': 'searchable', 'parent': parent, 'cursor': cursor}), content_type='application/json')
+        request.user = self.user
+        data = simplejson.loads(view(request).content)
+        if not data['success']:
+            return data['error_message']
+
+        tree = data.get('tools_search_jstree', data.get('workflows_search_jstree'))
+        ret = []
+        for node in tree:
+            if node['data'].get('placeholder'):
+                ret.append('forks')
+            elif node['data'].get('more'):
+                ret.append('more:{}'.format(node['data']['cursor']))
+            else:
+                ret.append('/'.join(str(node['data'][x]) for x in ['name', 'version', 'edit'] if x in node['data']))
+        return ret
+
+    def setUp(self):
+        super().setUp()
+        limit = views.g['search_result_limit']
+        views.g['search_result_limit'] = 2
+        self.addCleanup(views.g.__setitem__, 'search_result_limit', limit)
+
+    def test_tools(self):
+        first = self.create_tool('searchable', '1', 1)
+        self.create_tool('searchable', '2', 1)
+        self.create_tool('searchable', '3', 1)
+        fork = self.create_tool('searchable', '1', 2, forked_from=first)
+        self.create_tool('searchable', '1', 3, forked_from=first)
+        self.create_tool('searchable', '1', 4, forked_from=fork)
+        # A fork of a tool that does not match is on the top level
+        self.create_tool('searchable', '4', 1, forked_from=self.create_tool('other', '1', 1))
+
+        view = views.tools_search_jstree_level
+        self.assertEqual(self.level(view), ['searchable/1/1', 'forks', 'searchable/2/1', 'more:2'])
+        self.assertEqual(self.level(view, cursor=2), ['searchable/3/1', 'searchable/4/1'])
+        self.assertEqual(self.level(view, cursor=4), [])
+
+        parent = {'name': 'searchable', 'version': '1', 'edit': 1}
+        self.assertEqual(self.level(view, parent=parent), ['searchable/1/2', 'forks', 'searchable/1/3'])
+        self.assertEqual(self.level(view, parent=dict(parent, edit=2)), ['searchable/1/4'])
+        self.assertEqual(self.level(view, parent=dict(parent, edit=4)), [])
+
+        self.assertEqual(self.level(view, cursor='next'), 'Error 7011')
+        self.assertEqual(self.level(view, cursor=-2), 'Error 7011')
+        self.assertEqual(self.level(view, parent=dict(parent, edit=9)), 'Error 7012. Could not find tool')
+
+        # Number of results and constant number of queries 
+        with self.assertNumQueries(4):
+            data = views.tools_search_2('searchable', '', '')
+        self.assertEqual(data['tools_search_tools_number'], 7)
+
+    def test_workflows(self):
+        first = create_workflow(self.obc_user, 'searchable')
+        for edit in range(2, 5):
+            create_workflow(self.obc_user, 'searchable', edit=edit, forked_from=first)
+
+        view = views.workflows_search_jstree_level
+        self.assertEqual(self.level(view), ['searchable/1', 'forks'])
+        self.assertEqual(self.level(view, parent={'name': 'searchable', 'edit': 1}), ['searchable/2', 'searchable/3', 'more:2'])
+        self.assertEqual(self.level(view, parent={'name': 'searchable', 'edit': 1}, cursor=2), ['searchable/4'])
+
+class QAThreadTestCase(UserTestCase):
+    '''
+    Comment threads are fetched in one query (plus one for the votes)
+    '''
+
+    def test_thread(self):
+        root = create_comment(self.obc_user)
+        answers = [create_comment(self.obc_user, root) for _ in range(5)]
+        replies = [create_comment(self.obc_user, answer) for answer in answers for _ in range(5)]
+        deep = create_comment(self.obc_user, replies[-1])
+        UpDownCommentVote.objects.create(obc_user=self.obc_user, comment=deep, upvote=False)
+
+        self.assertEqual(deep.root_id, root.pk)
+        self.assertEqual(deep.depth, 3)
+
+        with self.assertNumQueries(2):
+            thread = views.qa_create_thread(root, self.obc_user)
+
+        self.assertEqual([x['id'] for x in thread], [x.pk for x in answers])
+        self.assertEqual([x['id'] for x in thread[0]['children']], [x.pk for x in replies[:5]])
+        self.assertEqual(thread[-1]['children'][-1]['children'][0]['id'], deep.pk)
+        self.assertEqual(thread[-1]['children'][-1]['children'][0]['voted'], {'up': False, 'down': True})
+
+        # The vote on the root is fetched together with the thread
+        UpDownCommentVote.objects.create(obc_user=self.obc_user, comment=root, upvote=True)
+        with self.assertNumQueries(2):
+            _, root_voted = views.qa_get_thread(root, self.obc_user)
+        self.assertEqual(root_voted, {'up': True, 'down': False})
+
+        # Subthread of a comment that is not the root
+        with self.assertNumQueries(2):
+            subthread = views.qa_create_thread(answers[-1], self.obc_user)
+        self.assertEqual(subthread, thread[-1]['children'])
+
+class ToolClosureTestCase(UserTestCase):
+    '''
+    All the dependencies of a tool are fetched with a constant number of queries
+    '''
+
+    def create_tool(self, name, dependencies):
+        return create_tool(self.obc_user, name, dependencies=dependencies)
+
+    def test_closure(self):
+        zlib = self.create_tool('zlib', [])
+        htslib = self.create_tool('htslib', [zlib])
+        bzip2 = self.create_tool('bzip2', [])
+        samtools = self.create_tool('samtools', [htslib, bzip2])
+        bcftools = self.create_tool('bcftools', [htslib, samtools])
+
+        with self.assertNumQueries(2):
+            dependencies = views.tool_get_dependencies_internal(bcftools, include_as_root=True)
+
+        self.assertEqual(
+            [(str(d['dependant']) if d['dependant'] else None, str(d['dependency'])) for d in dependencies],
+            [
+                (None, 'bcftools/1/1'),
+                ('bcftools/1/1', 'htslib/1/1'),
+                ('htslib/1/1', 'zlib/1/1'),
+                ('bcftools/1/1', 'samtools/1/1'),
+                ('samtools/1/1', 'htslib/1/1'),
+                ('htslib/1/1', 'zlib/1/1'),
+                ('samtools/1/1', 'bzip2/1/1'),
+            ]
+        )
+
+        # A new dependency deep in the graph updates all the tools that depend on it
+        xz = self.create_tool('xz', [])
+        htslib.dependencies.add(xz)
+        ToolClosure.update([htslib])
+        self.assertEqual(
+            set(ToolClosure.objects.filter(dependency=xz).values_list('tool__name', flat=True)),
+            {'htslib', 'samtools', 'bcftools'},
+        )
+
+        # Rebuilding everything gives the same closure
+        closure = set(ToolClosure.objects.values_list('tool_id', 'dependency_id'))
+        ToolClosure.update()
+        self.assertEqual(set(ToolClosure.objects.values_list('tool_id', 'dependency_id')), closure)
+
+    def test_stale_closure(self):
+        zlib = self.create_tool('zlib', [])
+        htslib = self.create_tool('htslib', [zlib])
+        samtools = self.create_tool('samtools', [htslib])
+
+        # htslib got a new dependency but its closure (and the closure of samtools) was not updated
+        xz = self.create_tool('xz', [])
+        htslib.dependencies.add(xz)
+        dependencies = views.tool_get_dependencies_internal(samtools)
+        self.assertEqual([str(d['dependency']) for d in dependencies], ['htslib/1/1', 'zlib/1/1', 'xz/1/1'])
+
+        # No closure at all (before scripts/migrate_5.py)
+        ToolClosure.objects.all().delete()
+        dependencies = views.tool_get_dependencies_internal(samtools)
+        self.assertEqual([str(d['dependency']) for d in dependencies], ['htslib/1/1', 'zlib/1/1', 'xz/1/1'])
+
+    def test_jstree(self):
+        zlib = self.create_tool('zlib', [])
+        Variables.objects.create(name='path', value='zlib', description='', tool=zlib).tools_related.add(zlib)
+        htslib = self.create_tool('htslib', [zlib])
+        bzip2 = self.create_tool('bzip2', [zlib])
+        samtools = self.create_tool('samtools', [htslib, bzip2])
+
+        dependencies = views.tool_get_dependencies_internal(samtools, include_as_root=True, unique=True)
+        # variables, os_choices, dependencies
+        with self.assertNumQueries(3):
+            dependencies_jstree, variables_jstree = views.tool_build_dependencies_jstree(dependencies, add_installation_commands=True)
+
+        # zlib is added once
+        self.assertEqual([x['name'] for x in dependencies_jstree], ['samtools', 'htslib', 'zlib', 'bzip2'])
+        self.assertEqual(dependencies_jstree[3]['dependencies'], ['zlib/1/1'])
+        self.assertEqual([x['data']['type'] for x in variables_jstree], ['tool', 'tool', 'tool', 'variable', 'tool'])
+        self.assertNotIn('installation_commands', variables_jstree[0])
+
+class DetailCacheTestCase(UserTestCase):
+    '''
+    The details of a tool are cached. The votes of the user are added on every request.
+    '''
+
+    def create_tool(self, name, dependencies):
+        return create_tool(self.obc_user, name, dependencies=dependencies, comment=create_comment(self.obc_user))
+
+    def get_details(self, tool, user):
+        request = RequestFactory().get('/platform/tools_search_3/', {'tool_name': tool.name, 'tool_version': tool.version, 'tool_edit': tool.edit})
+        request.user = user
+        response = views.tools_search_3(request)
+        self.assertEqual(response.status_code, 200)
+        return simplejson.loads(response.content)
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_cache(self):
+        zlib = self.create_tool('zlib', [])
+        samtools = self.create_tool('samtools', [zlib])
+        answer = create_comment(self.obc_user, samtools.comment)
+        UpDownCommentVote.objects.create(obc_user=self.obc_user, comment=answer, upvote=True)
+
+        self.get_details(samtools, AnonymousUser())
+        with self.assertNumQueries(0):
+            data = self.get_details(samtools, AnonymousUser())
+        self.assertEqual(data['tool_thread'][0]['voted'], {'up': False, 'down': False})
+
+        # obc_user, vote on the tool, votes on the comments
+        with self.assertNumQueries(3):
+            data = self.get_details(samtools, self.user)
+        self.assertEqual(data['tool_voted'], {'up': False, 'down': False})
+        self.assertEqual(data['tool_thread'][0]['voted'], {'up': True, 'down': False})
+
+        # A new comment in the thread
+        create_comment(self.obc_user, answer)
+        data = self.get_details(samtools, AnonymousUser())
+        self.assertEqual(len(data['tool_thread'][0]['children']), 1)
+
+        # A change in a dependency
+        self.get_details(zlib, AnonymousUser())
+        zlib.description = 'compression'
+        zlib.save()
+        self.assertIsNone(detail_cache.get_document(detail_cache.tool_key('samtools', '1', 1)))
+        self.assertEqual(self.get_details(zlib, AnonymousUser())['description'], 'compression')
+
+    @unittest.skipIf(settings.CACHES['default']['BACKEND'].endswith('LocMemCache'), 'The cache (obc_private.CACHES) is per process')
+    def test_shared(self):
+        # scripts/workflow_update_worker.py is another process. Its invalidations should reach the web server
+        key = detail_cache.workflow_key('pipeline', 1)
+        detail_cache.set_document(key, {'name': 'pipeline'})
+        command = 'from app import detail_cache; detail_cache.cache.delete({!r})'.format(key)
+        subprocess.run([sys.executable, 'manage.py', 'shell', '-c', command], cwd=settings.BASE_DIR, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.assertIsNone(detail_cache.get_document(key))
+
+class WorkflowJSONTestCase(UserTestCase):
+    '''
+    A tool update reaches all the workflows that use it, also through other workflows
+    '''
+
+    def workflow_node(self, name, belongto):
+        return {'data': {'id': name + '__1', 'name': name, 'edit': 1, 'type': 'workflow', 'belongto': belongto, 'draft': False, 'disconnected': False}}
+
+    def create_workflow(self, name, nodes, workflows):
+        graph = {'elements': {'nodes': [self.workflow_node(name, None)] + nodes, 'edges': []}}
+        workflow = create_workflow(self.obc_user, name, workflow=simplejson.dumps(graph))
+        workflow.workflows.add(*workflows)
+        return workflow
+
+    def graph_ids(self, workflow):
+        workflow.refresh_from_db()
+        return {node['data']['id'] for node in simplejson.loads(workflow.workflow)['elements']['nodes']}
+
+    def test_update_tool(self):
+        zlib = create_tool(self.obc_user, 'zlib')
+        htslib = create_tool(self.obc_user, 'htslib')
+        ToolClosure.update()
+
+        htslib_node = views.tool_node_cytoscape(htslib)
+        htslib_node['data']['belongto'] = {'name': 'align', 'edit': 1}
+        align = self.create_workflow('align', [htslib_node], [])
+        align.tools.add(htslib)
+        pipeline = self.create_workflow('pipeline', [self.workflow_node('align', {'name': 'pipeline', 'edit': 1}), htslib_node], [align])
+        pipeline.tools.add(htslib)
+        # Created before htslib was added to align
+        project = self.create_workflow('project', [self.workflow_node('pipeline', {'name': 'project', 'edit': 1}), self.workflow_node('align', {'name': 'pipeline', 'edit': 1})], [pipeline, align])
+
+        htslib.dependencies.add(zlib)
+        ToolClosure.update([htslib])
+        views.WorkflowJSON().update_tool(htslib)
+
+        zlib_id = views.tool_id_cytoscape(zlib)
+        for workflow in [align, pipeline, project]:
+            self.assertIn(zlib_id, self.graph_ids(workflow))
+            self.assertEqual(set(workflow.tools.all()), {htslib, zlib})
+        self.assertEqual(set(project.workflows.all()), {pipeline, align})
+
+        # A workflow update reaches the workflows that use it
+        align.draft = True
+        views.WorkflowJSON().update_workflow(align)
+        for workflow in [pipeline, project]:
+            workflow.refresh_from_db()
+            nodes = {node['data']['id']: node for node in simplejson.loads(workflow.workflow)['elements']['nodes']}
+            self.assertTrue(nodes['align__1']['data']['draft'])
+            self.assertIn(zlib_id, nodes)
+
+    def test_job(self):
+        tool = create_tool(self.obc_user, 'zlib')
+        tool_node = views.tool_node_cytoscape(tool)
+        tool_node['data']['belongto'] = {'name': 'compress', 'edit': 1}
+        workflow = self.create_workflow('compress', [tool_node], [])
+        workflow.tools.add(tool)
+
+        # One queued job per tool
+        job = WorkflowUpdateJob.enqueue(WorkflowUpdateJob.TOOL, tool)
+        self.assertEqual(WorkflowUpdateJob.enqueue(WorkflowUpdateJob.TOOL, tool), job)
+
+        self.assertEqual(views.run_workflow_update_jobs(), 1)
+        self.assertEqual(views.run_workflow_update_jobs(), 0)
+
+        request = RequestFactory().get('/platform/job_status/', {'job_id': job.pk})
+        data = simplejson.loads(views.job_status(request).content)
+        self.assertEqual((data['status'], data['progress'], data['total']), (WorkflowUpdateJob.DONE, 1, 1))
+
+        # The worker of a running job crashed. The job is queued again after STALE_AFTER
+        job = WorkflowUpdateJob.enqueue(WorkflowUpdateJob.TOOL, tool)
+        self.assertTrue(job.claim())
+        self.assertEqual(views.run_workflow_update_jobs(), 0) # Still running
+
+        WorkflowUpdateJob.objects.filter(pk=job.pk).update(updated_at=timezone.now() - WorkflowUpdateJob.STALE_AFTER - datetime.timedelta(seconds=1))
+        self.assertEqual(views.run_workflow_update_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, WorkflowUpdateJob.DONE)
+
+class ArtifactCacheTestCase(UserTestCase):
+    '''
+    Downloads without a report are cached and have an ETag
+    '''
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.workflow = create_workflow(self.obc_user, 'pipeline', workflow='{"elements": {"nodes": [], "edges": []}}')
+
+    def executable_graph(self, name):
+        '''
+        A workflow with a main step that calls another step
+        '''
+        belongto = {'name': name, 'edit': 1}
+        nodes = [
+            {'id': name + '__1', 'type': 'workflow', 'name': name, 'edit': 1, 'belongto': None, 'label': name + '/1'},
+            {'id': 'step__main__' + name + '__1', 'type': 'step', 'name': 'main', 'main': True, 'sub_main': False, 'belongto': belongto,
+                'bash': 'echo main\nstep__other__' + name + '__1\n', 'steps': ['step__other__' + name + '__1'], 'tools': [], 'inputs': [], 'outputs': []},
+            {'id': 'step__other__' + name + '__1', 'type': 'step', 'name': 'other', 'main': False, 'sub_main': False, 'belongto': belongto,
+                'bash': 'echo other\n', 'steps': [], 'tools': [], 'inputs': [], 'outputs': []},
+        ]
+        return simplejson.dumps({'elements': {'nodes': [{'data': node} for node in nodes], 'edges': []}})
+
+    def test_stream(self):
+        self.workflow.workflow = self.executable_graph('pipeline')
+        self.workflow.save()
+
+        url = '/platform/rest/workflows/pipeline/1/'
+        response = self.client.get(url, {'format': 'CWLTARGZ', 'workflow_id': 'abc'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        content = b''.join(response.streaming_content)
+
+        with tarfile.open(fileobj=io.BytesIO(content)) as tar:
+            self.assertIn('inputs.yml', tar.getnames())
+
+        # Without a workflow_id the output contains a random id
+        response = self.client.get(url, {'format': 'CWLTARGZ'})
+        self.assertFalse(response.has_header('ETag'))
+
+        # Cached after the last chunk
+        key = artifact_cache.get_key(self.workflow, 'CWLTARGZ', {}, 'abc', True, 'http://testserver/platform')
+        self.assertEqual(artifact_cache.get_artifact(key), content)
+        response = self.client.get(url, {'format': 'CWLTARGZ', 'workflow_id': 'abc'})
+        self.assertEqual(b''.join(response.streaming_content), content)
+
+    def test_bash(self):
+        # BASH has a random nice id, even with a workflow_id. Every download is different
+        self.workflow.workflow = self.executable_graph('pipeline')
+        self.workflow.save()
+        url = '/platform/rest/workflows/pipeline/1/'
+
+        response = self.client.get(url, {'format': 'BASH', 'workflow_id': 'abc'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertIsNone(artifact_cache.get_artifact(artifact_cache.get_key(self.workflow, 'BASH', {}, 'abc', True, 'http://testserver/platform')))
+        self.assertNotEqual(self.client.get(url, {'format': 'BASH', 'workflow_id': 'abc'}).content, response.content)
+
+    def test_report_batch(self):
+        # Only downloads that create a report (validated user) can report in batches 
+        self.workflow.workflow = self.executable_graph('pipeline')
+        self.workflow.save()
+        url = '/platform/rest/workflows/pipeline/1/'
+
+        response = self.client.get(url, {'format': 'BASH', 'report_batch': 'true'})
+        self.assertNotIn(b'obc_status_sender', response.content)
+
+        self.client.force_login(self.workflow.obc_user.user)
+        response = self.client.get(url, {'format': 'BASH', 'report_batch': 'true'})
+        self.assertIn(b'obc_status_sender', response.content)
+        response = self.client.get(url, {'format': 'BASH'})
+        self.assertNotIn(b'obc_status_sender', response.content)
+
+    def test_etag(self):
+        url = '/platform/rest/workflows/pipeline/1/'
+        response = self.client.get(url, {'format': 'JSON', 'input__inp__pipeline__1': 'a'})
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        key = artifact_cache.get_key(self.workflow, 'JSON', {'input__inp__pipeline__1': 'a'}, None, True, 'http://testserver/platform')
+        self.assertEqual(etag, '"{}"'.format(key))
+        self.assertIsNotNone(artifact_cache.get_artifact(key))
+
+        response = self.client.get(url, {'format': 'JSON', 'input__inp__pipeline__1': 'a'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Other arguments, other artifact
+        response = self.client.get(url, {'format': 'JSON', 'input__inp__pipeline__1': 'b'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # A changed workflow, other artifact
+        self.workflow.workflow = '{"elements": {"nodes": [], "edges": [], "changed": true}}'
+        self.workflow.save()
+        response = self.client.get(url, {'format': 'JSON', 'input__inp__pipeline__1': 'a'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+class ReportEventTestCase(UserTestCase):
+    '''
+    report and report_batch save the statuses as ReportEvent, with one token per request
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.report = Report.objects.create(obc_user=self.obc_user, workflow=create_workflow(self.obc_user, 'pipeline'))
+        self.token = ReportToken.objects.create(status=ReportToken.UNUSED, active=True)
+        self.report.tokens.add(self.token)
+
+    def post(self, url, data):
+        response = self.client.post(url, simplejson.dumps(data), content_type='application/json')
+        return simplejson.loads(response.content)
+
+    def test_report_batch(self):
+        statuses = ['workflow started pipeline__1', 'step started step__main__pipeline__1 main', 'step finished step__main__pipeline__1']
+        with self.assertNumQueries(8): # Token and report, 4 writes for the whole batch, 2 for the transaction
+            data = self.post('/platform/report_batch/', {'token': str(self.token.token), 'statuses': statuses})
+        self.assertTrue(data['success'])
+
+        self.assertEqual([x.status for x in self.report.events.order_by('created_at', 'pk')], statuses)
+        self.assertEqual(self.report.tokens.count(), 2)
+        self.assertTrue(ReportToken.objects.get(token=data['token']).active)
+
+        # The token has been used
+        self.assertFalse(self.post('/platform/report/', {'token': str(self.token.token), 'status': 'workflow finished pipeline__1'})['success'])
+
+        # Nothing is saved if a status is unknown
+        self.assertFalse(self.post('/platform/report_batch/', {'token': data['token'], 'statuses': ['workflow finished pipeline__1', 'unknown']})['success'])
+        self.assertEqual(self.report.events.count(), 3)
+
+        data = self.post('/platform/report/', {'token': data['token'], 'status': 'workflow finished pipeline__1'})
+        self.assertTrue(data['success'])
+
+        # reports_search_3 reads the events
+        self.client.force_login(self.user)
+        data = self.post('/platform/reports_search_3/', {'run': self.report.nice_id})
+        self.assertEqual([x['status'] for x in data['report_tokens']], statuses + ['workflow finished pipeline__1'])
+        self.assertEqual([x['node_anim_params'] for x in data['report_tokens']], [ReportToken.parse_response_status(x) for x in statuses + ['workflow finished pipeline__1']])
+
+    def test_parse_response_status(self):
+        self.assertEqual(ReportToken.parse_response_status('workflow started pipeline/1'), {'status_code': ReportToken.WORKFLOW_STARTED_CODE, 'status_fields': {'name': 'pipeline/1'}})
+        self.assertEqual(ReportToken.parse_response_status('tool finished samtools/1.9/1 '), {'status_code': ReportToken.TOOL_FINISHED_CODE, 'status_fields': {'name': 'samtools/1.9/1'}})
+        self.assertEqual(ReportToken.parse_response_status('step started step__a__p__1 main'), {'status_code': ReportToken.STEP_STARTED_CODE, 'status_fields': {'name': 'step__a__p__1', 'caller': 'main'}})
+        self.assertIsNone(ReportToken.parse_response_status('step started step__a__p__1'))
+        self.assertIsNone(ReportToken.parse_response_status('step finished step/1'))
+        self.assertIsNone(ReportToken.parse_response_status(ReportToken.UNUSED))
+
+class ExecutorTestCase(TestCase):
+    '''
+    executor.py
+    '''
+
+    TOKEN = '8a5b2f1e-0c3d-4e6f-9a7b-1c2d3e4f5a6b'
+
+    def node_order(self, nodes):
+        workflow = executor.Workflow.__new__(executor.Workflow)
+        return [node['id'] for node in workflow.get_node_order(lambda: iter(nodes), lambda x: x['id'], lambda x: x['dependencies'])]
+
+    def test_node_order(self):
+        nodes = [
+            {'id': 'samtools', 'dependencies': ['htslib', 'zlib']},
+            {'id': 'htslib', 'dependencies': ['zlib']},
+            {'id': 'bzip2', 'dependencies': []},
+            {'id': 'zlib', 'dependencies': []},
+        ]
+        self.assertEqual(self.node_order(nodes), ['bzip2', 'zlib', 'htslib', 'samtools'])
+
+        nodes[3]['dependencies'] = ['samtools']
+        with self.assertRaises(executor.OBC_Executor_Exception):
+            self.node_order(nodes)
+
+        with self.assertRaises(executor.OBC_Executor_Exception):
+            self.node_order([{'id': 'samtools', 'dependencies': ['htslib']}])
+
+    def executable_workflow(self, arguments={}, main_bash='echo main\nstep__other__pipeline__1\n', token=None):
+        '''
+        A workflow with a main step that calls another step (the nodes are not in order)
+        '''
+        belongto = {'name': 'pipeline', 'edit': 1}
+        nodes = [
+            {'id': 'step__main__pipeline__1', 'type': 'step', 'name': 'main', 'main': True, 'sub_main': False, 'belongto': belongto,
+                'bash': main_bash, 'steps': ['step__other__pipeline__1'], 'tools': [], 'inputs': [], 'outputs': []},
+            {'id': 'pipeline__1', 'type': 'workflow', 'name': 'pipeline', 'edit': 1, 'belongto': None, 'label': 'pipeline/1'},
+            {'id': 'step__other__pipeline__1', 'type': 'step', 'name': 'other', 'main': False, 'sub_main': False, 'belongto': belongto,
+                'bash': 'echo other\n', 'steps': [], 'tools': [], 'inputs': [], 'outputs': []},
+        ]
+        workflow_object = {'arguments': arguments, 'workflow': {'elements': {'nodes': [{'data': node} for node in nodes], 'edges': []}}, 'token': token, 'nice_id': None}
+        return nodes, executor.Workflow(workflow_object=workflow_object, askinput='NO')
+
+    def run_script(self, script, **environment):
+        '''
+        Run a sh script with a curl that only logs what it posts (and always succeeds)
+        environment: More environment variables. TMPDIR is the temporary directory of the test
+        Returns the posted JSON objects and the work path (which is deleted after the test)
+        '''
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for name in ['bin', 'tools', 'data', 'work']:
+            os.mkdir(os.path.join(directory, name))
+
+        curl = os.path.join(directory, 'bin', 'curl')
+        with open(curl, 'w') as f:
+            f.write('#!/bin/bash\n'
+                'while [ $# -gt 0 ] ; do if [ "$1" == "-d" ] ; then echo "$2" >> "${OBC_TEST_CURL_LOG}" ; fi ; shift ; done\n'
+                'echo \'{"success": true, "token": "%s"}\'\n' % self.TOKEN)
+        os.chmod(curl, 0o755)
+
+        script_path = os.path.join(directory, 'script.sh')
+        with open(script_path, 'w') as f:
+            f.write(script)
+
+        env = dict(os.environ,
+            PATH=os.path.join(directory, 'bin') + os.pathsep + os.environ.get('PATH', ''),
+            OBC_TEST_CURL_LOG=os.path.join(directory, 'curl.log'),
+            OBC_TOOL_PATH=os.path.join(directory, 'tools'),
+            OBC_DATA_PATH=os.path.join(directory, 'data'),
+            OBC_WORK_PATH=os.path.join(directory, 'work'),
+            TMPDIR=directory,
+            **environment
+        )
+        subprocess.run(['bash', script_path], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60)
+
+        if not os.path.exists(env['OBC_TEST_CURL_LOG']):
+            return [], env['OBC_WORK_PATH']
+        with open(env['OBC_TEST_CURL_LOG']) as f:
+            return [simplejson.loads(line) for line in f], env['OBC_WORK_PATH']
+
+    def test_indexes(self):
+        nodes, workflow = self.executable_workflow()
+
+        self.assertEqual(workflow.root_workflow['id'], 'pipeline__1')
+        self.assertEqual([node['id'] for node in workflow.get_all_workflows()], ['pipeline__1'])
+        self.assertEqual([node['id'] for node in workflow.step_iterator()], ['step__main__pipeline__1', 'step__other__pipeline__1'])
+        self.assertEqual([node['id'] for node in workflow.get_steps_from_workflow(workflow.root_workflow)], ['step__main__pipeline__1', 'step__other__pipeline__1'])
+        self.assertIs(workflow.nodes_by_id['step__other__pipeline__1'], nodes[2])
+
+    def test_tool_dependent_variables(self):
+        def tool(name, dependencies):
+            return {'name': name, 'version': '1', 'edit': 1, 'dependencies': [x + '/1/1' for x in dependencies], 'variables': [{'name': 'path'}]}
+
+        # samtools --> htslib, bzip2 --> zlib
+        tools = [tool('samtools', ['htslib', 'bzip2']), tool('htslib', ['zlib']), tool('bzip2', ['zlib']), tool('zlib', [])]
+        workflow = executor.Workflow.__new__(executor.Workflow)
+        workflow.nodes_by_type = {executor.Workflow.TOOL_TYPE: tools}
+        workflow.tool_slash_id_d = {executor.Workflow.get_tool_slash_id(x): x for x in tools}
+
+        dependent_variables = workflow.get_tool_dependent_variables()
+        self.assertEqual([dependent_tool['name'] for _, dependent_tool in dependent_variables['samtools/1/1']], ['htslib', 'zlib', 'bzip2'])
+        self.assertEqual(dependent_variables['zlib/1/1'], [])
+
+    def test_parse_step_bash(self):
+        bash = 'STEPS="\nA,B\n1,2\n"\nPARALLEL step__a__p__1 ${STEPS}\nstep__b__p__1\necho end\n'
+        commands = executor.parse_step_bash(bash, ['step__a__p__1', 'step__b__p__1'])
+        self.assertEqual(commands[0]['assignment'], {'variable': 'STEPS', 'header': ['A', 'B'], 'content': [['1', '2']]})
+        self.assertEqual(commands[1]['parallel_call_1'], {'step': 'step__a__p__1', 'variable': 'STEPS'})
+        bash_to_parse = '{\n:\n' + bash + '\n}'
+        self.assertEqual(bash_to_parse[slice(*commands[2]['call_pos'])], 'step__b__p__1')
+
+        # Parsed once
+        self.assertIs(executor.parse_step_bash(bash, ['step__a__p__1', 'step__b__p__1']), commands)
+
+        cache = executor.LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+    def test_emitter(self):
+        emitter = executor.Emitter('a', 'b')
+        emitter += 'c'
+        emitter += executor.Emitter('d')
+        self.assertEqual(emitter.getvalue(), 'abcd')
+
+        # The script is written to a stream as it is returned
+        _, workflow = self.executable_workflow()
+        f = io.StringIO()
+        executor.LocalExecutor(workflow).build(output=f)
+        self.assertEqual(f.getvalue(), executor.LocalExecutor(workflow).build(output=None))
+        self.assertIn('echo other', f.getvalue())
+
+    def test_compiled_workflow(self):
+        _, workflow = self.executable_workflow()
+
+        # All executors render the same CompiledWorkflow
+        compiled = executor.ArgoExecutor(workflow).compile()
+        self.assertIs(executor.NextflowExecutor(workflow).compile(), compiled)
+        self.assertEqual([step['id'] for step in compiled.steps], ['step__main__pipeline__1__1', 'step__other__pipeline__1__1', 'step__main__pipeline__1__2'])
+        self.assertEqual(
+            sorted(compiled.dag_edges('INIT', 'FINAL')),
+            [('INIT', 'step__main__pipeline__1__1'), ('step__main__pipeline__1__1', 'step__other__pipeline__1__1'), ('step__main__pipeline__1__2', 'FINAL'), ('step__other__pipeline__1__1', 'step__main__pipeline__1__2')],
+        )
+
+        # The second format of the same workflow is compiled only once
+        executor.workflow_cache.clear()
+        argo = executor.create_bash_script(workflow.workflow_object, 'http://127.0.0.1:8200/platform', 'argo', workflow_id='pipeline')
+        nextflow = executor.create_bash_script(workflow.workflow_object, 'http://127.0.0.1:8200/platform', 'nextflow', workflow_id='pipeline')
+        self.assertEqual(len(executor.workflow_cache), 1)
+        self.assertIn('echo other', argo)
+        self.assertIn('echo other', nextflow)
+
+    def test_transitive_reduction(self):
+        # samtools --> htslib --> zlib and samtools --> zlib 
+        dag = executor.transitive_reduction([('samtools', 'htslib'), ('htslib', 'zlib'), ('samtools', 'zlib'), ('samtools', 'zlib')])
+        self.assertEqual(dag.nodes(), ['samtools', 'htslib', 'zlib'])
+        self.assertEqual(dag.edges, [('samtools', 'htslib'), ('htslib', 'zlib')])
+        self.assertEqual(list(dag.predecessors('zlib')), ['htslib'])
+
+        with self.assertRaises(executor.OBC_Executor_Exception):
+            executor.transitive_reduction([('samtools', 'htslib'), ('htslib', 'samtools')])
+
+    @unittest.skipIf(networkx is None, 'networkx is not installed')
+    def test_transitive_reduction_networkx(self):
+        # Same nodes and edges, in the same order, as networkx
+        rnd = random.Random(0)
+        for _ in range(50):
+            nodes = ['step{}'.format(i) for i in range(rnd.randint(1, 40))]
+            rnd.shuffle(nodes)
+            edges = [(a, b) for j, b in enumerate(nodes) for a in nodes[:j] if rnd.random() < 0.2]
+            rnd.shuffle(edges)
+
+            expected = networkx.transitive_reduction(networkx.DiGraph(edges))
+            dag = executor.transitive_reduction(edges)
+            self.assertEqual(dag.nodes(), list(expected.nodes()))
+            self.assertEqual(dag.edges, list(expected.edges))
+
+    @unittest.skipIf(shutil.which('bash') is None, 'bash is not installed')
+    def test_report_batch_script(self):
+        _, workflow = self.executable_workflow(token=self.TOKEN)
+        self.assertNotIn('obc_status_sender', executor.LocalExecutor(workflow).build(output=None))
+        posted, _ = self.run_script(executor.LocalExecutor(workflow).build(output=None))
+        statuses = [x['status'] for x in posted]
+
+        # The same statuses, in the same order, in fewer requests. The spool is deleted at the end
+        posted, work_path = self.run_script(executor.LocalExecutor(workflow, report_batch=True).build(output=None), OBC_STATUS_INTERVAL='0.2')
+        self.assertEqual([status for x in posted for status in x['statuses']], statuses)
+        self.assertLess(len(posted), len(statuses))
+        self.assertEqual({x['token'] for x in posted}, {self.TOKEN})
+        self.assertEqual([name for name in os.listdir(os.path.dirname(work_path)) if name.startswith('tmp')], [])
+
+    def test_max_parallel(self):
+        _, workflow = self.executable_workflow({'OBC_MAX_PARALLEL': '4'})
+        script = executor.LocalExecutor(workflow).build(output=None)
+        self.assertIn('OBC_MAX_PARALLEL=${OBC_MAX_PARALLEL:-4}', script)
+        self.assertIn('function obc_parallel_start()', script)
+
+        _, workflow = self.executable_workflow()
+        self.assertNotIn('OBC_MAX_PARALLEL=$', executor.LocalExecutor(workflow).build(output=None))
+
+        with self.assertRaises(executor.OBC_Executor_Exception):
+            self.executable_workflow({'OBC_MAX_PARALLEL': 'many'})[1].get_max_parallel()
+
+    def test_report_log(self):
+        # REPORT appends to the log. The report is rendered when the script exits
+        _, workflow = self.executable_workflow()
+        script = executor.LocalExecutor(workflow).build(output=None)
+        self.assertIn('>> "${OBC_REPORT_LOG}"', script)
+        self.assertNotIn('sed -i', script)
+        self.assertLess(script.index('function obc_render_report()'), script.index(executor.BaseExecutor.render_report_on_exit_bash))
+        self.assertIn('obc_render_report', executor.bash_patterns['final_report'])
+
+        # The executors with one script per step render it once, in the final step. Steps render it only if they fail
+        dag = executor.AirflowExecutor(workflow).build(output=None, workflow_id='abc')
+        self.assertEqual(len(re.findall(r'^obc_render_report$', dag, re.MULTILINE)), 1)
+        self.assertGreater(dag.count(executor.BaseExecutor.render_report_on_failure_bash), 1)
+        self.assertNotIn(executor.BaseExecutor.render_report_on_exit_bash, dag)
+
+    @unittest.skipIf(shutil.which('bash') is None, 'bash is not installed')
+    def test_report_failed_step(self):
+        def run(step):
+            script = 'obc_render_report() { echo rendered; }\n' + executor.BaseExecutor.render_report_on_failure_bash + step
+            result = subprocess.run(['bash', '-c', script], stdout=subprocess.PIPE, timeout=60)
+            return result.stdout.decode(), result.returncode
+        self.assertEqual(run('echo step\n'), ('step\n', 0))
+        self.assertEqual(run('echo step\nexit 3\n'), ('step\nrendered\n', 3))
+
+    @unittest.skipIf(shutil.which('bash') is None, 'bash is not installed')
+    def test_report_failed_run(self):
+        # The report of a run that fails has what was reported until then
+        _, workflow = self.executable_workflow(main_bash='REPORT before "a<b"\nexit 1\nREPORT after 1\n')
+        _, work_path = self.run_script(executor.LocalExecutor(workflow).build(output=None))
+        with open(os.path.join(work_path, workflow.nice_id_global + '.html')) as f:
+            report = f.read()
+        self.assertIn('before=a&lt;b</li>', report)
+        self.assertNotIn('after', report)
+
+    @unittest.skipIf(shutil.which('bash') is None, 'bash is not installed')
+    def test_parallel_caller(self):
+        # The steps that PARALLEL runs are reported as called from the step that called PARALLEL
+        _, workflow = self.executable_workflow(main_bash='PARALLEL step__other__pipeline__1 step__other__pipeline__1\nstep__other__pipeline__1\n', token=self.TOKEN)
+        posted, _ = self.run_script(executor.LocalExecutor(workflow).build(output=None))
+        statuses = [x['status'] for x in posted]
+        self.assertEqual(statuses.count('step started step__other__pipeline__1 step__main__pipeline__1'), 3)
+        self.assertEqual(statuses.count('step started step__main__pipeline__1 main'), 1)
+
+    def test_find_circle(self):
+        # Diamonds are not circles
+        self.assertIsNone(executor.find_circle({'samtools': ['htslib', 'bzip2'], 'htslib': ['zlib'], 'bzip2': ['zlib'], 'zlib': []}))
+        self.assertEqual(executor.find_circle({'samtools': ['htslib'], 'htslib': ['zlib'], 'zlib': ['htslib']}), ['zlib', 'htslib'])
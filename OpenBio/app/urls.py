@@ -42,6 +42,7 @@ urlpatterns = [
 	path('tools_search_3/', views.tools_search_3), # Search for a specific tool
 	path('tools_add/', views.tools_add), # Add a new tool
 	path('ro_finalize_delete/', views.ro_finalize_delete), # Finalize (from draft to no draft) or delete a Research Object (ro) 
+	path('job_status/', views.job_status), # Status of the background update of the workflows that use an edited / finalized tool or workflow
 	path('tool_get_dependencies/', views.tool_get_dependencies), # Get a JSTREE with a dependencies of this tool
 	path('workflows_add/', views.workflows_add), # Add (or Save) a new workflow 
 	path('workflows_search_3/', views.workflows_search_3), # Search (and get the details) for a specific SINGLE workflow. 
@@ -53,7 +54,10 @@ urlpatterns = [
 	path('tool_validation_status/', views.tool_validation_status), # Query validation status if tool
 	re_path(r'^tool_stdout/(?P<tools_info_name>[\w]+)/(?P<tools_info_version>[\w\.]+)/(?P<tools_info_edit>[\d]+)/$', views.tools_show_stdout), # Show stdout of tool
 	path('report/', views.report), # Called from executor.py 
+	path('report_batch/', views.report_batch), # Called from executor.py (sh scripts with batch reporting)
 	path('all_search_2/', views.all_search_2), # Called on main search on-change . Construct jstrees. 
+	path('tools_search_jstree_level/', views.tools_search_jstree_level), # Called when a node of the tools search jstree opens or "More.." is clicked
+	path('workflows_search_jstree_level/', views.workflows_search_jstree_level), # Same for workflows search jstree
 	path('reports_search_3/', views.reports_search_3), # Search (and get the details) for a specific SINGLE Report. 
 	path('reports_refresh/', views.reports_refresh), # The user pressed refresh on a report. Get an update from the update. 
 	path('references_generate/', views.references_generate), # Generate a HTML reference from BIBTEX 
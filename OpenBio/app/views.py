@@ -16,6 +16,8 @@ from django.core.mail import send_mail
 from django.db.models import Q # https://docs.djangoproject.com/en/2.1/topics/db/queries/#complex-lookups-with-q-objects
 from django.db.models import Max # https://docs.djangoproject.com/en/2.1/topics/db/aggregation/
 from django.db.models import Count # https://stackoverflow.com/questions/7883916/django-filter-the-model-on-manytomany-count 
+from django.db import transaction
+from django.db.models import prefetch_related_objects # https://docs.djangoproject.com/en/2.2/ref/models/querysets/#prefetch-related-objects
 
 from django.utils import timezone
 #from django.utils.html import escape # https://docs.djangoproject.com/en/2.2/ref/utils/#module-django.utils.html
@@ -27,11 +29,19 @@ from django.middleware.csrf import get_token
 
 #Import database objects
 from app.models import OBC_user, Tool, Workflow, Variables, ToolValidations, \
-    OS_types, Keyword, Report, ReportToken, Reference, ReferenceField, Comment, \
-    UpDownCommentVote, UpDownToolVote, UpDownWorkflowVote, ExecutionClient
+    OS_types, Keyword, Report, ReportToken, ReportEvent, Reference, ReferenceField, Comment, \
+    UpDownCommentVote, UpDownToolVote, UpDownWorkflowVote, ExecutionClient, \
+    SearchEntry, ToolClosure, WorkflowUpdateJob
 
 from app.models import create_nice_id
 
+# Search index
+from app.search import search as search_index
+from app.search import match as search_index_match
+from app.search import search_roots as search_index_roots
+from app import detail_cache
+from app import artifact_cache
+
 #Import executor
 from ExecutionEnvironment.executor import create_bash_script, OBC_Executor_Exception
 
@@ -45,6 +55,7 @@ from social_core.pipeline.social_auth import social_details
 
 # System imports 
 import io
+import copy
 import os
 import re
 import six
@@ -92,6 +103,8 @@ g = {
     'VARIABLES_TOOL_TREE_ID': '3',
     'SEARCH_WORKFLOW_TREE_ID': '4',
     'SEARCH_REPORT_TREE_ID': '5',
+    'search_result_limit': 200, # Max number of results of each type (tools, workflows, ...) that main search returns. For tools and workflows this is the page size of each tree level
+    'report_batch_max_statuses': 1000, # Max number of statuses that report_batch accepts in one request
     'format_time_string' : '%a, %d %b %Y %H:%M:%S', # RFC 2822 Internet email standard. https://docs.python.org/2/library/time.html#time.strftime   # '%Y-%m-%d, %H:%M:%S'
 
     'instance_settings' : {
@@ -736,42 +749,90 @@ def tool_variable_id_jstree(variable, tool, id_):
         str(id_), 
         tool.name, tool.version, tool.edit])
 
-def tool_get_dependencies_internal(tool, include_as_root=False):
+def tool_get_dependencies_internal(tool, include_as_root=False, unique=False):
     '''
     Get the dependencies of this tool in a flat list
-    Recursive
     include_as_root: Should we add this tool as root?
+    unique: Add each tool once. If two tools depend on the same tool (diamond), only the first path to it is added.
+        Without this, a tool is added once for every path that leads to it.
+
+    All the dependencies (direct or not) come from ToolClosure, so this takes 2 queries regardless of the depth.
+    The list is then built in memory (Depth first, as tool.dependencies.all() would give)
+    If the closure is missing or stale (i.e. before scripts/migrate_5.py), the tools that it misses are fetched from the direct edges (a few more queries)
 
     'dependant' needs dependencies..
     '''
 
+    tools = {t.pk: t for t in Tool.objects.filter(closure_dependants_related__tool=tool)}
+    tools[tool.pk] = tool
+
+    dependencies = defaultdict(list)
+    queried = set()
+    while len(queried) < len(tools):
+        from_pks = [pk for pk in tools if not pk in queried]
+        queried.update(from_pks)
+        edges = list(Tool.dependencies.through.objects.filter(from_tool_id__in=from_pks).order_by('pk').values_list('from_tool_id', 'to_tool_id'))
+        missing = {to_pk for _, to_pk in edges if not to_pk in tools}
+        if missing:
+            tools.update((t.pk, t) for t in Tool.objects.filter(pk__in=missing))
+        for from_pk, to_pk in edges:
+            dependencies[from_pk].append(tools[to_pk])
+
+    added = {tool.pk}
+    def tool_get_dependencies_recursive(dependant):
+        ret = []
+        for dependent_tool in dependencies[dependant.pk]:
+            if unique:
+                if dependent_tool.pk in added:
+                    continue
+                added.add(dependent_tool.pk)
+            ret.append({
+                'dependant': dependant,
+                'dependency': dependent_tool
+            })
+            ret.extend(tool_get_dependencies_recursive(dependent_tool))
+        return ret
+
     if include_as_root:
         ret = [{'dependant': None, 'dependency': tool}]
     else:
         ret = []
 
-    for dependent_tool in tool.dependencies.all():
-        ret.append({
-            'dependant': tool,
-            'dependency': dependent_tool
-        })
-        ret.extend(tool_get_dependencies_internal(dependent_tool, include_as_root=False))
+    ret.extend(tool_get_dependencies_recursive(tool))
 
     return ret
 
-def tool_build_dependencies_jstree(tool_dependencies, add_variables=False, add_installation_commands=False):
+def tool_build_dependencies_jstree(tool_dependencies, add_installation_commands=False):
     '''
-    Build JS TREE from tool_dependencies
+    Build two JS TREEs from tool_dependencies in one pass:
+    The dependencies jstree and the dependencies + variables jstree
+    Returns both: tool_dependencies_jstree, tool_variables_jstree
 
-    add_variables:  Also add tool/data variables
-    add_installation_commands: All installation_commands + validation_commands + os_choices 
+    Each tool is added once, even if it is a dependency of more than one tools (a jstree node has one parent anyway).
+    The variables (and os_choices, dependencies) of all tools are fetched with one query each. 
+
+    add_installation_commands: All installation_commands + validation_commands + os_choices (only on the dependencies jstree) 
 
     ATTENTION: THIS IS NOT GENERIC!!! 
     IT uses g['DEPENDENCY_TOOL_TREE_ID']. 
     '''
 
-    tool_dependencies_jstree = []
+    unique_tool_dependencies = []
+    added = set()
     for tool_dependency in tool_dependencies:
+        if not tool_dependency['dependency'].pk in added:
+            added.add(tool_dependency['dependency'].pk)
+            unique_tool_dependencies.append(tool_dependency)
+
+    prefetch_related_objects(
+        [tool_dependency['dependency'] for tool_dependency in unique_tool_dependencies], 
+        'variables', 
+        *(['os_choices', 'dependencies'] if add_installation_commands else [])
+    )
+
+    tool_dependencies_jstree = []
+    tool_variables_jstree = []
+    for tool_dependency in unique_tool_dependencies:
         to_append = {
 
             'data': {
@@ -794,6 +855,8 @@ def tool_build_dependencies_jstree(tool_dependencies, add_variables=False, add_i
             'draft': tool_dependency['dependency'].draft,
 
         }
+        tool_variables_jstree.append(dict(to_append))
+
         if add_installation_commands:
             to_append['installation_commands'] = tool_dependency['dependency'].installation_commands
             to_append['validation_commands'] = tool_dependency['dependency'].validation_commands
@@ -803,22 +866,21 @@ def tool_build_dependencies_jstree(tool_dependencies, add_variables=False, add_i
         tool_dependencies_jstree.append(to_append)
 
         # Add the variables of this tool
-        if add_variables:
-            for variable in tool_dependency['dependency'].variables.all():
-                tool_dependencies_jstree.append({
-                    'data': {
-                        'type': 'variable',
-                        'name': variable.name,
-                        'value': variable.value,
-                        'description': variable.description,
-                    },
-                    'text': tool_variable_node_jstree(variable),
-                    'id': tool_variable_id_jstree(variable, tool_dependency['dependency'], g['VARIABLES_TOOL_TREE_ID']),
-                    'parent': tool_id_jstree(tool_dependency['dependency'], g['DEPENDENCY_TOOL_TREE_ID']),
-                    'type': 'variable', # TODO: FIX REDUNDANCY WITH ['data']['type']
-                })
-
-    return tool_dependencies_jstree
+        for variable in tool_dependency['dependency'].variables.all():
+            tool_variables_jstree.append({
+                'data': {
+                    'type': 'variable',
+                    'name': variable.name,
+                    'value': variable.value,
+                    'description': variable.description,
+                },
+                'text': tool_variable_node_jstree(variable),
+                'id': tool_variable_id_jstree(variable, tool_dependency['dependency'], g['VARIABLES_TOOL_TREE_ID']),
+                'parent': tool_id_jstree(tool_dependency['dependency'], g['DEPENDENCY_TOOL_TREE_ID']),
+                'type': 'variable', # TODO: FIX REDUNDANCY WITH ['data']['type']
+            })
+
+    return tool_dependencies_jstree, tool_variables_jstree
 
 
 ### HELPING FUNCTIONS AND DECORATORS END #######
@@ -1174,14 +1236,11 @@ def users_search_2(
     Collect all users from main search
     '''
 
-    username_Q = Q(user__username__icontains=main_search)
-    affiliation_Q = Q(affiliation__icontains=main_search)
-    publicinfo_Q = Q(public_info__icontains=main_search)
-
-    results = OBC_user.objects.filter(username_Q | affiliation_Q | publicinfo_Q)
+    results_number, results_pks = search_index(main_search, SearchEntry.USER, OBC_user.objects.all(), g['search_result_limit'])
+    results = OBC_user.objects.select_related('user').in_bulk(results_pks)
 
     users_search_jstree = []
-    for result in results:
+    for result in map(results.get, results_pks): # Keep the ranking
         to_add = {
             'data': {'username': result.user.username},
             'text': result.user.username + jstree_icon_html('users'),
@@ -1192,7 +1251,7 @@ def users_search_2(
         users_search_jstree.append(to_add)
 
     ret = {
-        'main_search_users_number': results.count(),
+        'main_search_users_number': results_number,
         'users_search_jstree': users_search_jstree,
     }
 
@@ -1695,17 +1754,61 @@ def tools_search_1(request, **kwargs):
     return success(ret)
 
 
-def tools_search_2(tools_search_name, tools_search_version, tools_search_edit):
+def search_jstree_level(matches, parent_pk, cursor):
+    '''
+    Paginate the fork tree of the tools / workflows search results
+    matches is the ranked queryset of SearchEntries that app.search.match returns.
+    parent_pk is the level that we want. None is the top level: the matches that are not forks of other matches.
+    cursor is the number of the results of this level in the previous pages
+    Returns: the pks of this page, the pks of this page that have forks in matches, the cursor of the next page (None: this is the last page) 
+    The level, its order and the page are selected in the database (2 queries)
+    '''
+    limit = g['search_result_limit']
+    if parent_pk is None:
+        level = matches.filter(Q(parent_pk__isnull=True) | ~Q(parent_pk__in=matches.order_by().values('object_pk')))
+    else:
+        level = matches.filter(parent_pk=parent_pk)
+
+    page = list(level.values_list('object_pk', flat=True)[cursor:cursor + limit + 1]) # One more, to know if there is a next page
+    next_cursor = cursor + limit if len(page) > limit else None
+    page = page[:limit]
+
+    with_forks = set(matches.filter(parent_pk__in=page).order_by().values_list('parent_pk', flat=True).distinct())
+
+    return page, with_forks, next_cursor
+
+def search_jstree_placeholder(parent_id):
+    '''
+    A not loaded child of a jstree node. 
+    When the parent node opens, the UI replaces it with the real children
+    '''
+    return {
+        'data': {'placeholder': True},
+        'text': 'Loading..',
+        'id': simplejson.dumps([parent_id, 'placeholder']),
+        'parent': parent_id,
+    }
+
+def search_jstree_more(parent_id, cursor):
+    '''
+    The last node of a page of a jstree level. 
+    When clicked, the UI replaces it with the next page
+    '''
+    return {
+        'data': {'more': True, 'cursor': cursor},
+        'text': 'More..',
+        'id': simplejson.dumps([parent_id, 'more', str(cursor)]),
+        'parent': parent_id,
+    }
+
+def tools_search_2(tools_search_name, tools_search_version, tools_search_edit, parent=None, cursor=0):
     '''
     This is triggered when there is a key-change on the main-search
+    Returns one page of one level of the tree (see search_jstree_level). 
+    parent is the Tool whose forks we want. None is the top level.
     '''
 
     Qs = []
-    if tools_search_name:
-        Q1 = Q(name__icontains=tools_search_name)
-        Q2 = Q(obc_user__user__username__icontains=tools_search_name)
-        Qs.append(Q1 | Q2)
-
     if tools_search_version:
         Qs.append(Q(version__icontains=tools_search_version))
 
@@ -1715,67 +1818,78 @@ def tools_search_2(tools_search_name, tools_search_version, tools_search_edit):
 
 
     # This applies an AND operator. https://docs.djangoproject.com/en/2.2/topics/db/queries/#complex-lookups-with-q-objects 
-    # For the order_by part see issue #120
-    results = Tool.objects.filter(*Qs).order_by('created_at') 
+    # The name (or username) is searched in the search index
+    matches = search_index_match(tools_search_name, SearchEntry.TOOL, Tool.objects.filter(*Qs))
+    results_pks, with_forks, next_cursor = search_jstree_level(matches, parent.pk if parent else None, cursor)
+    results = Tool.objects.in_bulk(results_pks)
 
     # { id : 'ajson1', parent : '#', text : 'KARAPIPERIM', state: { opened: true} }
 
     # Build JS TREE structure
+    # Parents are always in an upper level, so the issue #120 (parents should be before children) does not apply here.
 
+    parent_id = tool_id_jstree(parent, g['SEARCH_TOOL_TREE_ID']) if parent else '#'
     tools_search_jstree = []
-    for x in results:
+    for x in map(results.get, results_pks): # Keep the ranking
         to_add = {
             'data': {'name': x.name, 'version': x.version, 'edit': x.edit},
             'text': tool_node_jstree(x), #  tool_text_jstree(x) + (' <span class="red lighten-3">DRAFT</span>' if x.draft else '') + jstree_icon_html('tools'),
             'id': tool_id_jstree(x, g['SEARCH_TOOL_TREE_ID']),
-            'parent': tool_id_jstree(x.forked_from, g['SEARCH_TOOL_TREE_ID']) if x.forked_from else '#',
-            'state': { 'opened': True},
+            'parent': parent_id,
+            'state': { 'opened': False},
         }
         tools_search_jstree.append(to_add)
+        if x.pk in with_forks:
+            tools_search_jstree.append(search_jstree_placeholder(to_add['id']))
+
+    if not next_cursor is None:
+        tools_search_jstree.append(search_jstree_more(parent_id, next_cursor))
 
     ret = {
-        'tools_search_tools_number' : results.count(),
+        'tools_search_tools_number' : matches.count(),
         #'tools_search_list': [{'name': x.name, 'version': x.version, 'edit': x.edit} for x in results], # We do not need a list, we need a tree!
         'tools_search_jstree' : tools_search_jstree,
     }
 
     return ret
 
-def workflows_search_2(workflows_search_name, workflows_search_edit):
+def workflows_search_2(workflows_search_name, workflows_search_edit, parent=None, cursor=0):
     '''
     Called by all_search_2
+    Returns one page of one level of the tree. See tools_search_2 
     '''
 
     Qs = []
-    #workflows_search_name = kwargs.get('workflows_search_name', '')
-    if workflows_search_name:
-        Q1 = Q(name__icontains=workflows_search_name)
-        Q2 = Q(obc_user__user__username__icontains=workflows_search_name)
-        Qs.append(Q1 | Q2)
-
     #workflows_search_edit = kwargs.get('workflows_search_edit', '')
     if workflows_search_edit:
         Qs.append(Q(edit = int(workflows_search_edit)))
 
-    # For the order_by part see issue #120 
-    results = Workflow.objects.filter(*Qs).order_by('created_at')
+    # The name (or username) is searched in the search index
+    matches = search_index_match(workflows_search_name, SearchEntry.WORKFLOW, Workflow.objects.filter(*Qs))
+    results_pks, with_forks, next_cursor = search_jstree_level(matches, parent.pk if parent else None, cursor)
+    results = Workflow.objects.in_bulk(results_pks)
 
     # Build JS TREE structure
     
+    parent_id = workflow_id_jstree(parent, g['SEARCH_WORKFLOW_TREE_ID']) if parent else '#'
     workflows_search_jstree = []
-    for x in results:
+    for x in map(results.get, results_pks): # Keep the ranking
         to_add = {
             'data': {'name': x.name, 'edit': x.edit},
             'text': workflow_node_jstree(x),
             'id': workflow_id_jstree(x, g['SEARCH_WORKFLOW_TREE_ID']),
-            'parent': workflow_id_jstree(x.forked_from, g['SEARCH_WORKFLOW_TREE_ID']) if x.forked_from else '#',
-            'state': { 'opened': True},
+            'parent': parent_id,
+            'state': { 'opened': False},
         }
         workflows_search_jstree.append(to_add)
-        
+        if x.pk in with_forks:
+            workflows_search_jstree.append(search_jstree_placeholder(to_add['id']))
+
+    if not next_cursor is None:
+        workflows_search_jstree.append(search_jstree_more(parent_id, next_cursor))
 
     ret = {
-        'workflows_search_tools_number' : results.count(),
+        'workflows_search_tools_number' : matches.count(),
         'workflows_search_jstree' : workflows_search_jstree,
     }
 
@@ -1791,20 +1905,33 @@ def tools_search_3(request, **kwargs):
     tool_version = kwargs.get('tool_version', '')
     tool_edit = int(kwargs.get('tool_edit', -1))
 
-    tool = Tool.objects.get(name__iexact=tool_name, version__iexact=tool_version, edit=tool_edit)
+    key = detail_cache.tool_key(tool_name, tool_version, tool_edit)
+    ret = detail_cache.get_document(key)
+    if ret is None:
+        tool = Tool.objects.get(name__iexact=tool_name, version__iexact=tool_version, edit=tool_edit)
+        ret = tool_detail_document(tool)
+        detail_cache.set_document(key, ret)
 
-    #Get the dependencies of this tool and build a JSTREE
-    tool_dependencies_jstree = []
-    for dependency in tool.dependencies.all():
-        dependency_js_tree = tool_build_dependencies_jstree(tool_get_dependencies_internal(dependency, include_as_root=True))
-        tool_dependencies_jstree.extend(dependency_js_tree)
+    # Add the votes of this user
+    ro_detail_add_votes(ret, get_obc_user(request), 'tool')
 
-    #Get the dependencies of this tool AND the variables and build a JSTREE
-    #FIXME: Duplicate code
-    tool_variables_jstree = []
-    for dependency in tool.dependencies.all():
-        variables_js_tree = tool_build_dependencies_jstree(tool_get_dependencies_internal(dependency, include_as_root=True), add_variables=True)
-        tool_variables_jstree.extend(variables_js_tree)
+    return success(ret)
+
+def tool_detail_document(tool):
+    '''
+    Everything that tools_search_3 returns except from the votes of the user.
+    This is cached (see detail_cache.py)
+    '''
+
+    #Get the dependencies of this tool. 
+    #The direct dependencies are the roots of the tree (this tool is not in the tree)
+    tool_dependencies = [
+        {'dependant': None if d['dependant'] is tool else d['dependant'], 'dependency': d['dependency']}
+        for d in tool_get_dependencies_internal(tool, include_as_root=False, unique=True)
+    ]
+
+    #Build the JSTREEs of the dependencies and of the dependencies AND the variables 
+    tool_dependencies_jstree, tool_variables_jstree = tool_build_dependencies_jstree(tool_dependencies)
 
     #print ('LOGGG DEPENDENIES + VARIABLES')
     #print (tool_variables_jstree)
@@ -1815,26 +1942,6 @@ def tools_search_3(request, **kwargs):
     for variable in tool.variables.all():
         tool_variables.append({'name': variable.name, 'value': variable.value, 'description': variable.description})
 
-    # Get obc_user
-    if request.user.is_anonymous:
-        obc_user = None
-    else:
-        obc_user = OBC_user.objects.get(user=request.user)
-
-    #Is it voted?
-    if obc_user:
-        try:
-            v = UpDownToolVote.objects.get(obc_user=obc_user, tool=tool)
-        except ObjectDoesNotExist as e:
-            # It is not voted
-            tool_voted = {'up': False, 'down': False}
-        else:
-            # It is noted
-            tool_voted = {'up': v.upvote, 'down': not v.upvote}
-
-    else:
-        tool_voted = {'up': False, 'down': False}
-
     ret = {
         'website': tool.website,
         'description': tool.description,
@@ -1861,9 +1968,8 @@ def tools_search_3(request, **kwargs):
         'errcode' : tool.last_validation.errcode if tool.last_validation else None,
         'validation_created_at' : datetime_to_str(tool.last_validation.created_at) if tool.last_validation else None,
         'tool_pk': tool.pk, # Used in comments
-        'tool_thread': qa_create_thread(tool.comment, obc_user), # Tool comment thread. This is a list
+        'tool_thread': qa_create_thread(tool.comment), # Tool comment thread. This is a list
         'tool_score': tool.upvotes - tool.downvotes,
-        'tool_voted': tool_voted,
         'tool_comment_id': tool.comment.pk, # Used to create a permalink to the comments
         'tool_comment_title': tool.comment.title,
         'tool_comment_created_at': datetime_to_str(tool.comment.created_at),
@@ -1877,7 +1983,7 @@ def tools_search_3(request, **kwargs):
     #print ('LOGGG DEPENDENCIES + VARIABLES')
     #print (simplejson.dumps(tool_variables_jstree, indent=4))
 
-    return success(ret)
+    return ret
 
 @has_data
 def tool_get_dependencies(request, **kwargs):
@@ -1906,11 +2012,10 @@ def tool_get_dependencies(request, **kwargs):
     tool = Tool.objects.get(name=tool_name, version=tool_version, edit=tool_edit)
 
     #Get the dependencies of this tool
-    tool_dependencies = tool_get_dependencies_internal(tool, include_as_root=True)
-    tool_dependencies_jstree = tool_build_dependencies_jstree(tool_dependencies, add_installation_commands=what_to_do==2)
+    tool_dependencies = tool_get_dependencies_internal(tool, include_as_root=True, unique=True)
 
-    #Get the dependencies + variables of this tool
-    tool_variables_jstree = tool_build_dependencies_jstree(tool_dependencies, add_variables=True)
+    #Get the dependencies and the dependencies + variables of this tool
+    tool_dependencies_jstree, tool_variables_jstree = tool_build_dependencies_jstree(tool_dependencies, add_installation_commands=what_to_do==2)
 
     #print ('LOGGG DEPENDENCIES')
     #print (simplejson.dumps(tool_dependencies_jstree, indent=4))
@@ -2185,11 +2290,13 @@ def tools_add(request, **kwargs):
             workflow_using_this_tool.tools.add(new_tool)
             workflow_using_this_tool.save()
 
-        # Update the json graph of the workflows using this tool
-        WJ = WorkflowJSON()
-        WJ.update_tool(new_tool)
+        # The tools that depended on the old tool, now depend on the new
+        ToolClosure.update([new_tool])
 
     else:
+        # The new tool has no dependants. 
+        ToolClosure.update([new_tool])
+
         #Add an empty comment. This will be the root comment for the QA thread
         comment = Comment(
             obc_user = OBC_user.objects.get(user=request.user),
@@ -2205,10 +2312,14 @@ def tools_add(request, **kwargs):
     new_tool.comment = comment
     new_tool.save()
 
+    # Update the json graph of the workflows using this tool. This happens in the background (see run_workflow_update_jobs)
+    job_id = WorkflowUpdateJob.enqueue(WorkflowUpdateJob.TOOL, new_tool).pk if tool_edit_state else None
+
     ret = {
         'description_html': tool_description_html, 
         'edit': next_edit,
         'created_at': datetime_to_str(new_tool.created_at),
+        'job_id': job_id, # See job_status
 
         'tool_pk': new_tool.pk, # Used in comments
         'tool_thread': qa_create_thread(new_tool.comment, obc_user), # Tool comment thread 
@@ -2224,6 +2335,12 @@ class WorkflowJSON:
     Basically a function collection for dealing with the workflow json object
     '''
 
+    def __init__(self, progress=None):
+        '''
+        progress(done, total) is called while the workflows that use the updated tool / workflow are updated
+        '''
+        self.progress = progress
+
     def update_workflow(self, workflow):
         '''
         workflow is a database Workflow opbject
@@ -2232,9 +2349,16 @@ class WorkflowJSON:
         self.key = workflow_id_cytoscape(self.workflow, None, None)
         self.graph = simplejson.loads(self.workflow.workflow)
         self.all_ids = {node['data']['id'] for node in self.graph['elements']['nodes']} # All node ids
-        self.workflows_using_me = Workflow.objects.filter(workflows__in = [self.workflow])
         self.belongto, self.workflow_nodes = self.__build_workflow_belongto(self.graph)
-        self.__update_workflow()
+
+        # Update this workflow
+        self.__update_workflow_node(self.workflow_nodes[self.key], self.workflow)
+        self.workflow.workflow = simplejson.dumps(self.graph)
+        self.workflow.save(update_fields=['workflow'])
+
+        # Update the workflows that are using me
+        workflows_using_me = Workflow.workflows.through.objects.filter(to_workflow_id=self.workflow.pk).values_list('from_workflow_id', flat=True)
+        self.__propagate(workflows_using_me, lambda graph: self.__splice_workflow(graph, self.key, self.graph, self.all_ids, self.workflow), root_pk=self.workflow.pk)
 
     def update_tool(self, tool):
         '''
@@ -2243,9 +2367,11 @@ class WorkflowJSON:
         self.tool = tool
         self.graph = self.__create_cytoscape_graph_from_tool_dependencies(self.tool)
         self.all_ids = {node['data']['id'] for node in self.graph['elements']['nodes']} # All node ids
-        self.workflows_using_me = Workflow.objects.filter(tools__in = [self.tool])
         self.key = tool_id_cytoscape(self.tool)
-        self.__update_tool()
+
+        # Update the workflows that are using me
+        workflows_using_me = Workflow.tools.through.objects.filter(tool_id=self.tool.pk).values_list('workflow_id', flat=True)
+        self.__propagate(workflows_using_me, self.__splice_tool)
 
     def __iter_workflows(self, graph):
         '''
@@ -2444,61 +2570,69 @@ class WorkflowJSON:
         # Remove nodes
         graph['elements']['nodes'] = [node for node in graph['elements']['nodes'] if not node['data']['id'] in node_ids_to_remove]
 
-    def __consistency_check_graph_model(self, graph, workflow):
+    def __consistency_check_graph_model(self, workflows_graphs):
         '''
         Whenever we update the graph of a workflow, we have to make sure that all tools/workflows that this graph has, do exist in the model
         We also need to check the opposite: All tools/workflows that exist in the model also exist in the graph
+        workflows_graphs is a list of (workflow, graph). All of them are checked together with a fixed number of queries.
         '''
 
-        workflow_using_me_tools = workflow.tools.all()
-        tools_found = {str(t): [False, t] for t in workflow_using_me_tools}
-
-        workflow_using_me_workflow = workflow.workflows.all()
-        workflows_found = {str(w): [False, w] for w in workflow_using_me_workflow}
-
-        for node in graph['elements']['nodes']:
-            if node['data']['type'] == 'tool':
-                if node['data']['disconnected']:
-                    continue
-
-                # This is a tool does it exist in the model?
-                this_tool = Tool.objects.get(name=node['data']['name'], version=node['data']['version'], edit=node['data']['edit'])
-                if not workflow_using_me_tools.filter(pk=this_tool.pk).exists():
-                    # This tools does not exist in the model but exists on the graph. Add it!
-                    workflow.tools.add(this_tool)
-                else:
-                    tools_found[str(this_tool)][0] = True
-
-            if node['data']['type'] == 'workflow':
-                if node['data']['disconnected']:
-                    continue
-
-                if not node['data']['belongto']:
-                    continue # Do not connect the root workflow 
-
-                this_workflow = Workflow.objects.get(name=node['data']['name'], edit=node['data']['edit'])
-                if not workflow_using_me_workflow.filter(pk=this_workflow.pk).exists():
-                    # This workflow does not exist in the model but exists on the graph. Add it!
-                    workflow.workflows.add(this_workflow)
-                else:
-                    workflows_found[str(this_workflow)][0] = True
-
-        workflow.save()
-
-        # Is there any tool that exist on the model, but it does not exist on the graph?
-        for tool_id, (exists, this_tool) in tools_found.items():
-            if not exists:
-                # This tool exists on the model but not in the graph. REMOVE IT!
-                workflow.tools.remove(this_tool)
-
-        # Is there any workflow that exists on the model, but it does not exist on the graph?
-        for workflow_id, (exists, this_workflow) in workflows_found.items():
-            if not exists:
-                # Remove this workflow from the model
-                workflow.workflows.remove(this_workflow)
-
-        workflow.save()
-
+        tool_through = Workflow.tools.through
+        workflow_through = Workflow.workflows.through
+
+        # The tools and workflows of each graph
+        graph_tools = {} # workflow pk --> set of (name, version, edit)
+        graph_workflows = {} # workflow pk --> set of (name, edit)
+        for workflow, graph in workflows_graphs:
+            graph_tools[workflow.pk] = set()
+            graph_workflows[workflow.pk] = set()
+            for node in graph['elements']['nodes']:
+                if node['data']['type'] == 'tool':
+                    if node['data']['disconnected']:
+                        continue
+                    graph_tools[workflow.pk].add((node['data']['name'], node['data']['version'], int(node['data']['edit'])))
+
+                if node['data']['type'] == 'workflow':
+                    if node['data']['disconnected']:
+                        continue
+                    if not node['data']['belongto']:
+                        continue # Do not connect the root workflow 
+                    graph_workflows[workflow.pk].add((node['data']['name'], int(node['data']['edit'])))
+
+        # The database objects of the graph nodes
+        tool_names = {name for tools in graph_tools.values() for name, _, _ in tools}
+        tool_pks = {(name, version, edit): pk for name, version, edit, pk in Tool.objects.filter(name__in=tool_names).values_list('name', 'version', 'edit', 'pk')}
+        workflow_names = {name for workflows in graph_workflows.values() for name, _ in workflows}
+        workflow_pks = {(name, edit): pk for name, edit, pk in Workflow.objects.filter(name__in=workflow_names).values_list('name', 'edit', 'pk')}
+
+        # The tools and workflows of each model
+        pks = list(graph_tools)
+        model_tools = defaultdict(dict) # workflow pk --> tool pk --> through pk
+        for through_pk, workflow_pk, tool_pk in tool_through.objects.filter(workflow_id__in=pks).values_list('pk', 'workflow_id', 'tool_id'):
+            model_tools[workflow_pk][tool_pk] = through_pk
+        model_workflows = defaultdict(dict) # workflow pk --> workflow pk --> through pk
+        for through_pk, workflow_pk, used_workflow_pk in workflow_through.objects.filter(from_workflow_id__in=pks).values_list('pk', 'from_workflow_id', 'to_workflow_id'):
+            model_workflows[workflow_pk][used_workflow_pk] = through_pk
+
+        tools_to_add, workflows_to_add, to_remove = [], [], {'tools': [], 'workflows': []}
+        for pk in pks:
+            this_graph_tools = {tool_pks[x] for x in graph_tools[pk] if x in tool_pks}
+            this_graph_workflows = {workflow_pks[x] for x in graph_workflows[pk] if x in workflow_pks}
+
+            # Tools / workflows that exist on the graph but not in the model. Add them!
+            tools_to_add.extend(tool_through(workflow_id=pk, tool_id=tool_pk) for tool_pk in this_graph_tools - set(model_tools[pk]))
+            workflows_to_add.extend(workflow_through(from_workflow_id=pk, to_workflow_id=workflow_pk) for workflow_pk in this_graph_workflows - set(model_workflows[pk]))
+
+            # Tools / workflows that exist on the model but not in the graph. REMOVE THEM!
+            to_remove['tools'].extend(through_pk for tool_pk, through_pk in model_tools[pk].items() if not tool_pk in this_graph_tools)
+            to_remove['workflows'].extend(through_pk for workflow_pk, through_pk in model_workflows[pk].items() if not workflow_pk in this_graph_workflows)
+
+        tool_through.objects.bulk_create(tools_to_add)
+        workflow_through.objects.bulk_create(workflows_to_add)
+        if to_remove['tools']:
+            tool_through.objects.filter(pk__in=to_remove['tools']).delete()
+        if to_remove['workflows']:
+            workflow_through.objects.filter(pk__in=to_remove['workflows']).delete()
 
     def __update_workflow_node(self, workflow_node, workflow_object):
         '''
@@ -2506,143 +2640,265 @@ class WorkflowJSON:
         '''
         workflow_node['data']['draft'] = workflow_object.draft
 
-    def __update_workflow(self,):
+    def __affected_workflows(self, workflows_using_me, root_pk):
         '''
-        update this workflow
+        workflows_using_me: pks of the workflows that use the updated tool / workflow
+        root_pk: pk of the updated workflow (None for tools)
+        Returns all the workflows that use them (directly or through other workflows) in topological order:
+        Every workflow comes after all the workflows that it uses.
+        Returns a list of (workflow, the affected workflows that it uses)
         '''
 
-        self.__update_workflow_node(self.workflow_nodes[self.key], self.workflow)
-        self.workflow.workflow = simplejson.dumps(self.graph)
-        self.workflow.save()
-
+        affected = set(workflows_using_me)
+        uses = defaultdict(set) # workflow pk --> affected workflow pks that it uses
+        frontier = set(affected)
+        while frontier:
+            edges = Workflow.workflows.through.objects.filter(to_workflow_id__in=frontier).values_list('from_workflow_id', 'to_workflow_id')
+            frontier = set()
+            for from_pk, to_pk in edges:
+                if from_pk == root_pk:
+                    continue # Do not go back to the updated workflow
+                uses[from_pk].add(to_pk)
+                if not from_pk in affected:
+                    affected.add(from_pk)
+                    frontier.add(from_pk)
+
+        # Kahn's algorithm
+        used_by = defaultdict(list)
+        for from_pk, to_pks in uses.items():
+            for to_pk in to_pks:
+                used_by[to_pk].append(from_pk)
+        remaining = {pk: len(uses[pk]) for pk in affected}
+        ready = sorted(pk for pk, n in remaining.items() if n == 0)
+        order = []
+        while ready:
+            pk = ready.pop()
+            order.append(pk)
+            for user_pk in used_by[pk]:
+                remaining[user_pk] -= 1
+                if remaining[user_pk] == 0:
+                    ready.append(user_pk)
+
+        # This should not happen (workflows cannot contain themselves). Update them anyway
+        order.extend(sorted(affected - set(order)))
+
+        workflows = Workflow.objects.in_bulk(order)
+        return [(workflows[pk], [workflows[x] for x in uses[pk]]) for pk in order]
+
+    def __propagate(self, workflows_using_me, splice, root_pk=None):
+        '''
+        Update the graphs of all the workflows that use the updated tool / workflow (self.key), directly or through other workflows.
+        splice(graph) replaces the updated tool / workflow in a graph that contains it.
+        A workflow that does not contain it (i.e. its graph was created before the workflows that it uses were updated)
+        gets the updated graphs of the workflows that it uses. This is why they are updated in topological order.
+        Every graph is parsed and serialized once. The graphs are saved together.
+        '''
 
-        # Update also the workflows that are using me
-        for workflow_using_me in self.workflows_using_me:
+        updated_graphs = {} # workflow cytoscape id --> updated graph
+        workflows_graphs = []
+        affected_workflows = self.__affected_workflows(workflows_using_me, root_pk)
+        for done, (workflow_using_me, workflows_used) in enumerate(affected_workflows):
+            if self.progress:
+                self.progress(done, len(affected_workflows))
 
             #print ('workflow using me:', workflow_using_me)
 
             graph = simplejson.loads(workflow_using_me.workflow)
-            belongto, workflow_nodes = self.__build_workflow_belongto(graph)
+            ids = {node['data']['id'] for node in graph['elements']['nodes']}
 
-            # Get the workflow that the workflow that we want to update belongs to 
-            belongto_root = belongto[self.key]
-            #print ('   belongto_root: ', belongto_root)
+            if self.key in ids:
+                splice(graph)
+            else:
+                spliced = False
+                for workflow_used in workflows_used:
+                    workflow_used_key = workflow_id_cytoscape(workflow_used, None, None)
+                    if workflow_used_key in ids and workflow_used_key in updated_graphs:
+                        workflow_used_graph = updated_graphs[workflow_used_key]
+                        workflow_used_ids = {node['data']['id'] for node in workflow_used_graph['elements']['nodes']}
+                        self.__splice_workflow(graph, workflow_used_key, workflow_used_graph, workflow_used_ids, workflow_used)
+                        spliced = True
+                if not spliced:
+                    continue
 
-            # Get the workflow node that we want to update
-            workflow_node_root = workflow_nodes[self.key]
-            #print ('   Workflow node root:', workflow_node_root)
+            workflow_using_me.workflow = simplejson.dumps(graph)
+            updated_graphs[workflow_id_cytoscape(workflow_using_me, None, None)] = graph
+            workflows_graphs.append((workflow_using_me, graph))
 
-            # This is a set of all the nodes that this sub-workflow has
-            workflow_nodes_set = self.__nodes_belonging_to_a_workflow(graph, workflow_node_root, workflow_nodes)
-            #print ('  workflow nodes set:', workflow_nodes_set)
+        if self.progress:
+            self.progress(len(affected_workflows), len(affected_workflows))
 
-            # Remove these nodes (and edges connected to them) from the graph
-            self.__remove_nodes_edges(graph, workflow_nodes_set, self.all_ids)
+        if not workflows_graphs:
+            return
 
-            #print ('The graph after removing of nodes edges:')
-            #print (simplejson.dumps(graph, indent=4))
+        workflows = [workflow for workflow, _ in workflows_graphs]
+        with transaction.atomic():
+            # Save the graphs
+            Workflow.objects.bulk_update(workflows, ['workflow'])
 
-            # Add the edges of this graph
-            graph['elements']['edges'].extend(self.graph['elements']['edges'])
+            # Check graph <--> model consistency
+            self.__consistency_check_graph_model(workflows_graphs)
 
-            # Add the nodes of this graph
-            # Make sure that any main step becomes sub_main
-            nodes_to_add = self.graph['elements']['nodes']
-            for node in nodes_to_add:
-                if node['data']['type'] == 'step':
-                    if node['data']['main']:
-                        node['data']['main'] = False
-                        node['data']['sub_main'] = True
+        # bulk_update does not send post_save
+        detail_cache.invalidate_workflows(workflows)
 
-            graph['elements']['nodes'].extend(nodes_to_add)
+    def __splice_workflow(self, graph, key, workflow_graph, workflow_ids, workflow_object):
+        '''
+        Replace the sub-workflow with id key in graph with workflow_graph (the graph of workflow_object, with node ids workflow_ids)
+        '''
 
-            # Update the belongto info on the root workflow node. We cannot use the belongto and workflow_nodes any more
-            workflow_node_root = [node for node in graph['elements']['nodes'] if node['data']['id'] == self.key][0]
-            workflow_node_root['data']['belongto'] = {'name': belongto_root['data']['name'] , 'edit': belongto_root['data']['edit']}
+        belongto, workflow_nodes = self.__build_workflow_belongto(graph)
 
-            # Update the root workflow node
-            self.__update_workflow_node(workflow_node_root, self.workflow)
+        # Get the workflow that the workflow that we want to update belongs to 
+        belongto_root = belongto[key]
+        #print ('   belongto_root: ', belongto_root)
 
-            # Save the graph
-            workflow_using_me.workflow = simplejson.dumps(graph)
-            workflow_using_me.save()
+        # Get the workflow node that we want to update
+        workflow_node_root = workflow_nodes[key]
+        #print ('   Workflow node root:', workflow_node_root)
 
-            # Check graph <--> model consistency
-            self.__consistency_check_graph_model(graph, workflow_using_me)
+        # This is a set of all the nodes that this sub-workflow has
+        workflow_nodes_set = self.__nodes_belonging_to_a_workflow(graph, workflow_node_root, workflow_nodes)
+        #print ('  workflow nodes set:', workflow_nodes_set)
+
+        # Remove these nodes (and edges connected to them) from the graph
+        self.__remove_nodes_edges(graph, workflow_nodes_set, workflow_ids)
+
+        #print ('The graph after removing of nodes edges:')
+        #print (simplejson.dumps(graph, indent=4))
+
+        # Add the edges of this graph
+        graph['elements']['edges'].extend(copy.deepcopy(workflow_graph['elements']['edges']))
+
+        # Add the nodes of this graph
+        # Make sure that any main step becomes sub_main
+        nodes_to_add = copy.deepcopy(workflow_graph['elements']['nodes'])
+        for node in nodes_to_add:
+            if node['data']['type'] == 'step':
+                if node['data']['main']:
+                    node['data']['main'] = False
+                    node['data']['sub_main'] = True
+
+        graph['elements']['nodes'].extend(nodes_to_add)
+
+        # Update the belongto info on the root workflow node. We cannot use the belongto and workflow_nodes any more
+        workflow_node_root = [node for node in nodes_to_add if node['data']['id'] == key][0]
+        workflow_node_root['data']['belongto'] = {'name': belongto_root['data']['name'] , 'edit': belongto_root['data']['edit']}
 
-    def __update_tool(self,):
+        # Update the root workflow node
+        self.__update_workflow_node(workflow_node_root, workflow_object)
+
+    def __splice_tool(self, graph):
         '''
+        Replace this tool and its dependencies in graph
         '''
 
-        # Update all the workflows who are using this tool
-        for workflow_using_me in self.workflows_using_me:
+        #print ('The graph of this tool:')
+        #print (simplejson.dumps(self.graph, indent=4))
 
-            #print ('The graph of this tool:')
-            #print (simplejson.dumps(self.graph, indent=4))
+        #print ('   The workflow graph:')
+        #print (simplejson.dumps(graph, indent=4))
 
-            #print ('Workflow using me:', workflow_using_me.name, workflow_using_me.edit)
+        all_nodes = {node['data']['id']:node for node in graph['elements']['nodes']}
+        edges = self.__build_edges_dict(graph)
 
-            graph = simplejson.loads(workflow_using_me.workflow)
+        tool_node = all_nodes[self.key]
+        tool_node_belongto = tool_node['data']['belongto']
 
-            #print ('   The workflow graph:')
-            #print (simplejson.dumps(graph, indent=4))
+        # Use download_tool() does the same task. The problem is that it works directly with the UI. 
+        # We want to construct a cytoscape graph from the database object
 
-            all_nodes = {node['data']['id']:node for node in graph['elements']['nodes']}
-            belongto = {node['data']['id']: node['data']['belongto'] for node in graph['elements']['nodes']}
-            edges = self.__build_edges_dict(graph)
+        # Get a set of the node ids that depend from this tool
+        tool_dependencies = self.__tool_dependencies(tool_node, all_nodes, edges)
 
-            #print ('   All nodes:')
-            #print (simplejson.dumps(all_nodes, indent=4))
+        #print ('   Nodes to delete:')
+        #print (tool_dependencies)
 
-            #print ('   Belongto:')
-            #print (simplejson.dumps(belongto, indent=4))
+        # Remove these nodes (and edges connected to them) from the graph
+        self.__remove_nodes_edges(graph, tool_dependencies, self.all_ids)
 
-            #print ('   self.key:', self.key)
+        # Add the edges of the graph
+        graph['elements']['edges'].extend(copy.deepcopy(self.graph['elements']['edges']))
 
-            tool_node = all_nodes[self.key]
-            tool_node_belongto = belongto[self.key]
+        # Add the nodes of this graph
+        # Make sure that they have the right belongto info
+        nodes_to_add = copy.deepcopy(self.graph['elements']['nodes'])
+        for node_to_add in nodes_to_add:
+            node_to_add['data']['belongto'] = tool_node_belongto
 
-            # Use download_tool() does the same task. The problem is that it works directly with the UI. 
-            # We want to construct a cytoscape graph from the database object
+        graph['elements']['nodes'].extend(nodes_to_add)
 
-            # Get a set of the node ids that depend from this tool
-            tool_dependencies = self.__tool_dependencies(tool_node, all_nodes, edges)
 
-            #print ('   Nodes to delete:')
-            #print (tool_dependencies)
+def run_workflow_update_job(job):
+    '''
+    Run a claimed WorkflowUpdateJob
+    '''
 
-            # Remove these nodes (and edges connected to them) from the graph
-            self.__remove_nodes_edges(graph, tool_dependencies, self.all_ids)
+    last_report = [0]
+    def progress(done, total):
+        # Do not write the progress more than once per second
+        now = time.time()
+        if done < total and now - last_report[0] < 1:
+            return
+        last_report[0] = now
+        WorkflowUpdateJob.objects.filter(pk=job.pk).update(progress=done, total=total, updated_at=timezone.now())
 
-            #print ('   Graph After Deletion of nodes and edges:')
-            #print (simplejson.dumps(graph, indent=4))
+    WJ = WorkflowJSON(progress=progress)
+    try:
+        if job.ro == WorkflowUpdateJob.TOOL:
+            WJ.update_tool(Tool.objects.get(pk=job.object_pk))
+        else:
+            WJ.update_workflow(Workflow.objects.get(pk=job.object_pk))
+    except Exception as e:
+        logger.exception('Workflow update job {} failed'.format(job.pk))
+        WorkflowUpdateJob.objects.filter(pk=job.pk).update(status=WorkflowUpdateJob.FAILED, error=str(e), updated_at=timezone.now())
+    else:
+        WorkflowUpdateJob.objects.filter(pk=job.pk).update(status=WorkflowUpdateJob.DONE, updated_at=timezone.now())
 
-            # Add the edges of the graph
-            #print ('   Edges to add:')
-            #print (simplejson.dumps(self.graph['elements']['edges'], indent=4))
-            graph['elements']['edges'].extend(self.graph['elements']['edges'])
+def run_workflow_update_jobs():
+    '''
+    Run all queued WorkflowUpdateJobs (oldest first). Called from scripts/workflow_update_worker.py
+    The jobs of workers that crashed are queued again first (see WorkflowUpdateJob.requeue_stale)
+    Returns the number of jobs that this worker run
+    '''
 
-            # Add the nodes of this graph
-            # Make sure that they have the right belongto info
-            nodes_to_add = self.graph['elements']['nodes']
-            for node_to_add in nodes_to_add:
-                node_to_add['data']['belongto'] = tool_node_belongto
+    WorkflowUpdateJob.requeue_stale()
 
-            #print ('   Nodes to add:')
-            #print (simplejson.dumps(nodes_to_add, indent=4))
+    ran = 0
+    for job in WorkflowUpdateJob.objects.filter(status=WorkflowUpdateJob.QUEUED).order_by('pk'):
+        if not job.claim():
+            continue # Another worker got it
+        run_workflow_update_job(job)
+        ran += 1
 
-            graph['elements']['nodes'].extend(nodes_to_add)
+    return ran
 
-            #print ('  Graph after adding new tool dependencies')
-            #print (simplejson.dumps(graph, indent=4))
+@has_data
+def job_status(request, **kwargs):
+    '''
+    path: job_status/
+    The status of a WorkflowUpdateJob (the job_id that tools_add, workflows_add and ro_finalize_delete return)
+    '''
 
-            # Save the graph
-            workflow_using_me.workflow = simplejson.dumps(graph)
-            workflow_using_me.save()
+    try:
+        job_id = int(kwargs.get('job_id', ''))
+    except ValueError:
+        return fail('Error 7015')
 
-            # Check graph <--> model consistency
-            self.__consistency_check_graph_model(graph, workflow_using_me)
+    try:
+        job = WorkflowUpdateJob.objects.get(pk=job_id)
+    except ObjectDoesNotExist:
+        return fail('Error 7016. Could not find job')
+
+    ret = {
+        'status': job.status,
+        'progress': job.progress,
+        'total': job.total,
+        'error': job.error,
+        'created_at': datetime_to_str(job.created_at),
+        'updated_at': datetime_to_str(job.updated_at),
+    }
 
+    return success(ret)
 
 @has_data
 def ro_finalize_delete(request, **kwargs):
@@ -2672,6 +2928,7 @@ def ro_finalize_delete(request, **kwargs):
     except ObjectDoesNotExist as e:
         return fail('Error 5472')
 
+    job_id = None # The background job that updates the workflows that use a finalized tool/workflow (see job_status)
 
     if ro == 'tool':
 
@@ -2707,15 +2964,14 @@ def ro_finalize_delete(request, **kwargs):
 
         if action == 'FINALIZE':
             # Does it depend on any tool that is draft?
-            draft_dependencies = [t for t in tool_get_dependencies_internal(tool, include_as_root=False) if t['dependency'].draft]
-            if draft_dependencies:
-                return fail('This tool cannot be finalized. It depends from {} draft tool(s). For example: {}'.format(len(draft_dependencies), str(draft_dependencies[0]['dependency'])))
+            draft_dependencies = Tool.objects.filter(closure_dependants_related__tool=tool, draft=True)
+            if draft_dependencies.exists():
+                return fail('This tool cannot be finalized. It depends from {} draft tool(s). For example: {}'.format(draft_dependencies.count(), str(draft_dependencies.first())))
             
             tool.draft = False
             tool.save()
 
-            WJ = WorkflowJSON()
-            WJ.update_tool(tool)
+            job_id = WorkflowUpdateJob.enqueue(WorkflowUpdateJob.TOOL, tool).pk
 
         elif action == 'DELETE':
             # Is there any other tool that depends from this tool?
@@ -2743,9 +2999,10 @@ def ro_finalize_delete(request, **kwargs):
             tool.comment.delete()
 
             # Delete the tool
+            # No tool depends on it, so deleting its ToolClosure rows (in cascade) is enough 
             tool.delete()
 
-        return success()
+        return success({'job_id': job_id})
 
     elif ro == 'workflow':
         workflow_info_name = kwargs.get('workflow_info_name', '')
@@ -2789,8 +3046,7 @@ def ro_finalize_delete(request, **kwargs):
             workflow.draft = False
             workflow.save()
             #workflow_has_changed(workflow) # Update other workflows that are using this
-            WJ = WorkflowJSON()
-            WJ.update_workflow(workflow) # TODO limit action to finalize!
+            job_id = WorkflowUpdateJob.enqueue(WorkflowUpdateJob.WORKFLOW, workflow).pk # TODO limit action to finalize!
 
         elif action == 'DELETE':
             # Is there any workflow that contains this workflow?
@@ -2815,7 +3071,7 @@ def ro_finalize_delete(request, **kwargs):
             # Delete the workflow
             workflow.delete()
 
-        return success()
+        return success({'job_id': job_id})
 
 
 def create_workflow_edge_id(source_id, target_id):
@@ -3191,10 +3447,6 @@ def workflows_add(request, **kwargs):
             workflow_using_this_workflow.workflows.add(new_workflow)
             workflow_using_this_workflow.save()
 
-        # Update the json graph to the workflows that are using me
-        WJ = WorkflowJSON()
-        WJ.update_workflow(new_workflow)
-
     else:
         # Add an empty comment. This will be the root comment for the QA thread
         comment = Comment(
@@ -3214,11 +3466,14 @@ def workflows_add(request, **kwargs):
     #print ('AFTER SAVE:')
     #print (simplejson.dumps(simplejson.loads(new_workflow.workflow), indent=4))
 
+    # Update the json graph to the workflows that are using me. This happens in the background (see run_workflow_update_jobs)
+    job_id = WorkflowUpdateJob.enqueue(WorkflowUpdateJob.WORKFLOW, new_workflow).pk if workflow_edit_state else None
 
     ret = {
         'description_html': workflow_description_html, 
         'edit': next_edit,
         'created_at': datetime_to_str(new_workflow.created_at),
+        'job_id': job_id, # See job_status
         'score': upvotes-downvotes,
         'voted': {'up': upvoted, 'down': downvoted},
 
@@ -3237,28 +3492,23 @@ def workflows_search_3(request, **kwargs):
     workflow_name = kwargs['workflow_name']
     workflow_edit = kwargs['workflow_edit']
 
-    workflow = Workflow.objects.get(name__iexact = workflow_name, edit=workflow_edit)
+    key = detail_cache.workflow_key(workflow_name, workflow_edit)
+    ret = detail_cache.get_document(key)
+    if ret is None:
+        workflow = Workflow.objects.get(name__iexact = workflow_name, edit=workflow_edit)
+        ret = workflow_detail_document(workflow)
+        detail_cache.set_document(key, ret)
 
-    # Get current obc_user
-    if request.user.is_anonymous:
-        obc_user = None
-    else:
-        obc_user = OBC_user.objects.get(user=request.user)
+    # Add the votes of this user
+    ro_detail_add_votes(ret, get_obc_user(request), 'workflow')
 
-    #Is it voted?
-    if obc_user:
-        try:
-            v = UpDownWorkflowVote.objects.get(obc_user=obc_user, workflow=workflow)
-        except ObjectDoesNotExist as e:
-            # It is not voted
-            workflow_voted = {'up': False, 'down': False}
-        else:
-            # It is noted
-            workflow_voted = {'up': v.upvote, 'down': not v.upvote}
-
-    else:
-        workflow_voted = {'up': False, 'down': False}
+    return success(ret)
 
+def workflow_detail_document(workflow):
+    '''
+    Everything that workflows_search_3 returns except from the votes of the user.
+    This is cached (see detail_cache.py)
+    '''
 
     ret = {
         'username': workflow.obc_user.user.username,
@@ -3271,9 +3521,8 @@ def workflows_search_3(request, **kwargs):
         'workflow' : simplejson.loads(workflow.workflow),
         'changes': workflow.changes,
         'workflow_pk': workflow.pk, # Used in comments (QAs)
-        'workflow_thread': qa_create_thread(workflow.comment, obc_user), # Workflow comment thread 
+        'workflow_thread': qa_create_thread(workflow.comment), # Workflow comment thread 
         'workflow_score': workflow.upvotes - workflow.downvotes,
-        'workflow_voted': workflow_voted,
         'workflow_comment_id': workflow.comment.pk, # Used to create a permalink to the comments
         'workflow_comment_title': workflow.comment.title,
         'workflow_comment_created_at': datetime_to_str(workflow.comment.created_at),
@@ -3282,7 +3531,27 @@ def workflows_search_3(request, **kwargs):
 
     }
 
-    return success(ret)
+    return ret
+
+def ro_detail_add_votes(ret, obc_user, ro):
+    '''
+    Add the votes of obc_user on the detail document of a tool / workflow (see tools_search_3)
+    The vote on the tool / workflow and the votes on all the comments of its thread. No queries for anonymous users.
+    ro: 'tool' or 'workflow'
+    '''
+
+    comments = []
+    to_visit = list(ret[ro + '_thread'])
+    while to_visit:
+        comment = to_visit.pop()
+        comments.append(comment)
+        to_visit.extend(comment['children'])
+
+    ret[ro + '_voted'] = get_updownvotes(obc_user, ro, [ret[ro + '_pk']])[ret[ro + '_pk']]
+
+    votes = get_updownvotes(obc_user, 'comment', [comment['id'] for comment in comments])
+    for comment in comments:
+        comment['voted'] = votes[comment['id']]
 
 def workflow_node_cytoscape(workflow, name='root', edit=0):
     '''
@@ -3516,6 +3785,8 @@ def download_workflow(request, **kwargs):
     workflow_obc_client = kwargs.get('obc_client', False)
     do_url_quote = kwargs.get('do_url_quote', True) # See rest_views.py
     return_bytes = kwargs.get('return_bytes', False) # See rest_views.py 
+    stream = kwargs.get('stream', False) # Return the archive (CWLTARGZ, CWLZIP) as an iterator of bytes. Needs return_bytes. See rest_views.py
+    report_batch = kwargs.get('report_batch', False) # BASH: Report the status in batches. See views.report_batch
 
 
     #print ('Name:', workflow_arg['name'])
@@ -3551,17 +3822,7 @@ def download_workflow(request, **kwargs):
     #print (workflow_cy)
 
     # Create a new Report object 
-    if (not user_is_validated(request)) or (not workflow) or (workflow.draft):
-        '''
-        If :
-            user is anonymous or 
-            with non-validated email or 
-            not saved workflow or 
-            this is a tool run (workflow is None) or
-            workflow is draft 
-        then:
-            we do not create a report!
-        '''
+    if not download_workflow_creates_report(request, workflow):
         run_report = None
         nice_id = None
         token = None
@@ -3603,15 +3864,24 @@ def download_workflow(request, **kwargs):
 
     server_url = get_server_url(request)
 
+    # Without a report, the output depends only on the workflow and the arguments. See artifact_cache.py
+    artifact_key = None
+    if workflow and not report_created and artifact_cache.is_cacheable(download_type, workflow_id):
+        artifact_key = artifact_cache.get_key(workflow, download_type, workflow_options_arg, workflow_id, workflow_obc_client, server_url)
+    cached_output_object = artifact_cache.get_artifact(artifact_key) if artifact_key else None
+
     try:
-        if download_type == 'JSON':
+        if cached_output_object is not None:
+            output_object = cached_output_object
+        elif download_type == 'JSON':
             output_object = simplejson.dumps(output_object)
         elif download_type == 'BASH':
-            output_object = create_bash_script(output_object, server_url, 'sh')
+            # Without a report there is nothing to report (and the cached artifacts do not depend on report_batch)
+            output_object = create_bash_script(output_object, server_url, 'sh', report_batch=report_batch and report_created)
         elif download_type == 'CWLTARGZ':
-            output_object = create_bash_script(output_object, server_url, 'cwltargz', workflow_id=workflow_id)
+            output_object = create_bash_script(output_object, server_url, 'cwltargz', workflow_id=workflow_id, stream=stream)
         elif download_type == 'CWLZIP':
-            output_object = create_bash_script(output_object, server_url, 'cwlzip', workflow_id=workflow_id)
+            output_object = create_bash_script(output_object, server_url, 'cwlzip', workflow_id=workflow_id, stream=stream)
         elif download_type == 'AIRFLOW':
             output_object = create_bash_script(output_object, server_url, 'airflow', workflow_id=workflow_id, obc_client=workflow_obc_client)
         elif download_type == 'ARGO':
@@ -3624,6 +3894,14 @@ def download_workflow(request, **kwargs):
         else:
             output_object = 'UNKNOWN TYPE' # THIS SHOULD NEVER HAPPEN
 
+        if stream and cached_output_object is not None:
+            output_object = iter([cached_output_object])
+        elif stream:
+            # Cache it after the last chunk
+            output_object = artifact_cache.stream_artifact(artifact_key, output_object)
+        elif artifact_key and cached_output_object is None:
+            artifact_cache.set_artifact(artifact_key, output_object)
+
         if do_url_quote:
             output_object = urllib.parse.quote(output_object)
         
@@ -3640,6 +3918,18 @@ def download_workflow(request, **kwargs):
 
     return success(ret)
 
+def download_workflow_creates_report(request, workflow):
+    '''
+    Does download_workflow create a report (and a report token in the output)? 
+    Not if:
+        user is anonymous or 
+        with non-validated email or 
+        not saved workflow or 
+        this is a tool run (workflow is None) or
+        workflow is draft 
+    '''
+    return bool(workflow) and (not workflow.draft) and user_is_validated(request)
+
 def callback_url(request):
     '''
     Buld callback url
@@ -3783,6 +4073,42 @@ curl --header "Content-Type: application/json" \
     return success(ret)
 
 
+def report_save_events(token, events):
+    '''
+    Used by report and report_batch. events are the (unsaved) ReportEvent of the received statuses. They are parsed only once (ReportEvent.from_status)
+    Checks and deactivates the token (only once for all events), saves the events (with one insert)
+    and returns (new token, None) or (None, error message)
+    '''
+
+    with transaction.atomic():
+        #Get the ReportToken
+        try:
+            old_report_token = ReportToken.objects.select_for_update().get(token=token) 
+        except ObjectDoesNotExist as e:
+            return None, 'Could not find entry to this token'
+
+        if not old_report_token.active:
+            return None, 'This token has expired'
+
+        # Get the report
+        report_obj = old_report_token.report_related.first()
+        if report_obj is None:
+            return None, 'Could not find the report of this token'
+
+        # Deactivate it
+        old_report_token.active = False
+        old_report_token.save(update_fields=['active'])
+
+        for event in events:
+            event.report = report_obj
+        ReportEvent.objects.bulk_create(events)
+
+        # Return a new token. create() and the through model: one INSERT each (save() and tokens.add() also SELECT)
+        new_report_token = ReportToken.objects.create(status=events[-1].status, active=True)
+        Report.tokens.through.objects.create(report=report_obj, reporttoken=new_report_token)
+
+    return new_report_token, None
+
 @csrf_exempt
 @has_data
 def report(request, **kwargs):
@@ -3804,35 +4130,50 @@ def report(request, **kwargs):
     if not status_received:
         return fail('Could not find status field')
 
-    status_fields = ReportToken.parse_response_status(status_received)
+    event = ReportEvent.from_status(None, status_received)
     #if not status_received in ReportToken.STATUS_CHOICES:
-    if status_fields is None:
+    if event is None:
         return fail('Unknown status: {}'.format(status_received))
 
-    #Get the ReportToken
-    try:
-        old_report_token = ReportToken.objects.get(token=token) 
-    except ObjectDoesNotExist as e:
-        return fail('Could not find entry to this token')
+    new_report_token, error_message = report_save_events(token, [event])
+    if error_message:
+        return fail(error_message)
 
-    if not old_report_token.active:
-        return fail('This token has expired')
+    return success({'token': str(new_report_token.token)})
 
-    # Deactivate it
-    old_report_token.active = False
-    old_report_token.save()
+@csrf_exempt
+@has_data
+def report_batch(request, **kwargs):
+    '''
+    called from executor (sh scripts with batch reporting, see executor.LocalExecutor)
+    Same as report, but with a list of statuses (in the order that they happened).
+    The token is checked once and one new token is returned for the whole batch.
+    '''
 
-    # Get the report
-    report_obj = old_report_token.report_related.first()
+    token = kwargs.get('token', None)
+    if not token:
+        return fail('Could not find token field')
 
-    # Save the new status and return a new token 
-    new_report_token = ReportToken(status=status_received, active=True) # Duplicate code
-    new_report_token.save()
-    report_obj.tokens.add(new_report_token)
-    report_obj.save()
+    if not uuid_is_valid(token):
+        return fail('bad token format')
 
-    #print ('OLD STATUS:', old_report_token.status)
-    #print ('NEW STATUS:', new_report_token.status)
+    statuses_received = kwargs.get('statuses', None)
+    if not statuses_received or not isinstance(statuses_received, list):
+        return fail('Could not find statuses field')
+
+    if len(statuses_received) > g['report_batch_max_statuses']:
+        return fail('Too many statuses: {}. Maximum is {}'.format(len(statuses_received), g['report_batch_max_statuses']))
+
+    events = []
+    for status_received in statuses_received:
+        event = ReportEvent.from_status(None, status_received) if isinstance(status_received, str) else None
+        if event is None:
+            return fail('Unknown status: {}'.format(status_received))
+        events.append(event)
+
+    new_report_token, error_message = report_save_events(token, events)
+    if error_message:
+        return fail(error_message)
 
     return success({'token': str(new_report_token.token)})
 
@@ -3977,14 +4318,13 @@ def reports_search_2(main_search, request):
     '''
 
     # Return empty results if user is anonymous or not validated 
-    if request.user.is_anonymous or (not user_is_validated(request)):
+    obc_user = get_obc_user(request)
+    if (not obc_user) or (not obc_user.email_validated):
         return {
             'main_search_reports_number': 0,
             'reports_search_jstree': [],
         }
 
-    obc_user = OBC_user.objects.get(user=request.user)
-
     nice_id_Q = Q(nice_id__contains=main_search)
     username_Q = Q(obc_user__user__username__icontains=main_search)
     workflow_Q = Q(workflow__name__icontains=main_search)
@@ -3993,9 +4333,10 @@ def reports_search_2(main_search, request):
     user_Q = Q(obc_user = obc_user)
 
     # We do not want reports that have only one tokens which is "unused"
-    results = Report.objects.annotate(num_tokens=Count('tokens')).filter( 
+    # Evaluate once. The workflow (and its parent) are needed for every report
+    results = list(Report.objects.annotate(num_tokens=Count('tokens')).filter( 
         user_Q & (nice_id_Q | workflow_Q | username_Q) & (~(not_unused&count_1)) 
-    )
+    ).select_related('workflow__forked_from'))
 
     # BUILD TREE
     reports_search_jstree = []
@@ -4029,7 +4370,7 @@ def reports_search_2(main_search, request):
 
 
     ret = {
-        'main_search_reports_number': results.count(),
+        'main_search_reports_number': len(results),
         'reports_search_jstree': reports_search_jstree,
     }
 
@@ -4054,20 +4395,14 @@ def reports_search_3(request, **kwargs):
         return fail('Could not find report, or you do not have access.')
     workflow = report.workflow
 
-    #Get all tokens
+    #Get all statuses. They are stored parsed, see ReportEvent
     tokens = [{
-        'status': token.status,
-        'created_at': datetime_to_str(token.created_at),
-        'token': str(token.token), 
+        'status': event.status,
+        'created_at': datetime_to_str(event.created_at),
+        'token': str(event.pk), # Unique id of the status (ng-repeat track by)
         #'node_anim_id': create_node_anim_id(token.status), # the parameter passed to nodeAnimation
-        'node_anim_params': ReportToken.parse_response_status(token.status), # the parameter passed to nodeAnimation_public
-    } for token in report.tokens.all().order_by('created_at') if token.status != ReportToken.UNUSED]
-
-    # Check if ReportToken.parse_response_status successfully parsed tokens
-    # This is a sanity check
-    for token in tokens:
-        if token['node_anim_params'] is None:
-            return fail('Error 8915: could not parse token: {}'.format(token['status']))
+        'node_anim_params': event.status_fields(), # the parameter passed to nodeAnimation_public
+    } for event in report.events.order_by('created_at', 'pk')]
 
     ret = {
         'report_workflow_name': workflow.name,
@@ -4487,14 +4822,11 @@ def references_search_2(
     Collect all references from main search
     '''
 
-    name_Q = Q(name__icontains=main_search)
-    html_Q = Q(html__icontains=main_search)
-    username_Q = Q(obc_user__user__username__icontains=main_search)
-
-    results = Reference.objects.filter(name_Q | html_Q | username_Q)
+    results_number, results_pks = search_index(main_search, SearchEntry.REFERENCE, Reference.objects.all(), g['search_result_limit'])
+    results = Reference.objects.in_bulk(results_pks)
     references_search_jstree = []
 
-    for result in results:
+    for result in map(results.get, results_pks): # Keep the ranking
         to_add = {
             'data': {'name': result.name},
             'text': result.name + jstree_icon_html('references'),
@@ -4505,7 +4837,7 @@ def references_search_2(
         references_search_jstree.append(to_add)
 
     ret = {
-        'main_search_references_number': results.count(),
+        'main_search_references_number': results_number,
         'references_search_jstree': references_search_jstree,
     }
 
@@ -4516,33 +4848,22 @@ def qa_get_root_comment(comment):
     Take a comment in a nested thread and get the root comment
     '''
 
-    if not comment.parent:
+    if not comment.root_id:
         return comment
 
-    return qa_get_root_comment(comment.parent)
+    return comment.root
 
 def qa_search_2(main_search):
     '''
     Collect all Q&A from main search
     '''
-    title_Q = Q(title__icontains=main_search)
-    comment_Q = Q(comment__icontains=main_search)
-    username_Q = Q(obc_user__user__username__icontains=main_search)
-
-    results = Comment.objects.filter(title_Q | comment_Q | username_Q)
+    # The index has the root of the thread of each comment (None if it is the root)
+    # One result per thread, ranked by its best comment
+    results_number, results_pks = search_index_roots(main_search, SearchEntry.QA, Comment.objects.all(), g['search_result_limit'])
+    results = Comment.objects.in_bulk(results_pks)
 
     qa_search_tree = []
-    entries_in_tree = set()
-    for result in results:
-        # Get the root message
-        result_parent = qa_get_root_comment(result)
-
-        #Is this on the tree?
-        if result_parent.pk in entries_in_tree:
-            # It is already in the tree
-            continue
-        else:
-            entries_in_tree.add(result_parent.pk)
+    for result_parent in map(results.get, results_pks):
 
         # Remove <a></a> hyperlinks from question answers
         # See issue #106
@@ -4561,7 +4882,7 @@ def qa_search_2(main_search):
         qa_search_tree.append(to_add)
 
     ret = {
-        'main_search_qa_number': len(qa_search_tree),
+        'main_search_qa_number': results_number,
         'qa_search_jstree': qa_search_tree,
     }
 
@@ -4616,12 +4937,10 @@ def references_search_3(request, **kwargs):
 
 ### SEARCH 
 
-@has_data
-def all_search_2(request, **kwargs):
+def main_search_parse(main_search):
     '''
-    Called when there is a key change in main search
+    Split the main search to the tool fields (name/version/edit) and the workflow fields (name/edit)
     '''
-    main_search = kwargs.get('main_search', '')
 
     main_search_slash_count = main_search.count('/')
 
@@ -4669,6 +4988,17 @@ def all_search_2(request, **kwargs):
         workflows_search_name = ''
         workflows_search_edit = -1
 
+    return tools_search_name, tools_search_version, tools_search_edit, workflows_search_name, workflows_search_edit
+
+@has_data
+def all_search_2(request, **kwargs):
+    '''
+    Called when there is a key change in main search
+    '''
+    main_search = kwargs.get('main_search', '')
+
+    tools_search_name, tools_search_version, tools_search_edit, workflows_search_name, workflows_search_edit = main_search_parse(main_search)
+
     ret = {}
 
     #Get tools
@@ -4698,6 +5028,56 @@ def all_search_2(request, **kwargs):
     return success(ret)
 
 
+@has_data
+def tools_search_jstree_level(request, **kwargs):
+    '''
+    Called when a node of the tools search tree opens (get the forks) or when "More.." is clicked (get the next page)
+    parent: {name, version, edit} of the opened tool or null for the top level
+    '''
+    main_search = kwargs.get('main_search', '')
+    parent = kwargs.get('parent', None)
+    try:
+        cursor = int(kwargs.get('cursor', 0))
+    except ValueError:
+        return fail('Error 7011')
+    if cursor < 0:
+        return fail('Error 7011')
+
+    if parent:
+        try:
+            parent = Tool.objects.get(name=parent['name'], version=parent['version'], edit=int(parent['edit']))
+        except ObjectDoesNotExist:
+            return fail('Error 7012. Could not find tool')
+
+    tools_search_name, tools_search_version, tools_search_edit, _, _ = main_search_parse(main_search)
+
+    return success(tools_search_2(tools_search_name, tools_search_version, tools_search_edit, parent=parent, cursor=cursor))
+
+@has_data
+def workflows_search_jstree_level(request, **kwargs):
+    '''
+    See tools_search_jstree_level
+    parent: {name, edit} of the opened workflow or null for the top level
+    '''
+    main_search = kwargs.get('main_search', '')
+    parent = kwargs.get('parent', None)
+    try:
+        cursor = int(kwargs.get('cursor', 0))
+    except ValueError:
+        return fail('Error 7013')
+    if cursor < 0:
+        return fail('Error 7013')
+
+    if parent:
+        try:
+            parent = Workflow.objects.get(name=parent['name'], edit=int(parent['edit']))
+        except ObjectDoesNotExist:
+            return fail('Error 7014. Could not find workflow')
+
+    _, _, _, workflows_search_name, workflows_search_edit = main_search_parse(main_search)
+
+    return success(workflows_search_2(workflows_search_name, workflows_search_edit, parent=parent, cursor=cursor))
+
 ### END OF SEARCH
 
 ### Q&A 
@@ -4743,13 +5123,22 @@ def qa_add_1(request, **kwargs):
 
     return success(ret)
 
-def qa_create_thread(comment, obc_user = None):
+def qa_get_thread(comment, obc_user = None):
     '''
-    Recursive
     Create the children thread of a comment
+    Fetch all the subthread in one query (see Comment.path) and the votes of the user in another.
+    Returns the thread and the vote of the user on the comment
     '''
-    ret = []
-    for child in comment.children.all():
+    subthread = list(Comment.objects.filter(
+        root_id=comment.root_id or comment.pk,
+        path__startswith=comment.thread_path(),
+    ).select_related('obc_user__user').order_by('depth', 'created_at', 'pk'))
+
+    votes = get_updownvotes(obc_user, 'comment', [comment.pk] + [child.pk for child in subthread])
+
+    # Parents are always before children (ordered by depth)
+    children = {comment.pk: []}
+    for child in subthread:
         to_add = {
             'comment': child.comment,
             'comment_html': child.comment_html,
@@ -4757,13 +5146,22 @@ def qa_create_thread(comment, obc_user = None):
             'score': child.upvotes - child.downvotes,
             'id': child.pk,
             'replying': False,
-            'voted' : is_comment_updownvoted(obc_user, child),
-            'children': qa_create_thread(child, obc_user),
+            'voted' : votes[child.pk],
+            'children': [],
             'username': child.obc_user.user.username,
             'created_at': datetime_to_str(child.created_at),
         }
-        ret.append(to_add)
-    return ret
+        children[child.parent_id].append(to_add)
+        children[child.pk] = to_add['children']
+
+    return children[comment.pk], votes[comment.pk]
+
+def qa_create_thread(comment, obc_user = None):
+    '''
+    Create the children thread of a comment
+    '''
+    thread, _ = qa_get_thread(comment, obc_user)
+    return thread
 
 
 @has_data
@@ -4790,14 +5188,16 @@ def qa_search_3(request, **kwargs):
         obc_user = OBC_user.objects.get(user=request.user)
 
 
+    qa_thread, qa_voted = qa_get_thread(comment, obc_user)
+
     ret = {
         'qa_title': comment.title,
         'qa_comment': comment.comment,
         'qa_comment_html': comment.comment_html,
         'qa_score': comment.upvotes - comment.downvotes,
         'qa_id': comment.pk,
-        'qa_thread': qa_create_thread(comment, obc_user),
-        'qa_voted': is_comment_updownvoted(obc_user, comment),
+        'qa_thread': qa_thread,
+        'qa_voted': qa_voted,
         'qa_username': comment.obc_user.user.username,
         'qa_created_at': datetime_to_str(comment.created_at),
     }
@@ -4859,10 +5259,12 @@ def gen_qa_search_3(request, **kwargs):
         obc_user = OBC_user.objects.get(user=request.user)
 
     # Get the thread of this comment
+    qa_thread, qa_voted = qa_get_thread(commentable.comment, obc_user)
+
     ret = {
         'qa_id': commentable.comment.pk,
-        'qa_thread': qa_create_thread(commentable.comment, obc_user),
-        'qa_voted': is_comment_updownvoted(obc_user, commentable.comment),
+        'qa_thread': qa_thread,
+        'qa_voted': qa_voted,
         'qa_score': commentable.comment.upvotes - commentable.comment.downvotes,
         'qa_username': commentable.comment.obc_user.user.username,
         'qa_created_at': datetime_to_str(commentable.comment.created_at),
@@ -4976,20 +5378,35 @@ def gen_qa_add_comment(request, **kwargs):
 
     return success(ret)
 
-def is_comment_updownvoted(obc_user, comment):
+def get_updownvotes(obc_user, ro, pks):
     '''
-    Has this user upvoted or downvoted this comment?
+    Has this user upvoted or downvoted these comments / tools / workflows?
+    ro: 'comment', 'tool' or 'workflow'
+    Returns a dictionary: pk --> {'up': .., 'down': ..} for every pk in pks. One query.
     '''
 
-    if obc_user is None:
-        return {'up': False, 'down': False}
+    ro_ud_table = {
+        'comment': UpDownCommentVote,
+        'tool': UpDownToolVote,
+        'workflow': UpDownWorkflowVote,
+    }[ro]
 
-    try:
-        vote = UpDownCommentVote.objects.get(obc_user=obc_user, comment=comment)
-    except ObjectDoesNotExist as e:
-        return {'up': False, 'down': False}
+    if obc_user is None or not pks:
+        votes = {}
+    else:
+        votes = dict(ro_ud_table.objects.filter(**{
+            'obc_user': obc_user,
+            ro + '__in': pks,
+        }).values_list(ro + '_id', 'upvote'))
+
+    return {pk: {'up': votes.get(pk) is True, 'down': votes.get(pk) is False} for pk in pks}
+
+def is_comment_updownvoted(obc_user, comment):
+    '''
+    Has this user upvoted or downvoted this comment?
+    '''
 
-    return {'up': vote.upvote, 'down': not vote.upvote}
+    return get_updownvotes(obc_user, 'comment', [comment.pk])[comment.pk]
 
 @has_data
 def updownvote_comment(request, **kwargs):
@@ -0,0 +1,35 @@
+import os
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OpenBioC.settings'
+import django
+django.setup()
+
+from app.models import Report, ReportToken, ReportEvent
+
+'''
+Create the ReportEvent of the reports that were run before ReportEvent existed.
+The statuses of these reports are only in their tokens (Report.tokens)
+Run this once after the migration that creates ReportEvent. Reports that already have events are skipped
+'''
+
+def do_1():
+
+	reports = 0
+	events = []
+	for report in Report.objects.filter(events__isnull=True).prefetch_related('tokens'):
+		reports += 1
+		for token in sorted(report.tokens.all(), key=lambda x: x.created_at):
+			if token.status == ReportToken.UNUSED:
+				continue
+			event = ReportEvent.from_status(report, token.status)
+			if event is None:
+				print ('Report: {} Unknown status: {}'.format(report.nice_id, token.status))
+				continue
+			event.created_at = token.created_at
+			events.append(event)
+
+	ReportEvent.objects.bulk_create(events, batch_size=1000)
+	print ('Created {} events of {} reports'.format(len(events), reports))
+
+if __name__ == '__main__':
+	do_1()
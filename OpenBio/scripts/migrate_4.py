@@ -0,0 +1,34 @@
+import os
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OpenBioC.settings'
+import django
+django.setup()
+
+from app.models import Comment
+
+'''
+Set the thread fields (root, depth, path) of the existing comments 
+New comments get them on insert (see Comment.save)
+'''
+
+def do_1():
+
+	# Parents are created before their children, so they come first
+	comments = {c.pk: c for c in Comment.objects.order_by('pk')}
+
+	for c in comments.values():
+		if c.parent_id is None:
+			c.root_id = None
+			c.depth = 0
+			c.path = ''
+		else:
+			parent = comments[c.parent_id]
+			c.root_id = parent.root_id or parent.pk
+			c.depth = parent.depth + 1
+			c.path = parent.thread_path()
+
+	Comment.objects.bulk_update(comments.values(), ['root', 'depth', 'path'], batch_size=500)
+	print ('Updated {} comments'.format(len(comments)))
+
+if __name__ == '__main__':
+	do_1()
@@ -0,0 +1,20 @@
+import os
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OpenBioC.settings'
+import django
+django.setup()
+
+from app.models import ToolClosure
+
+'''
+Build the ToolClosure table (all the dependencies of each tool) for the existing tools
+New and edited tools update it in views.tools_add
+'''
+
+def do_1():
+
+	ToolClosure.update()
+	print ('Created {} ToolClosure rows'.format(ToolClosure.objects.count()))
+
+if __name__ == '__main__':
+	do_1()
@@ -0,0 +1,21 @@
+import os
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OpenBioC.settings'
+import django
+django.setup()
+
+from app.models import SearchEntry
+from app.search import rebuild
+
+'''
+Rebuild the search index of the main search (see app/search.py)
+Run this once after the migration that creates SearchEntry/SearchGram 
+'''
+
+def do_1():
+
+	rebuild()
+	print ('Indexed {} objects'.format(SearchEntry.objects.count()))
+
+if __name__ == '__main__':
+	do_1()
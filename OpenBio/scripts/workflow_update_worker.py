@@ -0,0 +1,25 @@
+import os
+import time
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'OpenBioC.settings'
+import django
+django.setup()
+
+from app.views import run_workflow_update_jobs
+
+'''
+Run the background jobs (WorkflowUpdateJob) that update the graphs of the workflows 
+that use an edited / finalized tool or workflow. 
+Keep this running next to the server:
+python scripts/workflow_update_worker.py
+If a worker crashes or is killed, its running job is run again after WorkflowUpdateJob.STALE_AFTER
+'''
+
+def do_1():
+
+	while True:
+		if not run_workflow_update_jobs():
+			time.sleep(1)
+
+if __name__ == '__main__':
+	do_1()